@@ -0,0 +1,24 @@
+"""管理 API 的存取控制。
+
+交易查詢 / 匯出、批次退款、快取清除等 API 只給內部工具使用，以共用的 ADMIN_TOKEN 驗證；
+未設定 ADMIN_TOKEN 時直接停用，不會因為漏設而對外開放。
+"""
+import secrets
+from fastapi import HTTPException, Request
+import config
+
+
+def _supplied_token(request: Request) -> str:
+    token = request.headers.get("x-admin-token")
+    if token is not None:
+        return token
+    scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+    return credentials.strip() if scheme.lower() == "bearer" else ""
+
+
+async def require_admin(request: Request):
+    """FastAPI dependency：@app.get(..., dependencies=[Depends(require_admin)])。"""
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(status_code=503, detail="Admin API is disabled (ADMIN_TOKEN is not set)")
+    if not secrets.compare_digest(_supplied_token(request).encode("utf-8"), config.ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid admin token", headers={"WWW-Authenticate": "Bearer"})
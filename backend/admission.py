@@ -0,0 +1,248 @@
+"""付款端點的流量控制（ASGI middleware）。
+
+依序檢查：
+1. 機台 token bucket（以 JSON body 的 machine 欄位區分），超過速率回 429
+2. 同一機台同時處理中的請求數，超過回 429
+3. 全域處理中上限，滿了就排隊；佇列已滿或等待超過 QUEUE_TIMEOUT 回 503
+429 / 503 一律帶 Retry-After，單一機台重試風暴不會吃光整個服務的資源。
+body 超過 MAX_BODY_BYTES 時無法取得 machine，直接回 413，避免繞過機台限制。
+"""
+import asyncio
+import json
+import math
+import time
+from collections import OrderedDict, deque
+import config
+import metrics
+
+MAX_BODY_BYTES = 64 * 1024
+MAX_TRACKED_MACHINES = 10000
+MAX_LABELLED_MACHINES = 500  # machine 由用戶端提供，metric 只為前 N 台建立序列，其餘記為 "other"
+
+ADMISSION_DECISIONS = metrics.Counter(
+    "admission_decisions_total", "Admission decisions for payment endpoints", ("path", "result"),
+)
+ADMISSION_REJECTIONS_BY_MACHINE = metrics.Counter(
+    "admission_rejections_by_machine_total", "Requests shed per machine", ("machine", "reason"),
+)
+ADMISSION_QUEUE_WAIT = metrics.Histogram(
+    "admission_queue_wait_seconds", "Time spent waiting for a global admission slot",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0),
+)
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: float = None):
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """取一個 token，成功回傳 0，否則回傳需要等待的秒數。"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+
+class _MachineState:
+    __slots__ = ("bucket", "in_flight")
+
+    def __init__(self):
+        self.bucket = TokenBucket(config.ADMISSION_MACHINE_RATE, config.ADMISSION_MACHINE_BURST)
+        self.in_flight = 0
+
+
+class AdmissionController:
+    MAX_IN_FLIGHT = config.ADMISSION_MAX_IN_FLIGHT
+    QUEUE_SIZE = config.ADMISSION_QUEUE_SIZE
+    QUEUE_TIMEOUT = config.ADMISSION_QUEUE_TIMEOUT
+    MACHINE_CONCURRENCY = config.ADMISSION_MACHINE_CONCURRENCY
+
+    in_flight = 0
+    _waiters = deque()
+    _machines = OrderedDict()
+
+    @classmethod
+    def _machine(cls, machine: str) -> _MachineState:
+        state = cls._machines.get(machine)
+        if state is None:
+            state = cls._machines[machine] = _MachineState()
+            # 只淘汰沒有處理中請求的機台
+            while len(cls._machines) > MAX_TRACKED_MACHINES:
+                oldest, oldest_state = next(iter(cls._machines.items()))
+                if oldest_state.in_flight:
+                    cls._machines.move_to_end(oldest)
+                    break
+                del cls._machines[oldest]
+        else:
+            cls._machines.move_to_end(machine)
+        return state
+
+    @classmethod
+    async def acquire(cls, machine: str = None):
+        state = None
+        if machine is not None:
+            state = cls._machine(machine)
+            wait = state.bucket.take()
+            if wait:
+                raise Rejected(429, "rate_limited", wait)
+            if state.in_flight >= cls.MACHINE_CONCURRENCY:
+                raise Rejected(429, "machine_busy", 1)
+
+        if cls.in_flight >= cls.MAX_IN_FLIGHT or cls._waiters:
+            if len(cls._waiters) >= cls.QUEUE_SIZE:
+                raise Rejected(503, "queue_full", cls.QUEUE_TIMEOUT)
+            waiter = asyncio.get_running_loop().create_future()
+            cls._waiters.append(waiter)
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(waiter, timeout=cls.QUEUE_TIMEOUT)
+            except asyncio.TimeoutError:
+                # Python 3.12 起 wait_for 可能在 waiter 已被轉交名額後仍丟出逾時：名額已計入 in_flight，視為取得
+                if not waiter.done() or waiter.cancelled():
+                    raise Rejected(503, "queue_timeout", cls.QUEUE_TIMEOUT)
+            except asyncio.CancelledError:
+                # 已經被分配到名額才取消時要交還
+                if waiter.done() and not waiter.cancelled():
+                    cls._release_slot()
+                raise
+            finally:
+                if waiter in cls._waiters:
+                    cls._waiters.remove(waiter)
+                ADMISSION_QUEUE_WAIT.observe(time.perf_counter() - start)
+            # 名額由 release 直接轉交，in_flight 已經計入
+        else:
+            cls.in_flight += 1
+
+        if state is not None:
+            state.in_flight += 1
+        return state
+
+    @classmethod
+    def _release_slot(cls):
+        while cls._waiters:
+            waiter = cls._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # 名額直接轉給下一個等待者
+                return
+        cls.in_flight -= 1
+
+    @classmethod
+    def release(cls, state: _MachineState = None):
+        if state is not None:
+            state.in_flight -= 1
+        cls._release_slot()
+
+
+_labelled_machines = set()
+
+
+def _machine_label(machine: str) -> str:
+    if machine in _labelled_machines:
+        return machine
+    if len(_labelled_machines) < MAX_LABELLED_MACHINES:
+        _labelled_machines.add(machine)
+        return machine
+    return "other"
+
+
+def _machine_from_body(body: bytes):
+    try:
+        machine = json.loads(body).get("machine")
+    except (ValueError, AttributeError):
+        return None
+    return str(machine) if machine is not None else None
+
+
+async def _reject(send, rejected: Rejected):
+    if rejected.status_code == 413:
+        detail = f"Request body exceeds {MAX_BODY_BYTES} bytes"
+    else:
+        detail = f"Too many requests ({rejected.reason})"
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode("ascii")),
+    ]
+    if rejected.retry_after is not None:
+        headers.append((b"retry-after", str(max(1, math.ceil(rejected.retry_after))).encode("ascii")))
+    await send({"type": "http.response.start", "status": rejected.status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, paths=None):
+        self.app = app
+        self.paths = set(paths if paths is not None else
+                         [path.strip() for path in config.ADMISSION_PATHS.split(",") if path.strip()])
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+
+        # 先讀完 body 取得 machine，之後再原樣交給應用程式
+        chunks, size, more = [], 0, True
+        while more and size <= MAX_BODY_BYTES:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunk = message.get("body", b"")
+            chunks.append(chunk)
+            size += len(chunk)
+            more = message.get("more_body", False)
+        path = scope["path"]
+        if more or size > MAX_BODY_BYTES:
+            ADMISSION_DECISIONS.inc(path=path, result="body_too_large")
+            await _reject(send, Rejected(413, "body_too_large"))
+            return
+        body = b"".join(chunks)
+        machine = _machine_from_body(body)
+
+        replayed = False
+
+        async def replay_receive():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        try:
+            state = await AdmissionController.acquire(machine)
+        except Rejected as rejected:
+            ADMISSION_DECISIONS.inc(path=path, result=rejected.reason)
+            if machine is not None:
+                ADMISSION_REJECTIONS_BY_MACHINE.inc(machine=_machine_label(machine), reason=rejected.reason)
+            await _reject(send, rejected)
+            return
+
+        ADMISSION_DECISIONS.inc(path=path, result="admitted")
+        try:
+            await self.app(scope, replay_receive, send)
+        finally:
+            AdmissionController.release(state)
+
+
+metrics.Gauge(
+    "admission_in_flight", "Payment requests holding an admission slot",
+    callback=lambda: {(): AdmissionController.in_flight},
+)
+metrics.Gauge(
+    "admission_queue_depth", "Payment requests waiting for an admission slot",
+    callback=lambda: {(): len(AdmissionController._waiters)},
+)
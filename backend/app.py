@@ -1,10 +1,75 @@
-from fastapi import FastAPI, UploadFile, File
-from esunpay import EsunPayAPI, EsunPayRequest
+from fastapi import Depends, FastAPI, UploadFile, File, HTTPException, Query, Request
+from esunpay import EsunPayAPI, EsunPayRequest, EsunInquireRequest, EsunRefundRequest
 from linepay import LinePayAPI, LinePayRequest, LinePayRefundRequest
-from logdownload import LogAPI, schedule_log_upload
-from fastapi.responses import HTMLResponse
+from linepay_batch import LinePayBatchAPI, LinePayBatchInquireRequest, LinePayBatchRefundRequest
+from logdownload import LogAPI, BASE_DIR, UploadLimitMiddleware, safe_name, schedule_log_retention
+from b010_scheduler import B010Scheduler, schedule_log_upload
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from http_client import Upstreams
+from resilience import Resilience
+from credential_cache import CredentialCache
+from transaction_recorder import TransactionRecorder
+from transaction_query import TransactionQuery
+from database import Database
+from reconciliation import ReconciliationEngine
+from log_index import LogIndex
+from log_search import LogSearch
+from log_tail import LogTail
+from telemetry import Telemetry, FIELD_PATTERN as TELEMETRY_FIELD_PATTERN, parse_bucket
+import metrics
+import config
+from migrate import Migrations
+from structured_logging import CorrelationMiddleware, StructuredLogging
+from admin_auth import require_admin
+from admission import AdmissionMiddleware
+from leader import LeaderElection
+from shared_state import SharedEvents
+from lifecycle import Lifecycle
+from contextlib import asynccontextmanager
 import asyncio
-app = FastAPI()
+import datetime
+import os
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    StructuredLogging.setup()
+    await Upstreams.init_clients()
+    await SharedEvents.start()
+    await asyncio.to_thread(LogIndex.load)
+    await LeaderElection.start()
+    await TransactionRecorder.start()
+    loop_lag = asyncio.create_task(metrics.monitor_event_loop_lag())
+    # ✅ 暖機在背景執行，/healthz 立即可用，/readyz 在暖機完成後才回 200
+    warm_up = asyncio.create_task(Lifecycle.warm_up({
+        "database": Database.warm_up,
+        "schema": Migrations.check,
+        "upstreams": Upstreams.warm_up,
+    }))
+    schema_watch = asyncio.create_task(Migrations.watch())
+    try:
+        yield
+    finally:
+        # 先停止接手新工作，等背景工作完成，再依相依順序釋放資源
+        warm_up.cancel()
+        schema_watch.cancel()
+        await Lifecycle.drain()
+        await LeaderElection.stop()
+        await TransactionRecorder.stop()
+        await Database.close_pool()
+        await Upstreams.close_clients()
+        LogSearch.shutdown()
+        await SharedEvents.stop()
+        loop_lag.cancel()
+        await asyncio.gather(warm_up, schema_watch, loop_lag, return_exceptions=True)
+        StructuredLogging.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(AdmissionMiddleware)
+app.add_middleware(UploadLimitMiddleware)
+app.add_middleware(metrics.RequestMetricsMiddleware)
+app.add_middleware(CorrelationMiddleware)
 
 # 合併後的請求格式
 @app.post("/api/linepay/pay")
@@ -15,38 +80,247 @@ async def linepay_pay(request: LinePayRequest):
 async def linepay_inquire(channel_id: str, channel_secret: str, order_id: str):
     return await LinePayAPI.inquire(channel_id, channel_secret, order_id)
 
+@app.get("/api/linepay/reconcile/{order_id}")
+async def linepay_reconcile_status(order_id: str):
+    result = await ReconciliationEngine.get_status(order_id, "linepay")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return result
+
 @app.post("/api/linepay/refund")
 async def linepay_refund(request: LinePayRefundRequest):
     return await LinePayAPI.refund(request)
 
+@app.post("/api/linepay/inquire/batch", dependencies=[Depends(require_admin)])
+async def linepay_inquire_batch(request: LinePayBatchInquireRequest):
+    return StreamingResponse(LinePayBatchAPI.inquire(request), media_type="application/x-ndjson")
+
+@app.post("/api/linepay/refund/batch", dependencies=[Depends(require_admin)])
+async def linepay_refund_batch(request: LinePayBatchRefundRequest):
+    return StreamingResponse(LinePayBatchAPI.refund(request), media_type="application/x-ndjson")
+
 @app.post("/api/esunpay/pay")
 async def esunpay_pay(request: EsunPayRequest):
     return await EsunPayAPI.pay(request)
 
+@app.post("/api/esunpay/inquire")
+async def esunpay_inquire(request: EsunInquireRequest):
+    return await EsunPayAPI.inquire(request)
+
+@app.post("/api/esunpay/refund")
+async def esunpay_refund(request: EsunRefundRequest):
+    return await EsunPayAPI.refund(request)
+
+@app.get("/api/esunpay/reconcile/{order_id}")
+async def esunpay_reconcile_status(order_id: str):
+    result = await ReconciliationEngine.get_status(order_id, "esunpay")
+    if result is None:
+        raise HTTPException(status_code=404, detail="Order not found")
+    return result
+
 @app.post("/api/machine/{machine_id}/log/update")
 async def upload_log(machine_id: str, file: UploadFile = File(...)):
     return await LogAPI.upload_log(machine_id, file)
 
 @app.get("/api/machine/{machine_id}/log/download/{filename}")
-async def download_log(machine_id: str, filename: str):
-    return await LogAPI.download_log(machine_id, filename)
+async def download_log(machine_id: str, filename: str, request: Request, raw: bool = False):
+    return await LogAPI.download_log(machine_id, filename, request, raw)
 
 @app.get("/api/machine/{machine_id}/log/download")
-async def list_logs(machine_id: str):
-    return await LogAPI.list_logs(machine_id)
+async def list_logs(
+    machine_id: str,
+    sort: str = Query("name", pattern="^(name|mtime|size|lines)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(None, ge=1),
+    mtime_from: datetime.datetime = None,
+    mtime_to: datetime.datetime = None,
+):
+    return await LogAPI.list_logs(
+        machine_id, sort, order, offset, limit,
+        mtime_from.timestamp() if mtime_from else None,
+        mtime_to.timestamp() if mtime_to else None,
+    )
 
 @app.get("/api/machine/{machine_id}/log/show/{filename}", response_class=HTMLResponse)
-async def show_log(machine_id: str, filename: str):
-    return await LogAPI.show_log(machine_id, filename)
+async def show_log(
+    machine_id: str,
+    filename: str,
+    tail: int = Query(None, ge=1),
+    start: int = Query(None, ge=1),
+    end: int = Query(None, ge=1),
+):
+    return await LogAPI.show_log(machine_id, filename, tail, start, end)
+
+@app.get("/api/machine/{machine_id}/log/tail")
+async def tail_log(
+    machine_id: str,
+    request: Request,
+    filename: str = None,
+    offset: int = Query(None, ge=0),
+    lines: int = Query(None, ge=0, le=config.LOG_VIEW_MAX_LINES),
+):
+    """以 Server-Sent Events 即時追蹤機台 log；未指定 filename 時追蹤最新的檔案與之後上傳的檔案。"""
+    machine_id = safe_name(machine_id)
+    if filename is not None:
+        filename = safe_name(filename)
+    # 瀏覽器重連時從最後收到的位置繼續
+    last_file, last_end = LogTail.parse_event_id(request.headers.get("last-event-id"))
+    if last_file is not None and filename in (None, last_file):
+        filename, offset = safe_name(last_file), last_end
+    if not LogIndex.has_machine(machine_id) and not (BASE_DIR / machine_id).is_dir():
+        raise HTTPException(status_code=404, detail="Machine ID not found")
+    return StreamingResponse(
+        await LogTail.stream(BASE_DIR, machine_id, filename, offset, lines),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/machine/log/search")
+async def search_logs(
+    q: str = Query(..., min_length=1),
+    machine: str = None,
+    since: datetime.datetime = None,
+    until: datetime.datetime = None,
+    regex: bool = False,
+    ignore_case: bool = True,
+    context: int = Query(0, ge=0, le=10),
+    limit: int = Query(1000, ge=1, le=100000),
+):
+    if regex:
+        try:
+            LogSearch.check_pattern(q)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+    return StreamingResponse(
+        LogSearch.search(
+            BASE_DIR, q, machine,
+            since.timestamp() if since else None,
+            until.timestamp() if until else None,
+            regex, ignore_case, context, limit,
+        ),
+        media_type="application/x-ndjson",
+    )
+
+@app.get("/api/machine/{machine_id}/telemetry")
+async def machine_telemetry(
+    machine_id: str,
+    field: str = Query("temperature", pattern=TELEMETRY_FIELD_PATTERN),
+    since: datetime.datetime = Query(None, alias="from"),
+    until: datetime.datetime = Query(None, alias="to"),
+    bucket: str = None,
+):
+    return await asyncio.to_thread(
+        Telemetry.query, safe_name(machine_id), field,
+        since.timestamp() if since else None,
+        until.timestamp() if until else None,
+        parse_bucket(bucket) if bucket else None,
+    )
+
+@app.get("/api/machine/telemetry")
+async def fleet_telemetry(
+    field: str = Query("temperature", pattern=TELEMETRY_FIELD_PATTERN),
+    since: datetime.datetime = Query(None, alias="from"),
+    until: datetime.datetime = Query(None, alias="to"),
+    bucket: str = "1h",
+    machines: str = None,
+):
+    return await asyncio.to_thread(
+        Telemetry.fleet, field,
+        since.timestamp() if since else None,
+        until.timestamp() if until else None,
+        parse_bucket(bucket),
+        [safe_name(machine) for machine in machines.split(",") if machine] if machines else None,
+    )
 
 @app.get("/api/machine/{machine_id}/log/show", response_class=HTMLResponse)
 async def show_machine_logs(machine_id: str):
     return await LogAPI.show_machine_logs(machine_id)
 
 @app.get("/api/machine")
-async def list_machines():
-    return await LogAPI.list_machines()
+async def list_machines(
+    sort: str = Query("name", pattern="^(name|mtime|size|files)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(None, ge=1),
+    mtime_from: datetime.datetime = None,
+    mtime_to: datetime.datetime = None,
+):
+    return await LogAPI.list_machines(
+        sort, order, offset, limit,
+        mtime_from.timestamp() if mtime_from else None,
+        mtime_to.timestamp() if mtime_to else None,
+    )
+
+@app.delete("/api/admin/credentials", dependencies=[Depends(require_admin)])
+async def invalidate_credentials(key: str = None, machine: str = None):
+    removed = CredentialCache.invalidate(key, machine)
+    return {"status": "success", "invalidated": removed}
+
+@app.get("/api/admin/transactions", dependencies=[Depends(require_admin)])
+async def query_transactions(
+    machine: str = None,
+    status: str = None,
+    return_code: str = None,
+    payway: str = None,
+    since: datetime.datetime = None,
+    until: datetime.datetime = None,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str = None,
+):
+    filters = {"machine": machine, "status": status, "return_code": return_code, "payway": payway}
+    return await TransactionQuery.page(filters, since, until, limit, cursor)
+
+@app.get("/api/admin/transactions/export", dependencies=[Depends(require_admin)])
+async def export_transactions(
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    machine: str = None,
+    status: str = None,
+    return_code: str = None,
+    payway: str = None,
+    since: datetime.datetime = None,
+    until: datetime.datetime = None,
+):
+    filters = {"machine": machine, "status": status, "return_code": return_code, "payway": payway}
+    if format == "csv":
+        media_type = "text/csv; charset=utf-8"
+        headers = {"Content-Disposition": 'attachment; filename="linepay_transactions.csv"'}
+    else:
+        media_type, headers = "application/x-ndjson", None
+    return StreamingResponse(
+        TransactionQuery.export(filters, since, until, format), media_type=media_type, headers=headers
+    )
+
+@app.get("/api/admin/leader", dependencies=[Depends(require_admin)])
+async def leader_status():
+    return {"pid": os.getpid(), "is_leader": LeaderElection.is_leader, "leader_pid": LeaderElection.holder()}
+
+@app.get("/api/admin/upstreams", dependencies=[Depends(require_admin)])
+async def upstream_states():
+    return Resilience.states()
+
+@app.get("/api/admin/b010/stats", dependencies=[Depends(require_admin)])
+async def b010_stats():
+    return {"interval": B010Scheduler.INTERVAL, "last_cycle": B010Scheduler.last_cycle}
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    body = {"status": Lifecycle.state, "checks": Lifecycle.checks}
+    if Lifecycle.blockers:
+        body["blockers"] = Lifecycle.blockers
+    return JSONResponse(body, status_code=200 if Lifecycle.ready() else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
-@app.on_event("startup")
-async def startup_event():
-    asyncio.create_task(schedule_log_upload())
\ No newline at end of file
+# 背景工作只在 leader worker 執行，依註冊順序啟動
+# log 索引重建可能需要掃描大量檔案，在背景進行，完成前使用啟動時從 SQLite 載入的索引
+LeaderElection.register_loop("log_index", lambda: LogIndex.rebuild_in_background(BASE_DIR))
+LeaderElection.register("reconciliation", ReconciliationEngine.start, ReconciliationEngine.stop)
+LeaderElection.register_loop("b010_push", schedule_log_upload)
+LeaderElection.register_loop("log_retention", schedule_log_retention)
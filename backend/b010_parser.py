@@ -0,0 +1,111 @@
+import os
+import threading
+from pathlib import Path
+
+B010_FIELDS = ("machine", "cabinetT", "door", "temperature", "M_Stus", "M_Stus2", "M_Ver")
+BLOCK_SIZE = 64 * 1024
+RECENT_BYTES = 64  # 記住已處理位置之前的一小段內容，用來判斷被取代的檔案是否只是變長
+
+
+def _parse_line(line: bytes, wanted, values: dict, overwrite: bool):
+    # 與 parse_log_for_b010 相同：key:value，以第一個冒號切開並去除前後空白
+    if b":" not in line:
+        return
+    key, value = line.decode("utf-8", errors="replace").split(":", 1)
+    key = key.strip()
+    if key in wanted and (overwrite or key not in values):
+        values[key] = value.strip()
+
+
+def parse_backward(f, end: int, wanted=B010_FIELDS, block_size: int = BLOCK_SIZE) -> dict:
+    """從 end 往前分段讀取，取得每個欄位最後一次出現的值；全部找到就停止。"""
+    values = {}
+    position = end
+    pending = b""
+    while position > 0 and len(values) < len(wanted):
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        data = f.read(read_size) + pending
+        lines = data.split(b"\n")
+        # 第一段可能不完整，留到下一次一起處理
+        pending = lines[0] if position > 0 else b""
+        start = 1 if position > 0 else 0
+        for line in reversed(lines[start:]):
+            _parse_line(line, wanted, values, overwrite=False)
+            if len(values) == len(wanted):
+                break
+    if pending and len(values) < len(wanted):
+        _parse_line(pending, wanted, values, overwrite=False)
+    return values
+
+
+def _last_newline_end(f, size: int, block_size: int = BLOCK_SIZE) -> int:
+    """回傳最後一個換行之後的位置，檔案沒有換行時回傳 0。"""
+    position = size
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        index = f.read(read_size).rfind(b"\n")
+        if index >= 0:
+            return position + index + 1
+    return 0
+
+
+class B010StatusParser:
+    """讀取 log 中 B010 需要的欄位。
+
+    第一次讀取某個檔案時從檔尾往前找；之後記住已處理到的位置，
+    檔案只是被附加內容時只解析新增的部分。檔案變小或已處理位置之前的內容不同時重新從檔尾解析。
+    上傳以 os.replace 覆蓋檔案，inode 每次都會變，因此以路徑加上內容比對判斷（與 log_tail 相同）。
+    """
+
+    def __init__(self, wanted=B010_FIELDS):
+        self.wanted = tuple(wanted)
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def parse(self, path: Path) -> dict:
+        path = Path(path)
+        size = os.stat(path).st_size
+        with self._lock:
+            state = self._state.get(path)
+
+        with path.open("rb") as f:
+            if state is not None:
+                offset, recent = state[0], state[1]
+                f.seek(offset - len(recent))
+                # 檔案變小，或已處理位置之前的內容不同（被換成另一個檔案）
+                if offset > size or f.read(len(recent)) != recent:
+                    state = None
+            if state is not None:
+                offset, committed = state[0], dict(state[2])
+                lines = f.read(size - offset).split(b"\n")
+                partial = lines.pop()
+                for line in lines:
+                    _parse_line(line, self.wanted, committed, overwrite=True)
+                    offset += len(line) + 1
+            else:
+                offset = _last_newline_end(f, size)
+                committed = parse_backward(f, offset, self.wanted)
+                f.seek(offset)
+                partial = f.read(size - offset)
+            start = max(0, offset - RECENT_BYTES)
+            f.seek(start)
+            recent = f.read(offset - start)
+
+        with self._lock:
+            # 每個機台目錄只保留最新檔案的狀態
+            for other in [p for p in self._state if p.parent == path.parent and p != path]:
+                del self._state[other]
+            self._state[path] = (offset, recent, committed)
+
+        # 最後一行尚未換行時也納入結果，但不記入已處理位置
+        values = dict(committed)
+        _parse_line(partial, self.wanted, values, overwrite=True)
+        return values
+
+    def forget(self, path: Path):
+        with self._lock:
+            self._state.pop(Path(path), None)
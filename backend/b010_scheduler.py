@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+import httpx
+from log_index import LogIndex
+from logdownload import LogAPI, BASE_DIR
+from resilience import UpstreamUnavailable
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class B010Scheduler:
+    """定期把各機台最新 log 的狀態推送到 B010。
+
+    - 以 CONCURRENCY 限制同時進行的推送數量，單一機台變慢不會拖住整輪
+    - 最新 log 的檔名、大小、修改時間未變就跳過；檔案有變但內容相同也不重送
+    - 推送失敗以指數退避重試 RETRIES 次
+    """
+
+    INTERVAL = config.B010_PUSH_INTERVAL
+    CONCURRENCY = config.B010_PUSH_CONCURRENCY
+    RETRIES = config.B010_PUSH_RETRIES
+    BACKOFF = config.B010_PUSH_BACKOFF
+
+    _signatures = {}
+    _payload_hashes = {}
+    last_cycle = None
+
+    @classmethod
+    async def _push_machine(cls, machine_id: str) -> str:
+        latest = LogIndex.latest(machine_id)
+        if latest is None:
+            return "skipped"
+        filename, meta = latest
+        signature = (filename, meta.size, meta.mtime)
+        if cls._signatures.get(machine_id) == signature:
+            return "skipped"
+
+        payload = await LogAPI.build_b010_payload(machine_id)
+        if payload is None:
+            return "skipped"
+        payload_hash = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        if cls._payload_hashes.get(machine_id) == payload_hash:
+            cls._signatures[machine_id] = signature
+            return "skipped"
+
+        for attempt in range(cls.RETRIES + 1):
+            try:
+                await LogAPI.post_b010(payload)
+                break
+            except UpstreamUnavailable:
+                return "failed"  # 斷路中，重試也沒有意義
+            except httpx.HTTPError as exc:
+                if attempt == cls.RETRIES:
+                    logger.warning("failed to upload log for %s: %s", machine_id, exc)
+                    return "failed"
+                await asyncio.sleep(cls.BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.0))
+
+        cls._signatures[machine_id] = signature
+        cls._payload_hashes[machine_id] = payload_hash
+        return "pushed"
+
+    @classmethod
+    async def run_cycle(cls) -> dict:
+        started = time.monotonic()
+        await LogIndex.ensure_loaded(BASE_DIR)
+        machines = (await LogAPI.list_machines())["machines"]
+        semaphore = asyncio.Semaphore(cls.CONCURRENCY)
+
+        async def push(machine_id):
+            async with semaphore:
+                try:
+                    return await cls._push_machine(machine_id)
+                except Exception as exc:
+                    logger.exception("failed to upload log for %s: %s", machine_id, exc)
+                    return "failed"
+
+        results = await asyncio.gather(*(push(machine_id) for machine_id in machines))
+        for machine_id in set(cls._signatures) - set(machines):
+            cls._signatures.pop(machine_id, None)
+            cls._payload_hashes.pop(machine_id, None)
+        stats = {
+            "started_at": time.time() - (time.monotonic() - started),
+            "duration": round(time.monotonic() - started, 3),
+            "machines": len(machines),
+            "pushed": results.count("pushed"),
+            "skipped": results.count("skipped"),
+            "failed": results.count("failed"),
+        }
+        cls.last_cycle = stats
+        logger.info("B010 push cycle finished", extra=stats)
+        metrics.B010_MACHINES.set(stats["pushed"], result="pushed")
+        metrics.B010_MACHINES.set(stats["skipped"], result="skipped")
+        metrics.B010_MACHINES.set(stats["failed"], result="failed")
+        return stats
+
+
+async def schedule_log_upload():
+    while True:
+        try:
+            with metrics.BACKGROUND_TASK_DURATION.time(task="b010_push"):
+                await B010Scheduler.run_cycle()
+        except Exception as e:
+            metrics.BACKGROUND_TASK_FAILURES.inc(task="b010_push")
+            logger.exception("B010 push cycle failed: %s", e)
+        await asyncio.sleep(B010Scheduler.INTERVAL)
@@ -0,0 +1,96 @@
+"""B010 欄位解析效能比較：原本整檔讀取 vs 從檔尾往前讀取 vs 只解析新增內容。
+
+執行方式（於 backend 目錄）：
+    python -m bench.b010_parser
+    python -m bench.b010_parser --sizes 1 10
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+from b010_parser import B010_FIELDS, B010StatusParser
+from logdownload import LogAPI
+
+NOISE = [
+    "2025-01-01 12:00:00 INFO 出貨完成 slot=12",
+    "2025-01-01 12:00:01 DEBUG sensor poll ok",
+    "2025-01-01 12:00:02 WARN retry payment scan",
+    "heartbeat ok",
+]
+
+
+def status_block(i: int) -> str:
+    return "\n".join([
+        "machine:M0000123",
+        f"cabinetT:{i % 40}",
+        f"door:{i % 2}",
+        f"temperature:{(i % 120) / 10}",
+        f"M_Stus:{i % 5}",
+        f"M_Stus2:{i % 3}",
+        "M_Ver:1.2.3",
+    ]) + "\n"
+
+
+def generate(path: Path, size_mb: int):
+    rng = random.Random(size_mb)
+    target = size_mb * 1024 * 1024
+    written = 0
+    i = 0
+    with path.open("w", encoding="utf-8") as f:
+        while written < target:
+            chunk = "".join(rng.choice(NOISE) + "\n" for _ in range(200)) + status_block(i)
+            f.write(chunk)
+            written += len(chunk.encode("utf-8"))
+            i += 1
+
+
+def original(path: Path) -> dict:
+    payload = asyncio.run(LogAPI.parse_log_for_b010(path.read_text(encoding="utf-8")))
+    return {key: payload[key] for key in B010_FIELDS}
+
+
+def timed(func, repeat: int):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100], help="log 大小（MB）")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"{'size':>6} {'original':>12} {'tail':>12} {'append':>12} {'speedup':>9}")
+        for size_mb in args.sizes:
+            path = Path(tmp) / f"M0000123_{size_mb}MB.log"
+            generate(path, size_mb)
+
+            t_original, expected = timed(lambda: original(path), args.repeat)
+            t_tail, tail_result = timed(lambda: B010StatusParser().parse(path), args.repeat)
+
+            incremental = B010StatusParser()
+            incremental.parse(path)
+            with path.open("a", encoding="utf-8") as f:
+                f.write(status_block(999999))
+            expected_after = original(path)
+            t_append, append_result = timed(lambda: incremental.parse(path), 1)
+
+            expected = {key: value for key, value in expected.items() if value != ""}
+            assert tail_result == expected, (tail_result, expected)
+            assert append_result == {k: v for k, v in expected_after.items() if v != ""}
+            print(
+                f"{size_mb:>4}MB {t_original * 1000:>10.2f}ms {t_tail * 1000:>10.3f}ms "
+                f"{t_append * 1000:>10.3f}ms {t_original / t_tail:>8.0f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""玉山 xTrade 編碼與解碼效能比較：原本的 json.dumps + 兩次 quote / 兩次 unquote + json.loads vs EsunCodec。
+
+同時確認兩者編碼結果逐字相同、解碼結果一致。
+
+執行方式（於 backend 目錄）：
+    python -m bench.esun_codec
+    python -m bench.esun_codec --count 200000 --terminals 1000
+"""
+import argparse
+import hashlib
+import json
+import time
+import urllib.parse
+from esun_codec import EsunCodec
+
+
+def original_encode(store_id, term_id, hash_key, order_no, barcode, amount, order_dt):
+    transaction_data = {
+        "StoreID": store_id,
+        "TermID": term_id,
+        "Timeout": 20,
+        "BuyerID": barcode,
+        "OrderNo": order_no,
+        "OrderCurrency": "TWD",
+        "OrderAmount": amount,
+        "OrderDT": order_dt,
+        "OrderTitle": order_no,
+        "BuyerPaymentType": 1
+    }
+    transaction_data_encoded = urllib.parse.quote(json.dumps(transaction_data, separators=(',', ':')), safe='')
+    hash_source = "tradeapi" + "payment" + transaction_data_encoded + hash_key
+    hash_digest = hashlib.sha256(hash_source.encode("utf-8")).hexdigest().upper()
+    final_payload = {
+        "Type": "tradeapi",
+        "Action": "payment",
+        "TransactionData": transaction_data_encoded,
+        "HashDigest": hash_digest
+    }
+    return f"json={urllib.parse.quote(json.dumps(final_payload, separators=(',', ':')), safe='')}"
+
+
+def original_decode(text):
+    parsed = json.loads(urllib.parse.unquote(text))
+    if "TransactionData" in parsed:
+        parsed["TransactionData"] = json.loads(urllib.parse.unquote(parsed["TransactionData"]))
+    return parsed
+
+
+def response_text(order_no: str, amount: int) -> str:
+    result = {"ReturnCode": "00", "ReturnMessage": "交易成功", "OrderNo": order_no, "TradeAmount": amount}
+    response = {
+        "Type": "tradeapi",
+        "Action": "payment",
+        "TransactionData": urllib.parse.quote(json.dumps(result, separators=(",", ":")), safe=""),
+        "HashDigest": "",
+    }
+    return urllib.parse.quote(json.dumps(response, separators=(",", ":")), safe="")
+
+
+def orders(count: int, terminals: int):
+    return [
+        ("STORE001", f"T{i % terminals:05d}", "mock-hash-key", f"20260101120000{i:06d}ab{i % terminals:05d}",
+         f"{(i * 7919) % 10 ** 18:018d}", 10 + i % 500, "20260101120000")
+        for i in range(count)
+    ]
+
+
+def rate(func, items, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item in items:
+            func(*item)
+        best = min(best, time.perf_counter() - start)
+    return len(items) / best
+
+
+def codec_encode(store_id, term_id, hash_key, order_no, barcode, amount, order_dt):
+    return EsunCodec.terminal(store_id, term_id, hash_key).payment(order_no, barcode, amount, order_dt).content
+
+
+def codec_decode(text):
+    return EsunCodec.decode(text, "payment").data()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=50000, help="每輪的請求數")
+    parser.add_argument("--terminals", type=int, default=200, help="不同機台數（簽章前綴快取的命中情形）")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    items = orders(args.count, args.terminals)
+    for item in items[:1000]:
+        assert codec_encode(*item) == original_encode(*item), item
+    responses = [(response_text(item[3], item[5]),) for item in items]
+    for (text,) in responses[:1000]:
+        assert codec_decode(text) == original_decode(text), text
+
+    print(f"{'':>8} {'original':>14} {'EsunCodec':>14} {'speedup':>8}")
+    for name, old, new, data in (
+        ("encode", original_encode, codec_encode, items),
+        ("decode", original_decode, codec_decode, responses),
+    ):
+        old_rate, new_rate = rate(old, data, args.repeat), rate(new, data, args.repeat)
+        print(f"{name:>8} {old_rate:>12,.0f}/s {new_rate:>12,.0f}/s {new_rate / old_rate:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
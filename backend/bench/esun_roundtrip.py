@@ -0,0 +1,113 @@
+"""玉山 xTrade 來回檢查：以本機模擬上游實際走過付款、查詢、退款與逾時對帳。
+
+只驗證本服務與模擬上游之間的編碼、簽章與流程，不代表玉山實際 API 的 Action 名稱或回傳代碼：
+查詢 / 退款的 Action 與查詢結果代碼在下方明確設定為模擬上游使用的值。
+模擬的玉山會用 mock hash key 驗證 HashDigest，並記住收到的訂單，
+逾時的付款應回 pending，之後由背景對帳以查詢取得最終結果，重送時改回最終結果。
+
+執行方式（於 backend 目錄）：
+    python -m bench.esun_roundtrip
+"""
+import asyncio
+import os
+import tempfile
+import time
+import httpx
+from bench.mock_upstreams import MockSettings, MockUpstreams
+
+
+def check(condition: bool, message: str, detail=None):
+    print(f"{'ok  ' if condition else 'FAIL'} {message}")
+    if not condition:
+        raise SystemExit(f"{message}: {detail}")
+
+
+async def run(settings: MockSettings):
+    # config 於 import 時讀取環境變數，需在設定之後才載入 app
+    import app as service
+
+    machine, key = "M0000123", "bench-key"
+    transport = httpx.ASGITransport(app=service.app)
+    async with service.app.router.lifespan_context(service.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://service", timeout=30) as client:
+
+        async def post(path: str, body: dict) -> dict:
+            response = await client.post(path, json=body)
+            check(response.status_code == 200, f"POST {path} -> 200", response.text)
+            return response.json()
+
+        paid = await post("/api/esunpay/pay", {"key": key, "machine": machine, "barcode": "281234567890", "amount": 120})
+        result = paid["data"]["TransactionData"]
+        check(result["ReturnCode"] == "00" and result["TradeAmount"] == 120, "payment approved", paid)
+        order_no = result["OrderNo"]
+
+        inquired = await post("/api/esunpay/inquire", {"key": key, "machine": machine, "orderNo": order_no})
+        check(inquired["data"]["TransactionData"]["ReturnCode"] == "00", "inquiry finds the order", inquired)
+
+        refund = {"key": key, "machine": machine, "orderNo": order_no, "refundAmount": 100}
+        refunded = await post("/api/esunpay/refund", refund)
+        check(refunded["data"]["TransactionData"]["ReturnCode"] == "00", "partial refund accepted", refunded)
+        refunded = await post("/api/esunpay/refund", refund)
+        check(refunded["data"]["TransactionData"]["ReturnCode"] == "RA", "over-refund rejected", refunded)
+
+        unknown = await post("/api/esunpay/inquire", {"key": key, "machine": machine, "orderNo": "no-such-order"})
+        check(unknown["data"]["TransactionData"]["ReturnCode"] == "NF", "unknown order reported", unknown)
+
+        # 付款逾時：立即回 pending，恢復後由背景對帳查到結果
+        settings.faults["esun"].timeout_rate = 1.0
+        pending = await post("/api/esunpay/pay", {"key": key, "machine": machine, "barcode": "289999999999", "amount": 50})
+        settings.faults["esun"].timeout_rate = 0.0
+        check(pending.get("status") == "pending", "timed-out payment is pending", pending)
+
+        deadline = time.monotonic() + 30
+        status = None
+        while time.monotonic() < deadline:
+            response = await client.get(f"/api/esunpay/reconcile/{pending['orderId']}")
+            status = response.json()
+            if status.get("status") != "pending":
+                break
+            await asyncio.sleep(0.2)
+        check(status.get("status") == "success" and status.get("return_code") == "00",
+              "timed-out payment reconciled", status)
+
+        # 對帳後同一筆付款重送：回最終結果而不是第一次的 pending
+        resent = await post("/api/esunpay/pay", {"key": key, "machine": machine, "barcode": "289999999999", "amount": 50})
+        check(resent.get("status") == "success" and resent["data"]["TransactionData"]["ReturnCode"] == "00",
+              "resend after reconciliation returns the final result", resent)
+
+
+async def main():
+    settings = MockSettings()
+    for fault in settings.faults.values():
+        fault.latency_ms = 0
+    settings.faults["esun"].timeout_sleep = 5.0
+    mocks = MockUpstreams(settings)
+    await mocks.start()
+    workdir = tempfile.mkdtemp(prefix="linepay-esun-")
+    os.environ.update(mocks.environment())
+    os.environ.update({
+        "DATA_DIR": f"{workdir}/data",
+        "LOG_DIR": f"{workdir}/logs",
+        "ESUN_TIMEOUT": "1",
+        "RECONCILE_BASE_DELAY": "0.2",
+        "DB_MIGRATE_ON_STARTUP": "0",
+        "DB_POOL_MINSIZE": "0",  # 不連 MySQL，玉山交易也不寫入資料庫
+        "WARMUP_UPSTREAMS": "",
+        "APP_LOG_LEVEL": "WARNING",
+        # 模擬上游的 Action 與代碼（NF = 查無訂單）；正式環境需依玉山規格設定
+        "ESUN_INQUIRY_ACTION": "inquiry",
+        "ESUN_REFUND_ACTION": "refund",
+        "ESUN_INQUIRY_SUCCESS_CODES": "00",
+        "ESUN_INQUIRY_FAILED_CODES": "NF",
+    })
+    for key in list(os.environ):
+        if key.endswith("_DB_PATH") or key in ("TRANSACTION_SPOOL_PATH",):
+            del os.environ[key]
+    try:
+        await run(settings)
+    finally:
+        await mocks.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,330 @@
+"""API 壓力測試：啟動本機模擬上游，對 FastAPI 服務施壓並統計各端點延遲。
+
+執行方式（於 backend 目錄）：
+    python -m bench.loadtest --concurrency 10 50 100 --duration 15
+    python -m bench.loadtest --latency linepay=200 --error-rate linepay=0.02 --timeout-rate unibuy=0.01
+    python -m bench.loadtest --compare bench/results/20250101-120000-abc1234.json
+
+結果存成 JSON（預設於 bench/results/），可用 --compare 與先前的版本比較。
+資料庫預設以記憶體 sink 取代（--db-sink memory，可用 --db-latency-ms 模擬寫入延遲）；
+指定 --db-sink mysql 時改用 MYSQL_HOST 等環境變數設定的資料庫（例如本機 docker MySQL）。
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import httpx
+from bench.mock_upstreams import Fault, MockSettings, MockUpstreams
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+# ---- 工作負載 ----
+def _machine() -> str:
+    return f"M{random.randint(0, 999):07d}"
+
+
+def _barcode() -> str:
+    return "".join(random.choice("0123456789") for _ in range(18))
+
+
+def linepay_pay(client):
+    return client.post("/api/linepay/pay", json={
+        "key": "bench", "machine": _machine(), "barcode": _barcode(),
+        "amount": random.randint(10, 500), "payway": "L", "test": 0,
+    })
+
+
+def linepay_refund(client):
+    return client.post("/api/linepay/refund", json={
+        "key": "bench", "machine": _machine(), "orderId": f"BENCH{random.randint(0, 10 ** 9)}",
+        "refundAmount": 10, "test": 0,
+    })
+
+
+def linepay_inquire(client):
+    return client.get("/api/linepay/inquire", params={
+        "channel_id": "1234567890", "channel_secret": "mock-secret",
+        "order_id": f"BENCH{random.randint(0, 10 ** 9)}",
+    })
+
+
+def esunpay_pay(client):
+    return client.post("/api/esunpay/pay", json={
+        "key": "bench", "machine": _machine(), "barcode": _barcode(), "amount": random.randint(10, 500),
+    })
+
+
+LOG_BODY = ("".join(f"2025-01-01 12:00:{i % 60:02d} INFO bench line {i}\n" for i in range(500)) + (
+    "machine:M0000001\ncabinetT:5\ndoor:0\ntemperature:4.5\nM_Stus:1\nM_Stus2:0\nM_Ver:1.0\n"
+)).encode("utf-8")
+
+
+def log_upload(client):
+    machine = _machine()
+    return client.post(
+        f"/api/machine/{machine}/log/update",
+        files={"file": (f"{datetime.date.today():%Y%m%d}.log", LOG_BODY)},
+    )
+
+
+def list_machines(client):
+    return client.get("/api/machine", params={"limit": 50})
+
+
+SCENARIOS = {
+    "linepay_pay": linepay_pay,
+    "linepay_refund": linepay_refund,
+    "linepay_inquire": linepay_inquire,
+    "esunpay_pay": esunpay_pay,
+    "log_upload": log_upload,
+    "list_machines": list_machines,
+}
+DEFAULT_MIX = "linepay_pay=5,esunpay_pay=3,linepay_refund=1,linepay_inquire=1,log_upload=1,list_machines=1"
+
+
+# ---- 統計 ----
+def percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed: float) -> dict:
+    report = {}
+    for name in sorted({name for name, _, _ in samples}):
+        latencies = sorted(latency for sample, latency, _ in samples if sample == name)
+        errors = sum(1 for sample, _, ok in samples if sample == name and not ok)
+        report[name] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        }
+    return report
+
+
+# ---- 執行 ----
+class BackgroundLoop:
+    """在獨立 thread 執行 event loop（模擬上游、被測服務各自一個）。"""
+
+    def __init__(self, name: str):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_service(port: int, db_sink: str, db_latency_ms: float):
+    """於目前的環境變數下載入 app 並以 uvicorn 啟動；需在設定環境變數之後才 import。"""
+    if db_sink == "memory":
+        os.environ["DB_MIGRATE_ON_STARTUP"] = "0"
+        os.environ["DB_POOL_MINSIZE"] = "0"  # 不連 MySQL，暖機時不建立連線
+    import uvicorn
+    import app as service
+    from transaction_recorder import TransactionRecorder
+    from idempotency import IdempotencyStore
+
+    if db_sink == "memory":
+        stored = []
+
+        async def insert(rows):
+            if db_latency_ms:
+                await asyncio.sleep(db_latency_ms / 1000)
+            stored.extend(rows)
+
+        async def lookup(key):
+            return None
+
+        TransactionRecorder._insert = staticmethod(insert)
+        IdempotencyStore._load = staticmethod(lookup)
+
+    server = uvicorn.Server(uvicorn.Config(service.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, name="service", daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if time.monotonic() > deadline:
+            raise RuntimeError("service did not start")
+        time.sleep(0.05)
+    return server, thread
+
+
+async def run_level(base_url: str, concurrency: int, duration: float, mix, timeout: float):
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    samples = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        deadline = time.monotonic() + duration
+
+        async def worker():
+            while time.monotonic() < deadline:
+                name = random.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    response = await SCENARIOS[name](client)
+                    ok = response.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                samples.append((name, time.perf_counter() - start, ok))
+
+        started = time.monotonic()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.monotonic() - started
+    return summarize(samples, elapsed), len(samples) / elapsed
+
+
+def _parse_pairs(values, cast=float) -> dict:
+    result = {}
+    for item in values or []:
+        for pair in item.split(","):
+            key, _, value = pair.partition("=")
+            result[key.strip()] = cast(value)
+    return result
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(results: dict, baseline: dict = None):
+    for level in results["levels"]:
+        print(f"\nconcurrency={level['concurrency']}  total={level['rps']:.1f} req/s")
+        previous = None
+        if baseline:
+            previous = next(
+                (item for item in baseline["levels"] if item["concurrency"] == level["concurrency"]), None
+            )
+        print(f"  {'endpoint':<16}{'reqs':>8}{'err':>6}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for name, stats in level["endpoints"].items():
+            line = (
+                f"  {name:<16}{stats['requests']:>8}{stats['errors']:>6}{stats['rps']:>9.1f}"
+                f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+            )
+            old = previous and previous["endpoints"].get(name)
+            if old:
+                deltas = [
+                    f"{key[:3]} {((stats[key] - old[key]) / old[key] * 100) if old[key] else 0:+.0f}%"
+                    for key in ("rps", "p50_ms", "p95_ms", "p99_ms")
+                ]
+                line += "   vs baseline: " + ", ".join(deltas)
+            print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--duration", type=float, default=10.0, help="每個並行數的測試秒數")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="端點權重，例如 linepay_pay=5,esunpay_pay=1")
+    parser.add_argument("--latency", nargs="*", help="上游延遲 ms，例如 linepay=120 unibuy=30")
+    parser.add_argument("--jitter", nargs="*", help="上游延遲抖動 ms")
+    parser.add_argument("--error-rate", nargs="*", help="上游 503 比例，例如 esun=0.05")
+    parser.add_argument("--timeout-rate", nargs="*", help="上游不回應比例，例如 linepay=0.01")
+    parser.add_argument("--upstream-timeout", type=float, default=5.0, help="服務呼叫上游的 timeout 秒數")
+    parser.add_argument("--client-timeout", type=float, default=60.0)
+    parser.add_argument("--db-sink", choices=["memory", "mysql"], default="memory")
+    parser.add_argument("--db-latency-ms", type=float, default=2.0)
+    parser.add_argument("--output", type=Path, help="結果 JSON 路徑（預設 bench/results/<時間>-<commit>.json）")
+    parser.add_argument("--compare", type=Path, help="與先前的結果 JSON 比較")
+    args = parser.parse_args()
+
+    mix = [(name, float(weight)) for name, weight in _parse_pairs([args.mix]).items()]
+    unknown = [name for name, _ in mix if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)} (available: {', '.join(SCENARIOS)})")
+
+    settings = MockSettings()
+    for option, attribute in (
+        (args.latency, "latency_ms"), (args.jitter, "jitter_ms"),
+        (args.error_rate, "error_rate"), (args.timeout_rate, "timeout_rate"),
+    ):
+        for upstream, value in _parse_pairs(option).items():
+            setattr(settings.faults.setdefault(upstream, Fault()), attribute, value)
+
+    revision = _git_revision()
+    output = (args.output or RESULTS_DIR / f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{revision}.json").resolve()
+    baseline = json.loads(args.compare.read_text(encoding="utf-8")) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix="linepay-bench-")
+    mocks_loop = BackgroundLoop("mock-upstreams")
+    mocks = MockUpstreams(settings)
+    mocks_loop.run(mocks.start())
+    os.environ.update(mocks.environment())
+    os.environ.update({
+        "DATA_DIR": f"{workdir}/data",
+        "LOG_DIR": f"{workdir}/logs",
+        "UNIBUY_TIMEOUT": str(args.upstream_timeout),
+        "LINE_PAY_TIMEOUT": str(args.upstream_timeout),
+        "ESUN_TIMEOUT": str(args.upstream_timeout),
+    })
+    for key in list(os.environ):
+        if key.endswith("_DB_PATH") or key in ("TRANSACTION_SPOOL_PATH",):
+            del os.environ[key]
+    os.chdir(workdir)
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+    port = _free_port()
+    server, thread = start_service(port, args.db_sink, args.db_latency_ms)
+    base_url = f"http://127.0.0.1:{port}"
+
+    results = {
+        "revision": revision,
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "args": {key: str(value) for key, value in vars(args).items()},
+        "levels": [],
+    }
+    try:
+        if args.warmup:
+            asyncio.run(run_level(base_url, min(args.concurrency), args.warmup, mix, args.client_timeout))
+        for concurrency in args.concurrency:
+            endpoints, rps = asyncio.run(
+                run_level(base_url, concurrency, args.duration, mix, args.client_timeout)
+            )
+            results["levels"].append({"concurrency": concurrency, "rps": round(rps, 2), "endpoints": endpoints})
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+        mocks_loop.run(mocks.stop())
+        mocks_loop.stop()
+
+    results["upstream_calls"] = settings.calls
+    print_report(results, baseline)
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\nupstream calls: {settings.calls}")
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
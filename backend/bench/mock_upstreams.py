@@ -0,0 +1,191 @@
+"""壓力測試用的本機上游模擬服務：B014 / B010、LINE Pay、玉山 xTrade（付款、查詢、退款，並驗證 HashDigest）。
+
+每個上游可設定延遲、錯誤率與逾時率（逾時以長時間不回應模擬）。
+"""
+import asyncio
+import hashlib
+import json
+import random
+import urllib.parse
+from dataclasses import dataclass, field
+from aiohttp import web
+
+ESUN_HASH_KEY = "mock-hash-key"
+# 不 import 服務的模組：config 在 import 時讀取環境變數，需等模擬服務啟動、設定網址之後才能載入
+
+
+@dataclass
+class Fault:
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    timeout_rate: float = 0.0
+    timeout_sleep: float = 60.0
+
+
+@dataclass
+class MockSettings:
+    faults: dict = field(default_factory=lambda: {
+        "unibuy": Fault(latency_ms=20),
+        "linepay": Fault(latency_ms=80),
+        "esun": Fault(latency_ms=80),
+    })
+    calls: dict = field(default_factory=dict)
+    esun_orders: dict = field(default_factory=dict)
+
+
+async def _inject(settings: MockSettings, upstream: str, route: str):
+    """依設定等待、丟出錯誤或模擬逾時；回傳 None 表示正常處理。"""
+    settings.calls[route] = settings.calls.get(route, 0) + 1
+    fault = settings.faults[upstream]
+    delay = fault.latency_ms + random.uniform(0, fault.jitter_ms)
+    roll = random.random()
+    if roll < fault.timeout_rate:
+        await asyncio.sleep(fault.timeout_sleep)
+    elif delay:
+        await asyncio.sleep(delay / 1000)
+    if roll >= 1 - fault.error_rate:
+        return web.Response(status=503, text="injected error")
+    return None
+
+
+def unibuy_app(settings: MockSettings) -> web.Application:
+    async def b014(request):
+        if (error := await _inject(settings, "unibuy", "B014")) is not None:
+            return error
+        body = await request.json()
+        return web.json_response({"data": [{
+            "LINE_ChannelId": "1234567890",
+            "LINE_ChannelSecret": "mock-secret",
+            "t050v41": "STORE001",
+            "t050v42": f"T{body.get('machine', '')}",
+            "t050v43": ESUN_HASH_KEY,
+        }]})
+
+    async def b010(request):
+        if (error := await _inject(settings, "unibuy", "B010")) is not None:
+            return error
+        await request.read()
+        return web.json_response({"status": "ok"})
+
+    app = web.Application()
+    app.router.add_post("/Unibuy/api/app/machine/setting/B014", b014)
+    app.router.add_post("/Unibuy/api/app/machine/status/B010", b010)
+    return app
+
+
+def linepay_app(settings: MockSettings) -> web.Application:
+    async def pay(request):
+        if (error := await _inject(settings, "linepay", "oneTimeKeys/pay")) is not None:
+            return error
+        body = await request.json()
+        return web.json_response({
+            "returnCode": "0000",
+            "returnMessage": "OK",
+            "info": {
+                "transactionId": random.randint(10 ** 17, 10 ** 18),
+                "orderId": body["orderId"],
+                "payInfo": [{"method": "BALANCE", "amount": body["amount"]}],
+            },
+        })
+
+    async def check(request):
+        if (error := await _inject(settings, "linepay", "orders/check")) is not None:
+            return error
+        return web.json_response({"returnCode": "0123", "returnMessage": "Payment completed"})
+
+    async def refund(request):
+        if (error := await _inject(settings, "linepay", "orders/refund")) is not None:
+            return error
+        return web.json_response({
+            "returnCode": "0000",
+            "returnMessage": "OK",
+            "info": {"refundTransactionId": random.randint(10 ** 17, 10 ** 18)},
+        })
+
+    app = web.Application()
+    app.router.add_post("/v2/payments/oneTimeKeys/pay", pay)
+    app.router.add_get("/v2/payments/orders/{order_id}/check", check)
+    app.router.add_post("/v2/payments/orders/{order_id}/refund", refund)
+    return app
+
+
+def esun_app(settings: MockSettings) -> web.Application:
+    def reply(outer: dict, result: dict) -> web.Response:
+        response = {
+            "Type": outer["Type"],
+            "Action": outer["Action"],
+            "TransactionData": urllib.parse.quote(json.dumps(result, separators=(",", ":")), safe=""),
+            "HashDigest": "",
+        }
+        return web.Response(text=urllib.parse.quote(json.dumps(response, separators=(",", ":")), safe=""))
+
+    async def xtrade(request):
+        form = urllib.parse.unquote((await request.text()).removeprefix("json="))
+        outer = json.loads(form)
+        transaction = json.loads(urllib.parse.unquote(outer["TransactionData"]))
+        action, order_no = outer["Action"], transaction.get("OrderNo")
+        source = f"{outer['Type']}{action}{outer['TransactionData']}{ESUN_HASH_KEY}"
+        if hashlib.sha256(source.encode("utf-8")).hexdigest().upper() != outer["HashDigest"]:
+            return reply(outer, {"ReturnCode": "HE", "ReturnMessage": "HashDigest 錯誤", "OrderNo": order_no})
+        if action == "payment":
+            # 收到即成立，之後才模擬延遲或逾時：逾時的訂單可以查詢到
+            settings.esun_orders[order_no] = {"amount": transaction.get("OrderAmount"), "refunded": 0}
+        if (error := await _inject(settings, "esun", f"xTrade:{action}")) is not None:
+            return error
+
+        order = settings.esun_orders.get(order_no)
+        if action == "payment":
+            result = {"ReturnCode": "00", "ReturnMessage": "交易成功", "TradeAmount": order["amount"]}
+        elif order is None:
+            result = {"ReturnCode": "NF", "ReturnMessage": "查無訂單"}
+        elif action == "refund":
+            amount = transaction.get("RefundAmount")
+            if order["refunded"] + amount > order["amount"]:
+                result = {"ReturnCode": "RA", "ReturnMessage": "退款金額超過交易金額"}
+            else:
+                order["refunded"] += amount
+                result = {"ReturnCode": "00", "ReturnMessage": "退款成功", "RefundAmount": amount}
+        else:
+            result = {"ReturnCode": "00", "ReturnMessage": "交易成功", "TradeAmount": order["amount"],
+                      "RefundAmount": order["refunded"]}
+        return reply(outer, {**result, "OrderNo": order_no})
+
+    app = web.Application()
+    app.router.add_post("/mPay/GatewayV2/API/V2/xTrade.ashx", xtrade)
+    return app
+
+
+class MockUpstreams:
+    """在同一個 event loop 內啟動所有模擬服務，port 由系統分配。"""
+
+    def __init__(self, settings: MockSettings = None, host: str = "127.0.0.1"):
+        self.settings = settings or MockSettings()
+        self.host = host
+        self.urls = {}
+        self._runners = []
+
+    async def start(self):
+        for name, factory in (("unibuy", unibuy_app), ("linepay", linepay_app), ("esun", esun_app)):
+            runner = web.AppRunner(factory(self.settings), access_log=None)
+            await runner.setup()
+            site = web.TCPSite(runner, self.host, 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            self.urls[name] = f"http://{self.host}:{port}"
+            self._runners.append(runner)
+        return self.urls
+
+    async def stop(self):
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners = []
+
+    def environment(self) -> dict:
+        """給 config.py 使用的環境變數，讓服務改連到模擬上游。"""
+        return {
+            "UNIBUY_BASE_URL": self.urls["unibuy"],
+            "LINE_PAY_PRODUCTION_BASE_URL": self.urls["linepay"],
+            "LINE_PAY_SANDBOX_BASE_URL": self.urls["linepay"],
+            "ESUN_BASE_URL": self.urls["esun"],
+        }
@@ -0,0 +1,215 @@
+import os
+
+
+def _env_str(name: str, default: str) -> str:
+    return os.getenv(name, default)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+# MySQL（可用環境變數改連本機資料庫，例如壓力測試）
+MYSQL_HOST = _env_str("MYSQL_HOST", "152.42.211.122")
+MYSQL_PORT = _env_int("MYSQL_PORT", 3306)
+MYSQL_USER = _env_str("MYSQL_USER", "root")
+MYSQL_PASSWORD = _env_str("MYSQL_PASSWORD", "1234Abcd@")
+MYSQL_DB = _env_str("MYSQL_DB", "linepay_db")
+DB_POOL_MINSIZE = _env_int("DB_POOL_MINSIZE", 2)  # 啟動暖機時預先建立的連線數
+DB_POOL_MAXSIZE = _env_int("DB_POOL_MAXSIZE", 10)
+
+# 管理 API（/api/admin/*、批次查詢 / 退款）：需帶 Authorization: Bearer <ADMIN_TOKEN> 或 X-Admin-Token，
+# 未設定時這些 API 一律回 503
+ADMIN_TOKEN = _env_str("ADMIN_TOKEN", "")
+
+# 上游服務網址
+UNIBUY_BASE_URL = _env_str("UNIBUY_BASE_URL", "https://unibuy.com.tw")
+B014_URL = f"{UNIBUY_BASE_URL}/Unibuy/api/app/machine/setting/B014"
+B010_URL = f"{UNIBUY_BASE_URL}/Unibuy/api/app/machine/status/B010"
+LINE_PAY_SANDBOX_BASE_URL = _env_str("LINE_PAY_SANDBOX_BASE_URL", "https://sandbox-api-pay.line.me")
+LINE_PAY_PRODUCTION_BASE_URL = _env_str("LINE_PAY_PRODUCTION_BASE_URL", "https://api-pay.line.me")
+ESUN_BASE_URL = _env_str("ESUN_BASE_URL", "https://mpayment.esuntrade.com")
+
+# HTTP 連線池設定（每個上游主機各自一個長連線 client）
+HTTP2_ENABLED = _env_bool("HTTP2_ENABLED", False)
+HTTP_MAX_CONNECTIONS = _env_int("HTTP_MAX_CONNECTIONS", 100)
+HTTP_MAX_KEEPALIVE = _env_int("HTTP_MAX_KEEPALIVE", 20)
+HTTP_KEEPALIVE_EXPIRY = _env_float("HTTP_KEEPALIVE_EXPIRY", 60.0)
+
+UPSTREAMS = {
+    "unibuy": {
+        "base_url": UNIBUY_BASE_URL,
+        "connect_timeout": _env_float("UNIBUY_CONNECT_TIMEOUT", 5.0),
+        "timeout": _env_float("UNIBUY_TIMEOUT", 20.0),
+    },
+    # B010 批次回報與付款路徑的 B014 分開：各自的斷路器、延遲統計與連線池，回報失敗不影響付款
+    "unibuy_b010": {
+        "base_url": UNIBUY_BASE_URL,
+        "connect_timeout": _env_float("UNIBUY_CONNECT_TIMEOUT", 5.0),
+        "timeout": _env_float("B010_TIMEOUT", _env_float("UNIBUY_TIMEOUT", 20.0)),
+    },
+    "linepay": {
+        "base_url": LINE_PAY_PRODUCTION_BASE_URL,
+        "connect_timeout": _env_float("LINE_PAY_CONNECT_TIMEOUT", 5.0),
+        "timeout": _env_float("LINE_PAY_TIMEOUT", 20.0),
+    },
+    "linepay_sandbox": {
+        "base_url": LINE_PAY_SANDBOX_BASE_URL,
+        "connect_timeout": _env_float("LINE_PAY_CONNECT_TIMEOUT", 5.0),
+        "timeout": _env_float("LINE_PAY_TIMEOUT", 20.0),
+    },
+    "esun": {
+        "base_url": ESUN_BASE_URL,
+        "connect_timeout": _env_float("ESUN_CONNECT_TIMEOUT", 5.0),
+        "timeout": _env_float("ESUN_TIMEOUT", 20.0),
+    },
+}
+
+# 啟動暖機與關閉
+WARMUP_TIMEOUT = _env_float("WARMUP_TIMEOUT", 10.0)  # 每個暖機項目
+WARMUP_UPSTREAMS = [name for name in _env_str("WARMUP_UPSTREAMS", ",".join(UPSTREAMS)).split(",") if name in UPSTREAMS]
+WARMUP_CONNECTIONS = _env_int("WARMUP_CONNECTIONS", 2)  # 每個上游預先建立的連線數
+SHUTDOWN_DRAIN_TIMEOUT = _env_float("SHUTDOWN_DRAIN_TIMEOUT", 10.0)
+
+# B014 機台設定快取
+CREDENTIAL_TTL = _env_float("CREDENTIAL_TTL", 300.0)
+CREDENTIAL_REFRESH_AHEAD = _env_float("CREDENTIAL_REFRESH_AHEAD", 60.0)
+CREDENTIAL_STALE_IF_ERROR = _env_bool("CREDENTIAL_STALE_IF_ERROR", True)
+CREDENTIAL_STALE_MAX_AGE = _env_float("CREDENTIAL_STALE_MAX_AGE", 3600.0)
+CREDENTIAL_STALE_WAIT = _env_float("CREDENTIAL_STALE_WAIT", 2.0)
+
+# 交易紀錄批次寫入
+DATA_DIR = _env_str("DATA_DIR", "./data")
+TRANSACTION_BATCH_SIZE = _env_int("TRANSACTION_BATCH_SIZE", 100)
+TRANSACTION_FLUSH_INTERVAL = _env_float("TRANSACTION_FLUSH_INTERVAL", 1.0)
+TRANSACTION_QUEUE_SIZE = _env_int("TRANSACTION_QUEUE_SIZE", 10000)
+TRANSACTION_ENQUEUE_TIMEOUT = _env_float("TRANSACTION_ENQUEUE_TIMEOUT", 0.5)
+TRANSACTION_SPOOL_RETRY_INTERVAL = _env_float("TRANSACTION_SPOOL_RETRY_INTERVAL", 30.0)
+TRANSACTION_SPOOL_PATH = _env_str("TRANSACTION_SPOOL_PATH", f"{DATA_DIR}/transactions.spool.jsonl")
+
+# 逾時訂單對帳
+RECONCILE_DB_PATH = _env_str("RECONCILE_DB_PATH", f"{DATA_DIR}/reconciliation.sqlite")
+RECONCILE_MAX_CONCURRENT = _env_int("RECONCILE_MAX_CONCURRENT", 10)
+RECONCILE_BASE_DELAY = _env_float("RECONCILE_BASE_DELAY", 2.0)
+RECONCILE_MAX_DELAY = _env_float("RECONCILE_MAX_DELAY", 300.0)
+RECONCILE_MAX_ATTEMPTS = _env_int("RECONCILE_MAX_ATTEMPTS", 20)
+
+# 玉山 xTrade：查詢、退款的 Action 與查詢結果代碼需依玉山規格設定，沒有預設值
+# 未設定 Action 時查詢 / 退款 API 回 501；查詢 Action 與成功、失敗代碼都設定後才啟用逾時對帳
+ESUN_INQUIRY_ACTION = _env_str("ESUN_INQUIRY_ACTION", "")
+ESUN_REFUND_ACTION = _env_str("ESUN_REFUND_ACTION", "")
+ESUN_INQUIRY_SUCCESS_CODES = [code for code in _env_str("ESUN_INQUIRY_SUCCESS_CODES", "").split(",") if code]
+ESUN_INQUIRY_FAILED_CODES = [code for code in _env_str("ESUN_INQUIRY_FAILED_CODES", "").split(",") if code]
+ESUN_TERMINAL_CACHE_SIZE = _env_int("ESUN_TERMINAL_CACHE_SIZE", 1024)  # 快取簽章前綴的機台數
+
+# 機台 log 上傳與保存
+LOG_DIR = _env_str("LOG_DIR", "./logs")
+LOG_UPLOAD_CHUNK_SIZE = _env_int("LOG_UPLOAD_CHUNK_SIZE", 1024 * 1024)
+LOG_UPLOAD_MAX_BYTES = _env_int("LOG_UPLOAD_MAX_BYTES", 100 * 1024 * 1024)
+LOG_RETENTION_INTERVAL = _env_float("LOG_RETENTION_INTERVAL", 3600.0)
+LOG_RETENTION_DAYS = _env_float("LOG_RETENTION_DAYS", 30)
+LOG_MACHINE_MAX_BYTES = _env_int("LOG_MACHINE_MAX_BYTES", 0)  # 0 表示不限制
+LOG_GLOBAL_MAX_BYTES = _env_int("LOG_GLOBAL_MAX_BYTES", 0)  # 0 表示不限制
+LOG_VIEW_DEFAULT_LINES = _env_int("LOG_VIEW_DEFAULT_LINES", 500)
+LOG_VIEW_MAX_LINES = _env_int("LOG_VIEW_MAX_LINES", 5000)
+LOG_INDEX_DB_PATH = _env_str("LOG_INDEX_DB_PATH", f"{DATA_DIR}/log_index.sqlite")
+
+# 舊 log 壓縮歸檔（每台機台每天一個歸檔，分區塊壓縮，可直接跳到需要的區塊讀取）
+LOG_ARCHIVE_ENABLED = _env_bool("LOG_ARCHIVE_ENABLED", True)
+LOG_ARCHIVE_DIR = _env_str("LOG_ARCHIVE_DIR", f"{LOG_DIR}/.archive")
+LOG_ARCHIVE_AFTER_DAYS = _env_float("LOG_ARCHIVE_AFTER_DAYS", 7)
+LOG_ARCHIVE_RETENTION_DAYS = _env_float("LOG_ARCHIVE_RETENTION_DAYS", 365)
+LOG_ARCHIVE_CODEC = _env_str("LOG_ARCHIVE_CODEC", "gzip")  # gzip 或 zstd（需安裝 zstandard，未安裝時使用 gzip）
+LOG_ARCHIVE_LEVEL = _env_int("LOG_ARCHIVE_LEVEL", 6)
+LOG_ARCHIVE_BLOCK_SIZE = _env_int("LOG_ARCHIVE_BLOCK_SIZE", 256 * 1024)
+
+# log 即時追蹤（SSE）
+LOG_TAIL_POLL_INTERVAL = _env_float("LOG_TAIL_POLL_INTERVAL", 1.0)
+LOG_TAIL_QUEUE_SIZE = _env_int("LOG_TAIL_QUEUE_SIZE", 256)  # 每個觀看者最多積壓的事件數
+LOG_TAIL_MAX_CHUNK = _env_int("LOG_TAIL_MAX_CHUNK", 1024 * 1024)  # 單一事件最多送出的內容
+LOG_TAIL_HEARTBEAT = _env_float("LOG_TAIL_HEARTBEAT", 15.0)
+LOG_TAIL_MAX_SUBSCRIBERS = _env_int("LOG_TAIL_MAX_SUBSCRIBERS", 200)  # 每個 worker
+
+# 機台狀態時間序列（上傳 log 時擷取）
+TELEMETRY_ENABLED = _env_bool("TELEMETRY_ENABLED", True)
+TELEMETRY_DIR = _env_str("TELEMETRY_DIR", f"{DATA_DIR}/telemetry")
+TELEMETRY_MAX_POINTS = _env_int("TELEMETRY_MAX_POINTS", 10000)
+
+# B010 狀態回報排程
+B010_PUSH_INTERVAL = _env_float("B010_PUSH_INTERVAL", 600.0)
+B010_PUSH_CONCURRENCY = _env_int("B010_PUSH_CONCURRENCY", 50)
+B010_PUSH_RETRIES = _env_int("B010_PUSH_RETRIES", 3)
+B010_PUSH_BACKOFF = _env_float("B010_PUSH_BACKOFF", 1.0)
+
+# log 全文搜尋
+SEARCH_WORKERS = _env_int("SEARCH_WORKERS", min(8, (os.cpu_count() or 1) + 2))
+SEARCH_EXECUTOR = _env_str("SEARCH_EXECUTOR", "thread")  # thread 或 process
+SEARCH_TIMEOUT = _env_float("SEARCH_TIMEOUT", 30.0)  # 單一查詢的時間上限（秒），逾時回傳已找到的結果
+SEARCH_INDEX_ENABLED = _env_bool("SEARCH_INDEX_ENABLED", False)
+SEARCH_INDEX_DB_PATH = _env_str("SEARCH_INDEX_DB_PATH", f"{DATA_DIR}/search_index.sqlite")
+
+# 結構化 log（JSON lines，由背景 thread 輸出）
+APP_LOG_LEVEL = _env_str("APP_LOG_LEVEL", "INFO")
+APP_LOG_QUEUE_SIZE = _env_int("APP_LOG_QUEUE_SIZE", 10000)
+APP_LOG_SAMPLE_RATE = _env_float("APP_LOG_SAMPLE_RATE", 1.0)  # 只套用在 WARNING 以下
+APP_LOG_REDACT_KEYS = _env_str("APP_LOG_REDACT_KEYS", "")  # 逗號分隔，額外需要遮蔽的欄位
+
+# 付款冪等與訂單編號
+IDEMPOTENCY_CACHE_SIZE = _env_int("IDEMPOTENCY_CACHE_SIZE", 10000)
+IDEMPOTENCY_TTL = _env_float("IDEMPOTENCY_TTL", 900.0)
+ORDER_ID_NODE = _env_str("ORDER_ID_NODE", "")  # 多台主機時各自設定不同的兩碼，未設定時由 PID 產生
+
+# 資料庫 schema migration
+DB_MIGRATE_ON_STARTUP = _env_bool("DB_MIGRATE_ON_STARTUP", True)
+
+# 上游熔斷、動態逾時與 hedged request
+BREAKER_FAILURE_THRESHOLD = _env_int("BREAKER_FAILURE_THRESHOLD", 5)  # 連續失敗幾次後斷路
+BREAKER_RESET_TIMEOUT = _env_float("BREAKER_RESET_TIMEOUT", 30.0)  # 斷路多久後放行一個試探請求
+ADAPTIVE_TIMEOUT_ENABLED = _env_bool("ADAPTIVE_TIMEOUT_ENABLED", True)
+ADAPTIVE_TIMEOUT_PERCENTILE = _env_float("ADAPTIVE_TIMEOUT_PERCENTILE", 0.99)
+ADAPTIVE_TIMEOUT_MULTIPLIER = _env_float("ADAPTIVE_TIMEOUT_MULTIPLIER", 3.0)
+ADAPTIVE_TIMEOUT_MIN = _env_float("ADAPTIVE_TIMEOUT_MIN", 2.0)  # 上限為各上游設定的 timeout
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = _env_int("ADAPTIVE_TIMEOUT_MIN_SAMPLES", 50)
+HEDGE_ENABLED = _env_bool("HEDGE_ENABLED", False)
+HEDGE_DELAY = _env_float("HEDGE_DELAY", 1.0)  # 樣本不足時使用；之後改用 p95 延遲
+
+# 付款端點的流量控制
+ADMISSION_PATHS = _env_str("ADMISSION_PATHS", "/api/linepay/pay,/api/esunpay/pay")
+ADMISSION_MAX_IN_FLIGHT = _env_int("ADMISSION_MAX_IN_FLIGHT", 200)
+ADMISSION_QUEUE_SIZE = _env_int("ADMISSION_QUEUE_SIZE", 500)
+ADMISSION_QUEUE_TIMEOUT = _env_float("ADMISSION_QUEUE_TIMEOUT", 2.0)
+ADMISSION_MACHINE_CONCURRENCY = _env_int("ADMISSION_MACHINE_CONCURRENCY", 4)
+ADMISSION_MACHINE_RATE = _env_float("ADMISSION_MACHINE_RATE", 5.0)  # 每秒補充的 token
+ADMISSION_MACHINE_BURST = _env_float("ADMISSION_MACHINE_BURST", 10.0)
+
+# 批次查詢 / 退款
+LINEPAY_BATCH_MAX_ITEMS = _env_int("LINEPAY_BATCH_MAX_ITEMS", 1000)
+LINEPAY_BATCH_CONCURRENCY = _env_int("LINEPAY_BATCH_CONCURRENCY", 10)
+LINEPAY_BATCH_RETRIES = _env_int("LINEPAY_BATCH_RETRIES", 2)
+LINEPAY_BATCH_RETRY_BACKOFF = _env_float("LINEPAY_BATCH_RETRY_BACKOFF", 0.5)
+
+# 交易查詢與匯出
+TRANSACTION_QUERY_MAX_LIMIT = _env_int("TRANSACTION_QUERY_MAX_LIMIT", 500)
+TRANSACTION_EXPORT_MAX_CONCURRENT = _env_int("TRANSACTION_EXPORT_MAX_CONCURRENT", 2)
+TRANSACTION_EXPORT_FETCH_SIZE = _env_int("TRANSACTION_EXPORT_FETCH_SIZE", 1000)
+
+# 多 worker：背景工作只在 leader 執行，worker 之間以 SQLite 同步快取變更
+LEADER_ELECTION_ENABLED = _env_bool("LEADER_ELECTION_ENABLED", True)
+LEADER_LOCK_PATH = _env_str("LEADER_LOCK_PATH", f"{DATA_DIR}/leader.lock")
+LEADER_POLL_INTERVAL = _env_float("LEADER_POLL_INTERVAL", 2.0)
+SHARED_STATE_DB_PATH = _env_str("SHARED_STATE_DB_PATH", f"{DATA_DIR}/shared_state.sqlite")
+SHARED_STATE_POLL_INTERVAL = _env_float("SHARED_STATE_POLL_INTERVAL", 0.5)
+SHARED_STATE_RETENTION = _env_float("SHARED_STATE_RETENTION", 3600.0)
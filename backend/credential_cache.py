@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import logging
+import time
+import httpx
+from fastapi import HTTPException
+from resilience import Resilience
+from shared_state import SharedEvents
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("data", "fetched_at", "expires_at")
+
+    def __init__(self, data: dict, fetched_at: float, ttl: float):
+        self.data = data
+        self.fetched_at = fetched_at
+        self.expires_at = fetched_at + ttl
+
+
+class CredentialCache:
+    """B014 機台金流設定快取，以 (key, machine) 為鍵。
+
+    - 到期前 REFRESH_AHEAD 秒於背景更新，付款流程不必等待 B014
+    - 同一個鍵同時只會有一個 B014 請求（single-flight）
+    - STALE_IF_ERROR 開啟時，B014 變慢或失敗可回傳近期過期的資料
+    """
+
+    TTL = config.CREDENTIAL_TTL
+    REFRESH_AHEAD = config.CREDENTIAL_REFRESH_AHEAD
+    STALE_IF_ERROR = config.CREDENTIAL_STALE_IF_ERROR
+    STALE_MAX_AGE = config.CREDENTIAL_STALE_MAX_AGE
+    STALE_WAIT = config.CREDENTIAL_STALE_WAIT
+
+    _entries = {}
+    _inflight = {}
+    _generation = 0
+
+    @classmethod
+    async def get(cls, key: str, machine: str) -> dict:
+        cache_key = (key, machine)
+        now = time.monotonic()
+        entry = cls._entries.get(cache_key)
+
+        if entry is not None and now < entry.expires_at:
+            if now >= entry.expires_at - cls.REFRESH_AHEAD:
+                cls._load(cache_key)  # 背景更新，不等待結果
+            return entry.data
+
+        task = cls._load(cache_key)
+        stale_ok = (
+            cls.STALE_IF_ERROR
+            and entry is not None
+            and now < entry.expires_at + cls.STALE_MAX_AGE
+        )
+        if not stale_ok:
+            return await asyncio.shield(task)
+
+        # ✅ 有可用的舊資料時，B014 太慢或失敗（含回應格式錯誤、斷路器開啟等任何例外）就先回傳舊資料
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=cls.STALE_WAIT)
+        except asyncio.TimeoutError:
+            logger.warning("B014 refresh for machine %s is slow, serving stale credentials", machine)
+            return entry.data
+        except Exception as exc:
+            logger.warning("B014 refresh for machine %s failed, serving stale credentials: %r", machine, exc)
+            return entry.data
+
+    @classmethod
+    def invalidate(cls, key: str = None, machine: str = None) -> int:
+        # 通知其他 worker 一併清除
+        SharedEvents.publish("credentials", {"key": key, "machine": machine})
+        return cls._invalidate_local(key, machine)
+
+    @classmethod
+    def _invalidate_local(cls, key: str = None, machine: str = None) -> int:
+        targets = [
+            cache_key for cache_key in cls._entries
+            if (key is None or cache_key[0] == key) and (machine is None or cache_key[1] == machine)
+        ]
+        for cache_key in targets:
+            del cls._entries[cache_key]
+        # 讓進行中的 B014 請求結果不再寫回快取
+        cls._generation += 1
+        cls._inflight.clear()
+        return len(targets)
+
+    @classmethod
+    def _load(cls, cache_key) -> asyncio.Task:
+        task = cls._inflight.get(cache_key)
+        if task is None:
+            task = asyncio.create_task(cls._fetch(cache_key))
+            cls._inflight[cache_key] = task
+            task.add_done_callback(lambda t: cls._done(cache_key, t))
+        return task
+
+    @classmethod
+    def _done(cls, cache_key, task: asyncio.Task):
+        if cls._inflight.get(cache_key) is task:
+            del cls._inflight[cache_key]
+        if not task.cancelled():
+            task.exception()  # 背景更新失敗時避免 "exception was never retrieved"
+
+    @classmethod
+    async def _fetch(cls, cache_key) -> dict:
+        key, machine = cache_key
+        generation = cls._generation
+        try:
+            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            payload = {"key": key, "machine": machine, "time": current_time}
+            # B014 是唯讀查詢，可使用 hedged request
+            response = await Resilience.request("unibuy", "POST", config.B014_URL, hedge=True, json=payload)
+            response.raise_for_status()
+            api_b_response = response.json()
+        except (httpx.RequestError, httpx.HTTPStatusError) as exc:
+            raise HTTPException(status_code=500, detail=f"API B Request failed: {exc}")
+
+        data_items = api_b_response.get("data", [])
+        if not data_items or not isinstance(data_items, list):
+            raise HTTPException(status_code=500, detail="Invalid API B response structure.")
+
+        data = data_items[0]
+        if generation == cls._generation:
+            cls._entries[cache_key] = _Entry(data, time.monotonic(), cls.TTL)
+        return data
+
+
+SharedEvents.subscribe(
+    "credentials", lambda event: CredentialCache._invalidate_local(event["key"], event["machine"])
+)
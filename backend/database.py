@@ -1,31 +1,79 @@
 import aiomysql
 import asyncio
+from contextlib import asynccontextmanager
+import config
 
 class Database:
     _pool = None
+    _init_lock = asyncio.Lock()
 
     @classmethod
     async def init_pool(cls):
-        if cls._pool is None:
+        async with cls._init_lock:
+            if cls._pool is not None:
+                return
             cls._pool = await aiomysql.create_pool(
-                host="152.42.211.122",  # 你的 MySQL 伺服器 IP 或域名
-                port=3306,
-                user="root",  # 你的 MySQL 使用者名稱
-                password="1234Abcd@",  # 你的 MySQL 密碼
-                db="linepay_db",  # 你的 MySQL 資料庫名稱
+                host=config.MYSQL_HOST,  # 你的 MySQL 伺服器 IP 或域名
+                port=config.MYSQL_PORT,
+                user=config.MYSQL_USER,  # 你的 MySQL 使用者名稱
+                password=config.MYSQL_PASSWORD,  # 你的 MySQL 密碼
+                db=config.MYSQL_DB,  # 你的 MySQL 資料庫名稱
                 autocommit=True,
-                minsize=1,
-                maxsize=10
+                minsize=config.DB_POOL_MINSIZE,
+                maxsize=config.DB_POOL_MAXSIZE,
             )
 
+    @classmethod
+    async def warm_up(cls):
+        """啟動時建立連線池（建立時即開好 minsize 條連線）並逐一確認可用，第一筆交易不需等待連線。"""
+        await cls.init_pool()
+        conns = [await cls._pool.acquire() for _ in range(cls._pool.minsize)]
+        try:
+            for conn in conns:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT 1")
+        finally:
+            for conn in conns:
+                cls._pool.release(conn)
+        return {"connections": len(conns)}
+
     @classmethod
     async def get_connection(cls):
         if cls._pool is None:
             await cls.init_pool()
         return await cls._pool.acquire()
 
+    @classmethod
+    def release(cls, conn):
+        if cls._pool is not None:
+            cls._pool.release(conn)
+
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls):
+        # ✅ 使用完畢一定歸還連線，避免連線池（DB_POOL_MAXSIZE）被耗盡
+        conn = await cls.get_connection()
+        try:
+            yield conn
+        finally:
+            cls.release(conn)
+
+    @staticmethod
+    async def connect_dedicated(**kwargs):
+        """不經過連線池的獨立連線（例如大量匯出），不會佔用付款流程的連線。"""
+        return await aiomysql.connect(
+            host=config.MYSQL_HOST,
+            port=config.MYSQL_PORT,
+            user=config.MYSQL_USER,
+            password=config.MYSQL_PASSWORD,
+            db=config.MYSQL_DB,
+            autocommit=True,
+            **kwargs,
+        )
+
     @classmethod
     async def close_pool(cls):
         if cls._pool:
             cls._pool.close()
-            await cls._pool.wait_closed()
\ No newline at end of file
+            await cls._pool.wait_closed()
+            cls._pool = None
\ No newline at end of file
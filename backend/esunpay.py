@@ -1,128 +1,187 @@
 import datetime
 import httpx
-import hashlib
-import json
-import urllib.parse
+import logging
+from typing import Optional
 from fastapi import HTTPException
 from pydantic import BaseModel
+from resilience import Resilience
+from reconciliation import ReconciliationEngine
+from esun_codec import EsunCodec, EsunDecodeError, EsunRequest, EsunResponse
+from credential_cache import CredentialCache
+from structured_logging import bind_order
+from idempotency import IdempotencyStore, OrderIdGenerator
+import config
+
+logger = logging.getLogger(__name__)
 
 class EsunPayRequest(BaseModel):
     key: str
     machine: str
     barcode: str
     amount: int
+    idempotency_key: Optional[str] = None  # 未提供時以 machine + barcode + amount 判斷重複
+
+class EsunInquireRequest(BaseModel):
+    key: str
+    machine: str
+    orderNo: str
+
+class EsunRefundRequest(BaseModel):
+    key: str
+    machine: str
+    orderNo: str
+    refundAmount: int
 
 class EsunPayAPI:
-    ESUNPAY_API_URL = "https://mpayment.esuntrade.com/mPay/GatewayV2/API/V2/xTrade.ashx"
-    API_B_URL = "https://unibuy.com.tw/Unibuy/api/app/machine/setting/B014"
+    # 查詢結果的 ReturnCode 對應最終狀態，其餘代碼視為尚在處理中
+    CHECK_SUCCESS_CODES = set(config.ESUN_INQUIRY_SUCCESS_CODES)
+    CHECK_FAILED_CODES = set(config.ESUN_INQUIRY_FAILED_CODES)
+
+    ESUNPAY_API_URL = f"{config.ESUN_BASE_URL}/mPay/GatewayV2/API/V2/xTrade.ashx"
+    API_B_URL = config.B014_URL
+    HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+    # 查詢 / 退款的 Action 與查詢結果代碼未設定前不送出（猜測的名稱可能被玉山當成別的交易）
+    INQUIRY_ENABLED = bool(config.ESUN_INQUIRY_ACTION)
+    REFUND_ENABLED = bool(config.ESUN_REFUND_ACTION)
+    RECONCILE_ENABLED = INQUIRY_ENABLED and bool(CHECK_SUCCESS_CODES) and bool(CHECK_FAILED_CODES)
 
     @staticmethod
     async def pay(request: EsunPayRequest):
         # 🔹 Step 1: 從 B014 取得掃碼設定
-        try:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            payload = {"key": request.key, "machine": request.machine, "time": current_time}
-            async with httpx.AsyncClient() as client:
-                response = await client.post(EsunPayAPI.API_B_URL, json=payload, timeout=20.0)
-                response.raise_for_status()
-            api_b_response = response.json()
-        except httpx.RequestError as exc:
-            raise HTTPException(status_code=500, detail=f"API B Request failed: {exc}")
-
-        data_items = api_b_response.get("data", [])
-        if not data_items or not isinstance(data_items, list):
-            raise HTTPException(status_code=500, detail="Invalid API B response structure.")
+        settings = await CredentialCache.get(request.key, request.machine)
 
-        store_id = data_items[0].get("t050v41")
-        term_id = data_items[0].get("t050v42")
-        hash_key = data_items[0].get("t050v43")
+        store_id = settings.get("t050v41")
+        term_id = settings.get("t050v42")
+        hash_key = settings.get("t050v43")
 
-        print("🔍 B014 回傳：", {
-            "StoreID": store_id,
-            "TermID": term_id,
-            "Key": hash_key
-        })
+        logger.debug("esun settings loaded", extra={"store_id": store_id, "term_id": term_id, "machine": request.machine})
 
         if not store_id or not term_id or not hash_key:
             raise HTTPException(status_code=500, detail="Missing StoreID, TermID, or Hash from API B.")
 
+        # ✅ 同一筆付款重送時等待 / 沿用第一次的結果（玉山交易不寫入 linepay_transactions，只用記憶體）
+        idempotency_key = IdempotencyStore.make_key(
+            "esunpay", request.idempotency_key, request.machine, request.barcode, request.amount
+        )
+        return await IdempotencyStore.run(
+            "esunpay", idempotency_key,
+            lambda: EsunPayAPI._pay(request, store_id, term_id, hash_key, idempotency_key),
+            lookup=False,
+        )
+
+    @staticmethod
+    async def _pay(request: EsunPayRequest, store_id: str, term_id: str, hash_key: str, idempotency_key: str = None):
          # 2️⃣ 組訂單資料
-        order_no = f"{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}{request.machine}"
+        order_no = OrderIdGenerator.next(request.machine)
         order_dt = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        bind_order(order_no)
+
+        # ✅ 編碼與簽章由 EsunCodec 一次完成（各機台的固定前綴已快取）
+        esun_request = EsunCodec.terminal(store_id, term_id, hash_key).payment(
+            order_no, request.barcode, request.amount, order_dt
+        )
+        # hash key 不可寫入 log
+        logger.debug("esun payment request", extra={
+            "term_id": term_id, "amount": request.amount, "hash_digest": esun_request.digest,
+        })
 
-        transaction_data = {
-            "StoreID": store_id,
-            "TermID": term_id,
-            "Timeout": 20,
-            "BuyerID": request.barcode,
-            "OrderNo": order_no,
-            "OrderCurrency": "TWD",
-            "OrderAmount": request.amount,
-            "OrderDT": order_dt,
-            "OrderTitle": order_no,
-            "BuyerPaymentType": 1
-        }
+        # 🔹 Step 3: 呼叫玉山支付 API
+        try:
+            response = await EsunPayAPI.send(esun_request)
 
+        except httpx.TimeoutException as exc:  # ✅ 逾時改由背景對帳，立即回覆 pending
+            if not EsunPayAPI.RECONCILE_ENABLED:
+                logger.warning("esun request timed out: %s", exc)
+                raise HTTPException(status_code=500, detail=f"EsunPay Request failed: {exc}")
+            return await ReconciliationEngine.submit("esunpay", order_no, request.model_dump(), idempotency_key)
 
-        # 將 TransactionData JSON 壓縮為無空格並做 URL encode
-        transaction_json = json.dumps(transaction_data, separators=(',', ':'))
-        transaction_data_encoded = urllib.parse.quote(transaction_json, safe='')
+        except EsunDecodeError as exc:
+            # 玉山已收到請求但回應看不懂，結果不明，同樣交給背景查詢
+            logger.error("esun payment response could not be decoded: %s", exc)
+            if not EsunPayAPI.RECONCILE_ENABLED:
+                raise HTTPException(status_code=502, detail=f"EsunPay 回傳無法解析：{exc}")
+            return await ReconciliationEngine.submit("esunpay", order_no, request.model_dump(), idempotency_key)
 
-        # === 3️⃣ 組 HashDigest ===
-        hash_source = f"tradeapi" + "payment" + transaction_data_encoded + hash_key
-        hash_digest = hashlib.sha256(hash_source.encode("utf-8")).hexdigest().upper()
+        except httpx.RequestError as exc:
+            logger.warning("esun request failed: %s", exc)
+            raise HTTPException(status_code=500, detail=f"EsunPay Request failed: {exc}")
+        except httpx.HTTPStatusError as exc:
+            logger.warning("esun returned HTTP %s", exc.response.status_code)
+            raise HTTPException(status_code=exc.response.status_code, detail=f"EsunPay Error: {exc.response.text}")
 
-        # === 4️⃣ 組最終 payload ===
-        final_payload = {
-            "Type": "tradeapi",
-            "Action": "payment",
-            "TransactionData": transaction_data_encoded,
-            "HashDigest": hash_digest
+        if not response.approved:
+            logger.info("esun payment declined", extra={
+                "return_code": response.return_code, "return_message": response.return_message,
+            })
+        return {
+            "status": "success",
+            "data": response.data()
         }
 
-        # 最終上傳內容需再次 JSON 並 URL encode
-        encoded_json = urllib.parse.quote(json.dumps(final_payload, separators=(',', ':')), safe='')
+    @staticmethod
+    async def send(esun_request: EsunRequest, hedge: bool = False) -> EsunResponse:
+        """送出已編碼的請求並解碼回應；HTTP 錯誤以 httpx 例外、格式錯誤以 EsunDecodeError 丟出。"""
+        response = await Resilience.request(
+            "esun", "POST", EsunPayAPI.ESUNPAY_API_URL, hedge=hedge,
+            content=esun_request.content, headers=EsunPayAPI.HEADERS,
+        )
+        response.raise_for_status()
+        return EsunCodec.decode(response.content, esun_request.action)
 
-        print("🔍 寄出前內容：")
-        print("原始 Transaction JSON:", transaction_json)
-        print("URL encoded TransactionData:", transaction_data_encoded)
-        print("Hash Source:", hash_source)
-        print("HashDigest:", hash_digest)
-        print("最終傳送 JSON:", final_payload)
+    @staticmethod
+    async def terminal(key: str, machine: str):
+        settings = await CredentialCache.get(key, machine)
+        store_id, term_id, hash_key = settings.get("t050v41"), settings.get("t050v42"), settings.get("t050v43")
+        if not store_id or not term_id or not hash_key:
+            raise HTTPException(status_code=500, detail="Missing StoreID, TermID, or Hash from API B.")
+        return EsunCodec.terminal(store_id, term_id, hash_key)
 
-        # 🔹 Step 3: 呼叫玉山支付 API
-        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    @staticmethod
+    async def _call(esun_request: EsunRequest, hedge: bool = False):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    EsunPayAPI.ESUNPAY_API_URL,
-                    data=f"json={encoded_json}",
-                    headers=headers,
-                    timeout=20.0
-                )
-                response.raise_for_status()
-            # === 4️⃣ 嘗試雙層解碼 ===
-            try:
-                first_decode = urllib.parse.unquote(response.text)
-                parsed = json.loads(first_decode)
-
-                if "TransactionData" in parsed:
-                    parsed["TransactionData"] = json.loads(urllib.parse.unquote(parsed["TransactionData"]))
-
-                return {
-                    "status": "success",
-                    "data": parsed
-                }
-
-            except Exception as e:
-                return {
-                    "status": "error",
-                    "raw": response.text,
-                    "message": f"EsunPay 回傳無法解析：{str(e)}"
-                }
-
-
+            response = await EsunPayAPI.send(esun_request, hedge)
+        except EsunDecodeError as exc:
+            raise HTTPException(status_code=502, detail=f"EsunPay 回傳無法解析：{exc}")
         except httpx.RequestError as exc:
             raise HTTPException(status_code=500, detail=f"EsunPay Request failed: {exc}")
         except httpx.HTTPStatusError as exc:
             raise HTTPException(status_code=exc.response.status_code, detail=f"EsunPay Error: {exc.response.text}")
+        return {"status": "success", "data": response.data()}
+
+    @staticmethod
+    async def inquire(request: EsunInquireRequest):
+        if not EsunPayAPI.INQUIRY_ENABLED:
+            raise HTTPException(status_code=501, detail="EsunPay inquiry is not configured (ESUN_INQUIRY_ACTION)")
+        terminal = await EsunPayAPI.terminal(request.key, request.machine)
+        # ✅ 查詢可重送，允許 hedged request
+        return await EsunPayAPI._call(terminal.inquiry(request.orderNo), hedge=True)
+
+    @staticmethod
+    async def refund(request: EsunRefundRequest):
+        if not EsunPayAPI.REFUND_ENABLED:
+            raise HTTPException(status_code=501, detail="EsunPay refund is not configured (ESUN_REFUND_ACTION)")
+        terminal = await EsunPayAPI.terminal(request.key, request.machine)
+        return await EsunPayAPI._call(terminal.refund(request.orderNo, request.refundAmount))
+
+    @staticmethod
+    async def reconcile(record: dict):
+        """ReconciliationEngine 呼叫：查詢逾時訂單，尚無最終結果時回傳 None。"""
+        request = record["request"]
+        terminal = await EsunPayAPI.terminal(request["key"], request["machine"])
+        response = await EsunPayAPI.send(terminal.inquiry(record["order_id"]), hedge=True)
+        return_code, return_message = response.return_code, response.return_message
+        if return_code in EsunPayAPI.CHECK_SUCCESS_CODES:
+            return "success", return_code, return_message, response.data()
+        if return_code in EsunPayAPI.CHECK_FAILED_CODES:
+            return "failed", return_code, return_message, response.data()
+        return None
+
+    @staticmethod
+    def final_response(order_id: str, status: str, return_code: str, return_message: str, data):
+        """對帳取得最終結果後，同一筆付款重送時回傳的內容（與付款當下相同，結果在 TransactionData）。"""
+        return {"status": "success", "orderId": order_id, "data": data}
+
+
+# 玉山交易不寫入 linepay_transactions，對帳結果只保存在 ReconciliationEngine
+if EsunPayAPI.RECONCILE_ENABLED:
+    ReconciliationEngine.register("esunpay", EsunPayAPI.reconcile, record=False, respond=EsunPayAPI.final_response)
@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import re
+import time
+import httpx
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+# 路徑中的訂單編號等參數不列入指標標籤，避免標籤數量無限增加
+_ORDER_SEGMENT = re.compile(r"/orders/[^/]+")
+
+
+def _endpoint(url: httpx.URL) -> str:
+    return _ORDER_SEGMENT.sub("/orders/{id}", url.path)
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """包住實際的 transport，記錄每個上游的延遲（到收到回應標頭為止）與錯誤。"""
+
+    def __init__(self, upstream: str, transport: httpx.AsyncBaseTransport):
+        self.upstream = upstream
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = _endpoint(request.url)
+        start = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.HTTPError as exc:
+            metrics.UPSTREAM_LATENCY.observe(
+                time.perf_counter() - start, upstream=self.upstream, endpoint=endpoint, status="error"
+            )
+            metrics.UPSTREAM_ERRORS.inc(upstream=self.upstream, endpoint=endpoint, error=type(exc).__name__)
+            raise
+        metrics.UPSTREAM_LATENCY.observe(
+            time.perf_counter() - start, upstream=self.upstream, endpoint=endpoint, status=response.status_code
+        )
+        if response.status_code >= 500:
+            metrics.UPSTREAM_ERRORS.inc(upstream=self.upstream, endpoint=endpoint, error=f"http_{response.status_code}")
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class Upstreams:
+    """每個上游主機共用一個長連線的 httpx.AsyncClient，於啟動時建立、關閉時釋放。"""
+
+    _clients = {}
+
+    @classmethod
+    def _build_client(cls, name: str) -> httpx.AsyncClient:
+        settings = config.UPSTREAMS[name]
+        http2 = config.HTTP2_ENABLED
+        if http2 and not _http2_available():
+            logger.warning("HTTP2_ENABLED is set but the h2 package is not installed, using HTTP/1.1")
+            http2 = False
+
+        transport = httpx.AsyncHTTPTransport(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=config.HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=config.HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        return httpx.AsyncClient(
+            base_url=settings["base_url"],
+            timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+            transport=InstrumentedTransport(name, transport),
+        )
+
+    @classmethod
+    async def init_clients(cls):
+        for name in config.UPSTREAMS:
+            if name not in cls._clients:
+                cls._clients[name] = cls._build_client(name)
+
+    @classmethod
+    def get(cls, name: str) -> httpx.AsyncClient:
+        # 尚未初始化時（例如單獨執行腳本）才延遲建立
+        client = cls._clients.get(name)
+        if client is None or client.is_closed:
+            client = cls._clients[name] = cls._build_client(name)
+        return client
+
+    @staticmethod
+    def linepay_name(test: int) -> str:
+        return "linepay_sandbox" if test == 1 else "linepay"
+
+    @classmethod
+    def linepay(cls, test: int) -> httpx.AsyncClient:
+        return cls.get(cls.linepay_name(test))
+
+    @classmethod
+    async def warm_up(cls, names=None, connections: int = None):
+        """預先建立到各上游的 keep-alive 連線（DNS、TCP、TLS），回應內容不重要。
+
+        不經過 Resilience，暖機失敗不會影響熔斷器狀態。
+        """
+        names = config.WARMUP_UPSTREAMS if names is None else names
+        connections = config.WARMUP_CONNECTIONS if connections is None else connections
+
+        async def touch(name):
+            client = cls.get(name)
+            timeout = config.UPSTREAMS[name]["connect_timeout"]
+            # 同時送出才會各自開一條連線，之後都留在 keep-alive pool
+            results = await asyncio.gather(
+                *(client.head("/", timeout=timeout) for _ in range(connections)), return_exceptions=True
+            )
+            errors = [result for result in results if isinstance(result, Exception)]
+            if len(errors) == len(results):
+                raise errors[0]
+            return connections - len(errors)
+
+        results = await asyncio.gather(*(touch(name) for name in names), return_exceptions=True)
+        opened = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.warning("failed to warm up upstream %s: %s", name, result)
+                opened[name] = f"{type(result).__name__}: {result}"
+            else:
+                opened[name] = result
+        return opened
+
+    @classmethod
+    async def close_clients(cls):
+        clients, cls._clients = cls._clients, {}
+        for client in clients.values():
+            await client.aclose()
@@ -0,0 +1,177 @@
+"""付款冪等與訂單編號。
+
+- OrderIdGenerator：毫秒時間戳（同一毫秒或時鐘倒退時遞增）加上節點碼，同一秒內重送也不會重複
+- IdempotencyStore：以冪等鍵（用戶端提供，或預設為 machine + barcode + amount）去除重複付款
+  - 相同鍵正在處理中：等待第一筆的結果，不再呼叫上游
+  - 已完成：回傳第一次的回應（記憶體 LRU/TTL；用戶端提供冪等鍵的重送才在未命中時查 linepay_transactions.response_json，
+    預設鍵不查資料庫，新付款不需等待 MySQL）
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from fastapi import HTTPException
+from database import Database
+from migrate import Migrations, IDEMPOTENCY_COLUMNS
+from shared_state import SharedEvents
+from structured_logging import redact
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENT_REQUESTS = metrics.Counter(
+    "idempotent_requests_total", "Payment requests by idempotency outcome", ("provider", "result"),
+)
+
+_BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _default_node() -> str:
+    pid = os.getpid() % (36 * 36)
+    return _BASE36[pid // 36] + _BASE36[pid % 36]
+
+
+class OrderIdGenerator:
+    NODE = config.ORDER_ID_NODE or _default_node()
+
+    _lock = threading.Lock()
+    _last_ms = 0
+
+    @classmethod
+    def next(cls, *parts) -> str:
+        """回傳 YYYYMMDDHHMMSSmmm + 節點碼 + parts，同一程序內嚴格遞增。"""
+        with cls._lock:
+            now_ms = time.time_ns() // 1_000_000
+            cls._last_ms = now_ms if now_ms > cls._last_ms else cls._last_ms + 1
+            ms = cls._last_ms
+        stamp = time.strftime("%Y%m%d%H%M%S", time.localtime(ms // 1000)) + f"{ms % 1000:03d}"
+        return stamp + cls.NODE + "".join(str(part) for part in parts)
+
+
+def error_response(status_code: int, detail: str) -> dict:
+    """上游已明確拒絕的結果也要記住，重送時回同樣的錯誤。"""
+    return {"_error": {"status_code": status_code, "detail": detail}}
+
+
+def unwrap(response):
+    if isinstance(response, dict) and "_error" in response:
+        raise HTTPException(**response["_error"])
+    return response
+
+
+class IdempotencyStore:
+    CACHE_SIZE = config.IDEMPOTENCY_CACHE_SIZE
+    TTL = config.IDEMPOTENCY_TTL
+    DB_TIMEOUT = 0.5
+    DB_RETRY_AFTER = 30.0
+
+    _entries = OrderedDict()  # key -> (expires_at, response)
+    _inflight = {}
+    _lookup_disabled_until = 0.0
+
+    @staticmethod
+    def make_key(provider: str, client_key: str = None, *parts) -> str:
+        source = f"{provider}|client|{client_key}" if client_key else "|".join([provider, *map(str, parts)])
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def _cached(cls, key: str):
+        entry = cls._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del cls._entries[key]
+            return None
+        cls._entries.move_to_end(key)
+        return entry[1]
+
+    @classmethod
+    def remember(cls, key: str, response, share: bool = True):
+        if share:
+            # 重送可能被分到其他 worker，一併讓它們記住；共用檔只寫入遮蔽後的回應，且不等待寫入
+            SharedEvents.publish("idempotency", {"key": key, "response": redact(response)})
+        cls._entries[key] = (time.monotonic() + cls.TTL, response)
+        cls._entries.move_to_end(key)
+        while len(cls._entries) > cls.CACHE_SIZE:
+            cls._entries.popitem(last=False)
+
+    @classmethod
+    async def _load(cls, key: str):
+        if time.monotonic() < cls._lookup_disabled_until or not Migrations.has(IDEMPOTENCY_COLUMNS):
+            return None
+
+        async def query():
+            async with Database.acquire() as conn:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(
+                        "SELECT response_json FROM linepay_transactions "
+                        "WHERE idempotency_key = %s AND response_json IS NOT NULL LIMIT 1",
+                        (key,),
+                    )
+                    return await cursor.fetchone()
+
+        try:
+            row = await asyncio.wait_for(query(), timeout=cls.DB_TIMEOUT)
+        except Exception as exc:
+            # 查不到就照常處理，不因資料庫問題擋住付款；一段時間內不再查詢
+            logger.warning("idempotency lookup failed: %s", exc)
+            cls._lookup_disabled_until = time.monotonic() + cls.DB_RETRY_AFTER
+            return None
+        return json.loads(row[0]) if row else None
+
+    @classmethod
+    async def run(cls, provider: str, key: str, func, lookup: bool = True):
+        """同一個 key 只執行一次 func()；func 回傳的結果會被記住，丟出例外則不記住（可重試）。
+
+        lookup=True 時記憶體未命中才查資料庫，只應用在用戶端明確提供冪等鍵的請求。
+        """
+        while True:
+            cached = cls._cached(key)
+            if cached is not None:
+                IDEMPOTENT_REQUESTS.inc(provider=provider, result="replayed")
+                return unwrap(cached)
+
+            inflight = cls._inflight.get(key)
+            if inflight is None:
+                break
+            IDEMPOTENT_REQUESTS.inc(provider=provider, result="joined")
+            try:
+                return unwrap(await asyncio.shield(inflight))
+            except asyncio.CancelledError:
+                # 第一筆請求被取消（例如連線中斷）時改由這一筆重新處理
+                if inflight.cancelled() and not asyncio.current_task().cancelling():
+                    continue
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        cls._inflight[key] = future
+        try:
+            result = await cls._load(key) if lookup else None
+            if result is not None:
+                IDEMPOTENT_REQUESTS.inc(provider=provider, result="replayed")
+            else:
+                IDEMPOTENT_REQUESTS.inc(provider=provider, result="executed")
+                result = await func()
+            cls.remember(key, result)
+            future.set_result(result)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # 沒有其他等待者時避免 "exception was never retrieved"
+            raise
+        finally:
+            if cls._inflight.get(key) is future:
+                del cls._inflight[key]
+        return unwrap(result)
+
+
+SharedEvents.subscribe(
+    "idempotency", lambda event: IdempotencyStore.remember(event["key"], event["response"], share=False)
+)
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import os
+from pathlib import Path
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderElection:
+    """多個 worker 以檔案鎖選出一個 leader，只有 leader 執行背景工作。
+
+    鎖由作業系統跟著程序釋放，leader 結束或當掉後，其他 worker 在 POLL_INTERVAL 內接手。
+    關閉 LEADER_ELECTION_ENABLED 時每個 worker 都視為 leader（單一 worker 部署的舊行為）。
+    """
+
+    ENABLED = config.LEADER_ELECTION_ENABLED
+    LOCK_PATH = Path(config.LEADER_LOCK_PATH)
+    POLL_INTERVAL = config.LEADER_POLL_INTERVAL
+
+    is_leader = False
+    _jobs = []
+    _fd = None
+    _task = None
+
+    @classmethod
+    def register(cls, name: str, start, stop=None):
+        """成為 leader 時依註冊順序 await start()，結束時反序 await stop()。"""
+        cls._jobs.append((name, start, stop))
+
+    @classmethod
+    def register_loop(cls, name: str, factory):
+        """factory() 回傳持續執行的 coroutine，例如 schedule_log_upload。"""
+        tasks = {}
+
+        async def start():
+            tasks[name] = asyncio.create_task(factory(), name=name)
+
+        async def stop():
+            task = tasks.pop(name, None)
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        cls.register(name, start, stop)
+
+    # ---- 檔案鎖 ----
+    @classmethod
+    def _try_lock(cls) -> bool:
+        cls.LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(cls.LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode("ascii"))
+        cls._fd = fd
+        return True
+
+    @classmethod
+    def _unlock(cls):
+        if cls._fd is None:
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(cls._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(cls._fd, 0, os.SEEK_SET)
+                msvcrt.locking(cls._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(cls._fd)
+            cls._fd = None
+
+    @classmethod
+    def holder(cls):
+        try:
+            return int(cls.LOCK_PATH.read_text().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    # ---- 生命週期 ----
+    @classmethod
+    async def _become_leader(cls):
+        cls.is_leader = True
+        logger.info("worker %s is now the leader", os.getpid())
+        for name, start, _ in cls._jobs:
+            try:
+                await start()
+            except Exception as exc:
+                logger.exception("failed to start leader job %s: %s", name, exc)
+
+    @classmethod
+    async def _campaign(cls):
+        while not cls._try_lock():
+            await asyncio.sleep(cls.POLL_INTERVAL)
+        await cls._become_leader()
+
+    @classmethod
+    async def start(cls):
+        if not cls.ENABLED:
+            await cls._become_leader()
+            return
+        # 第一次直接嘗試，拿到鎖就在啟動流程內啟動背景工作；否則在背景等待接手
+        if cls._try_lock():
+            await cls._become_leader()
+        else:
+            cls._task = asyncio.create_task(cls._campaign())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._task.cancel()
+            await asyncio.gather(cls._task, return_exceptions=True)
+            cls._task = None
+        if cls.is_leader:
+            for name, _, stop in reversed(cls._jobs):
+                if stop is None:
+                    continue
+                try:
+                    await stop()
+                except Exception as exc:
+                    logger.exception("failed to stop leader job %s: %s", name, exc)
+            cls.is_leader = False
+        cls._unlock()
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import time
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class Lifecycle:
+    """服務的啟動狀態：starting → ready → draining。
+
+    暖機（建立資料庫連線、預先連上游）在啟動後於背景執行，完成前 /readyz 回 503，
+    讓負載平衡器在暖機完成後才把流量導過來；個別項目失敗只記錄在 checks，不阻擋服務
+    （例如資料庫暫時無法連線時交易紀錄仍會寫入本機 spool）。
+    確定不能服務的狀況（例如 schema 有未套用的 migration）以 block() 登記，解除前 /readyz 維持 503。
+    關閉時先切換為 draining，等待 spawn() 建立的背景工作完成後才釋放資源。
+    """
+
+    WARMUP_TIMEOUT = config.WARMUP_TIMEOUT
+    DRAIN_TIMEOUT = config.SHUTDOWN_DRAIN_TIMEOUT
+
+    state = "starting"
+    checks = {}
+    blockers = {}
+    _tasks = set()
+
+    @classmethod
+    def ready(cls) -> bool:
+        return cls.state == "ready" and not cls.blockers
+
+    @classmethod
+    def block(cls, name: str, reason: str):
+        if name not in cls.blockers:
+            logger.warning("not ready: %s", reason)
+        cls.blockers[name] = reason
+
+    @classmethod
+    def unblock(cls, name: str):
+        cls.blockers.pop(name, None)
+
+    @classmethod
+    def blocked(cls, name: str) -> bool:
+        return name in cls.blockers
+
+    @classmethod
+    def spawn(cls, coro, name: str = None) -> asyncio.Task:
+        """建立關閉時需要等待完成的背景工作（例如上傳後的索引更新）。"""
+        task = asyncio.create_task(coro, name=name)
+        cls._tasks.add(task)
+        task.add_done_callback(cls._tasks.discard)
+        return task
+
+    @classmethod
+    async def _check(cls, name: str, step):
+        start = time.perf_counter()
+        try:
+            detail = await asyncio.wait_for(step(), cls.WARMUP_TIMEOUT)
+        except Exception as exc:
+            cls.checks[name] = {"status": "error", "error": f"{type(exc).__name__}: {exc}"}
+            logger.warning("warm-up step %s failed: %s", name, exc)
+            return
+        cls.checks[name] = {"status": "ok", "duration": round(time.perf_counter() - start, 3)}
+        if detail:
+            cls.checks[name]["detail"] = detail
+
+    @classmethod
+    async def warm_up(cls, steps: dict):
+        """steps 為 {名稱: 回傳 coroutine 的函式}，同時執行；全部結束（成功或失敗）後進入 ready。"""
+        await asyncio.gather(*(cls._check(name, step) for name, step in steps.items()))
+        if cls.state == "starting":
+            cls.state = "ready"
+            logger.info("service ready", extra={"checks": cls.checks})
+
+    @classmethod
+    async def drain(cls):
+        cls.state = "draining"
+        pending = [task for task in cls._tasks if not task.done()]
+        if not pending:
+            return
+        logger.info("waiting for %d background tasks before shutdown", len(pending))
+        _, still_running = await asyncio.wait(pending, timeout=cls.DRAIN_TIMEOUT)
+        for task in still_running:
+            task.cancel()
+        if still_running:
+            logger.warning("cancelled %d background tasks after drain timeout", len(still_running))
+            await asyncio.gather(*still_running, return_exceptions=True)
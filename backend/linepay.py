@@ -1,9 +1,16 @@
-import datetime
 import httpx
 import os
+from typing import Optional
 from fastapi import HTTPException
 from pydantic import BaseModel
-from database import Database
+from transaction_recorder import TransactionRecorder
+from reconciliation import ReconciliationEngine
+from http_client import Upstreams
+from resilience import Resilience
+from credential_cache import CredentialCache
+from structured_logging import bind_order
+from idempotency import IdempotencyStore, OrderIdGenerator, error_response
+import config
 
 # 定義 LINE Pay 交易請求的資料結構
 class LinePayRequest(BaseModel):
@@ -13,6 +20,7 @@ class LinePayRequest(BaseModel):
     amount: int
     payway: str
     test: int  # 1: 測試模式，0: 正式環境
+    idempotency_key: Optional[str] = None  # 未提供時以 machine + barcode + amount 判斷重複
 
 # 定義 LINE Pay 退款請求的資料結構
 class LinePayRefundRequest(BaseModel):
@@ -23,44 +31,48 @@ class LinePayRefundRequest(BaseModel):
     test: int  # 1: 測試模式，0: 正式環境
 
 class LinePayAPI:
-    API_B_URL = "https://unibuy.com.tw/Unibuy/api/app/machine/setting/B014"
-    LINE_PAY_SANDBOX_URL = "https://sandbox-api-pay.line.me/v2/payments"
-    LINE_PAY_PRODUCTION_URL = "https://api-pay.line.me/v2/payments"
+    # orders/{orderId}/check 的 returnCode 對應最終狀態，其餘代碼視為尚在處理中
+    CHECK_SUCCESS_CODES = {"0110", "0123"}
+    CHECK_FAILED_CODES = {"0121", "0122", "1150"}
+
+    API_B_URL = config.B014_URL
+    LINE_PAY_SANDBOX_URL = f"{config.LINE_PAY_SANDBOX_BASE_URL}/v2/payments"
+    LINE_PAY_PRODUCTION_URL = f"{config.LINE_PAY_PRODUCTION_BASE_URL}/v2/payments"
 
     @staticmethod
     async def pay(request: LinePayRequest):
         if len(request.barcode) != 18:
             return {"status": "barcode error"}
 
-        try:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            payload = {"key": request.key, "machine": request.machine, "time": current_time}
-            async with httpx.AsyncClient() as client:
-                response = await client.post(LinePayAPI.API_B_URL, json=payload, timeout=20.0)
-                response.raise_for_status()
-            api_b_response = response.json()
-        except httpx.RequestError as exc:
-            raise HTTPException(status_code=500, detail=f"API B Request failed: {exc}")
-        
-        data_items = api_b_response.get("data", [])
-        if not data_items or not isinstance(data_items, list):
-            raise HTTPException(status_code=500, detail="Invalid API B response structure.")
-        
+        # ✅ 機台設定改由快取取得，避免每筆交易都打一次 B014
+        settings = await CredentialCache.get(request.key, request.machine)
+
         # ✅ 確保 channel_id 和 channel_secret 不是 None 或空字串
-        channel_id = data_items[0].get("LINE_ChannelId", "").strip()
-        channel_secret = data_items[0].get("LINE_ChannelSecret", "").strip()
+        channel_id = (settings.get("LINE_ChannelId") or "").strip()
+        channel_secret = (settings.get("LINE_ChannelSecret") or "").strip()
         if not channel_id or not channel_secret:
-            return_code, return_message, status = "200", "金流未開放", "failed"
             return {"status": "failed", "message": "金流未開放"}
 
+        # ✅ 同一筆付款（相同冪等鍵）重送時不再向 LINE Pay 扣款
+        idempotency_key = IdempotencyStore.make_key(
+            "linepay", request.idempotency_key, request.machine, request.barcode, request.amount
+        )
+        return await IdempotencyStore.run(
+            "linepay", idempotency_key,
+            lambda: LinePayAPI._pay(request, channel_id, channel_secret, idempotency_key),
+            # 預設鍵（machine + barcode + amount）只看記憶體，不讓每筆新付款都先等一次 MySQL 查詢
+            lookup=request.idempotency_key is not None,
+        )
 
+    @staticmethod
+    async def _pay(request: LinePayRequest, channel_id: str, channel_secret: str, idempotency_key: str):
+        order_id = OrderIdGenerator.next(request.payway, request.machine)
+        bind_order(order_id)
         try:
             base_url = (
                 LinePayAPI.LINE_PAY_SANDBOX_URL if request.test == 1 else LinePayAPI.LINE_PAY_PRODUCTION_URL
             )
             pay_url = f"{base_url}/oneTimeKeys/pay"
-            req_time = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            order_id = f"{req_time}{request.payway}{request.machine}"
 
             body = {
                 "amount": request.amount,
@@ -74,91 +86,90 @@ class LinePayAPI:
                 "X-LINE-ChannelSecret": channel_secret,
                 "X-LINE-ChannelId": channel_id,
             }
-            async with httpx.AsyncClient() as client:
-                response = await client.post(pay_url, json=body, headers=headers, timeout=20.0)
-                response.raise_for_status()
+            response = await Resilience.request(
+                Upstreams.linepay_name(request.test), "POST", pay_url, json=body, headers=headers
+            )
+            response.raise_for_status()
             line_pay_response = response.json()
-            
-            # ✅ 新增 returnCode 判斷邏輯
-            return_code = line_pay_response.get("returnCode", "9999")  # 預設錯誤代碼
-            return_message = line_pay_response.get("returnMessage", "Unknown error")
-            status = "success" if return_code == "0000" else "failed"
-            
-             # ✅ 將交易記錄存入 MySQL
-            await LinePayAPI.save_transaction(order_id, request, status, return_code, return_message)
-            
-        except httpx.TimeoutException:  # ✅ **新增逾時處理**
-            try:
-                inquire_response = await LinePayAPI.inquire(channel_id, channel_secret, order_id, request.test)
-                return {
-                    "status": "timeout",
-                    "data": inquire_response,
-                }
-            except HTTPException as inquire_exc:
-                if inquire_exc.status_code == 500 and "timeout" in inquire_exc.detail.lower():
-                    return {
-                        "status": "error",
-                        "code": 9999,
-                        "message": "Payment request and inquiry both timed out.",
-                    }
-                raise inquire_exc  # 若 `inquire` 本身報錯，則拋出
 
+        except httpx.TimeoutException:  # ✅ **逾時改由背景對帳，立即回覆 pending**
+            result = await ReconciliationEngine.submit("linepay", order_id, request.model_dump(), idempotency_key)
+            await LinePayAPI.save_transaction(
+                order_id, request, "pending", "TIMEOUT", "Payment request timed out", idempotency_key, result
+            )
+            return result
+
+        # 沒有拿到 LINE Pay 的結果，不記住回應，讓機台可以重試
         except httpx.HTTPStatusError as exc:
             if exc.response.status_code == 503:
-                return_code, return_message, status = "503", "金流未開放", "failed"
+                return_code, return_message = "503", "金流未開放"
             else:
-                return_code, return_message, status = str(exc.response.status_code), exc.response.text, "failed"
-
+                return_code, return_message = str(exc.response.status_code), exc.response.text
+            raise HTTPException(status_code=400, detail=f"LINE Pay Error: {return_message} (Code: {return_code})")
 
         except httpx.RequestError as exc:
-            return_code, return_message, status = "9999", str(exc), "failed"
-            
-            
-           # ✅ 修正後的回應邏輯
+            raise HTTPException(status_code=400, detail=f"LINE Pay Error: {exc} (Code: 9999)")
+
+        # ✅ 新增 returnCode 判斷邏輯
+        return_code = line_pay_response.get("returnCode", "9999")  # 預設錯誤代碼
+        return_message = line_pay_response.get("returnMessage", "Unknown error")
         if return_code == "0000":
-            return {"status": "success", "data": line_pay_response}
+            status, result = "success", {"status": "success", "data": line_pay_response}
         else:
-            raise HTTPException(status_code=400, detail=f"LINE Pay Error: {return_message} (Code: {return_code})")
+            status = "failed"
+            result = error_response(400, f"LINE Pay Error: {return_message} (Code: {return_code})")
+
+        # ✅ 將交易記錄與回應存入 MySQL
+        await LinePayAPI.save_transaction(order_id, request, status, return_code, return_message, idempotency_key, result)
+        return result
 
     @staticmethod
-    async def save_transaction(order_id, request, status, return_code, return_message):
-        conn = await Database.get_connection()
-        async with conn.cursor() as cursor:
-            sql = """
-            INSERT INTO linepay_transactions (order_id, machine, barcode, amount, payway, status, return_code, return_message)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """
-            await cursor.execute(sql, (
-                order_id,
-                request.machine,
-                request.barcode,
-                request.amount,
-                request.payway,
-                status,
-                return_code,
-                return_message
-            ))
+    async def save_transaction(order_id, request, status, return_code, return_message,
+                               idempotency_key=None, response=None):
+        # ✅ 交易紀錄交給背景批次寫入，付款回應不再等待 MySQL
+        await TransactionRecorder.record(
+            order_id, request, status, return_code, return_message, idempotency_key, response
+        )
 
     @staticmethod
-    async def inquire(channel_id: str, channel_secret: str, order_id: str, test: int=0):
-        try:
-            # ✅ 使用 test 變數來判定環境
-            base_url = (
-                LinePayAPI.LINE_PAY_SANDBOX_URL if test == 1 else LinePayAPI.LINE_PAY_PRODUCTION_URL
-            )
-            url = f"{base_url}/orders/{order_id}/check"
+    def _base_url(test: int) -> str:
+        return LinePayAPI.LINE_PAY_SANDBOX_URL if test == 1 else LinePayAPI.LINE_PAY_PRODUCTION_URL
 
-            headers = {
-                "Content-Type": "application/json",
-                "X-LINE-ChannelId": channel_id,
-                "X-LINE-ChannelSecret": channel_secret,
-            }
+    @staticmethod
+    def _headers(channel_id: str, channel_secret: str) -> dict:
+        return {
+            "Content-Type": "application/json",
+            "X-LINE-ChannelId": channel_id,
+            "X-LINE-ChannelSecret": channel_secret,
+        }
+
+    @staticmethod
+    async def check_order(channel_id: str, channel_secret: str, order_id: str, test: int = 0) -> dict:
+        """查詢訂單狀態，HTTP 錯誤以 httpx 例外丟出（由呼叫端決定如何回應）。"""
+        url = f"{LinePayAPI._base_url(test)}/orders/{order_id}/check"
+        # ✅ 查詢可重送，允許 hedged request
+        response = await Resilience.request(
+            Upstreams.linepay_name(test), "GET", url, hedge=True,
+            headers=LinePayAPI._headers(channel_id, channel_secret),
+        )
+        response.raise_for_status()
+        return response.json()
 
-            async with httpx.AsyncClient() as client:
-                response = await client.get(url, headers=headers, timeout=20.0)
-                response.raise_for_status()
-                result = response.json()
+    @staticmethod
+    async def refund_order(channel_id: str, channel_secret: str, order_id: str, refund_amount: int,
+                           test: int = 0) -> dict:
+        url = f"{LinePayAPI._base_url(test)}/orders/{order_id}/refund"
+        response = await Resilience.request(
+            Upstreams.linepay_name(test), "POST", url, json={"refundAmount": refund_amount},
+            headers=LinePayAPI._headers(channel_id, channel_secret),
+        )
+        response.raise_for_status()
+        return response.json()
 
+    @staticmethod
+    async def inquire(channel_id: str, channel_secret: str, order_id: str, test: int=0):
+        try:
+            result = await LinePayAPI.check_order(channel_id, channel_secret, order_id, test)
             return {"status": "success", "data": result}
 
         except httpx.RequestError as exc:
@@ -169,37 +180,48 @@ class LinePayAPI:
 
 
     @staticmethod
-    async def refund(request: LinePayRefundRequest):
-        try:
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            payload = {"key": request.key, "machine": request.machine, "time": current_time}
-            async with httpx.AsyncClient() as client:
-                response = await client.post(LinePayAPI.API_B_URL, json=payload)
-                response.raise_for_status()
-            api_b_response = response.json()
+    async def credentials(key: str, machine: str):
+        settings = await CredentialCache.get(key, machine)
+        channel_id = (settings.get("LINE_ChannelId") or "").strip()
+        channel_secret = (settings.get("LINE_ChannelSecret") or "").strip()
+        return channel_id, channel_secret
 
-            data_items = api_b_response.get("data", [])
-            channel_id = data_items[0].get("LINE_ChannelId", "").strip()
-            channel_secret = data_items[0].get("LINE_ChannelSecret", "").strip()
+    @staticmethod
+    async def refund(request: LinePayRefundRequest):
+        channel_id, channel_secret = await LinePayAPI.credentials(request.key, request.machine)
 
-            base_url = (
-                LinePayAPI.LINE_PAY_SANDBOX_URL if request.test == 1 else LinePayAPI.LINE_PAY_PRODUCTION_URL
+        try:
+            result = await LinePayAPI.refund_order(
+                channel_id, channel_secret, request.orderId, request.refundAmount, request.test
             )
-            url = f"{base_url}/orders/{request.orderId}/refund"
-
-            body = {"refundAmount": request.refundAmount}
-            headers = {
-                "Content-Type": "application/json",
-                "X-LINE-ChannelId": channel_id,
-                "X-LINE-ChannelSecret": channel_secret,
-            }
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, json=body, headers=headers)
-                response.raise_for_status()
-                result = response.json()
-
             return {"status": "success", "data": result}
         except httpx.RequestError as exc:
             raise HTTPException(status_code=500, detail=f"Request failed: {exc}")
         except httpx.HTTPStatusError as exc:
-            raise HTTPException(status_code=exc.response.status_code, detail=f"Error: {exc.response.text}")
\ No newline at end of file
+            raise HTTPException(status_code=exc.response.status_code, detail=f"Error: {exc.response.text}")
+
+    @staticmethod
+    async def reconcile(record: dict):
+        """ReconciliationEngine 呼叫：查詢逾時訂單，尚無最終結果時回傳 None。"""
+        request = record["request"]
+        channel_id, channel_secret = await LinePayAPI.credentials(request["key"], request["machine"])
+
+        result = await LinePayAPI.inquire(channel_id, channel_secret, record["order_id"], request["test"])
+        data = result["data"]
+        return_code = data.get("returnCode", "9999")
+        return_message = data.get("returnMessage", "")
+        if return_code in LinePayAPI.CHECK_SUCCESS_CODES:
+            return "success", return_code, return_message, data
+        if return_code in LinePayAPI.CHECK_FAILED_CODES:
+            return "failed", return_code, return_message, data
+        return None
+
+    @staticmethod
+    def final_response(order_id: str, status: str, return_code: str, return_message: str, data):
+        """對帳取得最終結果後，同一筆付款重送時回傳的內容（與付款當下拿到結果時相同的格式）。"""
+        if status == "success":
+            return {"status": "success", "orderId": order_id, "data": data}
+        return error_response(400, f"LINE Pay Error: {return_message} (Code: {return_code})")
+
+
+ReconciliationEngine.register("linepay", LinePayAPI.reconcile, respond=LinePayAPI.final_response)
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import random
+from typing import List, Optional
+import httpx
+from fastapi import HTTPException
+from pydantic import BaseModel, Field
+from linepay import LinePayAPI
+from resilience import UpstreamUnavailable
+import config
+
+# 沒送到 LINE Pay 的錯誤，退款重送也不會重複退款
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, UpstreamUnavailable)
+
+
+# 定義批次查詢 / 退款的資料結構；項目未指定 machine 時使用請求層級的 machine
+class LinePayBatchOrder(BaseModel):
+    orderId: str
+    machine: Optional[str] = None
+
+class LinePayBatchInquireRequest(BaseModel):
+    key: str
+    machine: str
+    orders: List[LinePayBatchOrder] = Field(..., min_length=1, max_length=config.LINEPAY_BATCH_MAX_ITEMS)
+    test: int = 0
+
+class LinePayBatchRefundItem(BaseModel):
+    orderId: str
+    refundAmount: int
+    machine: Optional[str] = None
+
+class LinePayBatchRefundRequest(BaseModel):
+    key: str
+    machine: str
+    items: List[LinePayBatchRefundItem] = Field(..., min_length=1, max_length=config.LINEPAY_BATCH_MAX_ITEMS)
+    test: int = 0
+
+
+def _inquire_retryable(exc: Exception) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, (httpx.TransportError, UpstreamUnavailable))
+
+
+def _refund_retryable(exc: Exception) -> bool:
+    return isinstance(exc, _NOT_SENT)
+
+
+def _error_message(exc: Exception) -> str:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return f"HTTP {exc.response.status_code}: {exc.response.text}"
+    if isinstance(exc, HTTPException):
+        return str(exc.detail)
+    return f"{type(exc).__name__}: {exc}"
+
+
+class LinePayBatchAPI:
+    """批次查詢 / 退款：每個機台只取一次 B014 設定，以 CONCURRENCY 限制同時呼叫 LINE Pay 的數量，
+    每筆完成就以 NDJSON 回傳；失敗的項目個別重試。"""
+
+    CONCURRENCY = config.LINEPAY_BATCH_CONCURRENCY
+    RETRIES = config.LINEPAY_BATCH_RETRIES
+    RETRY_BACKOFF = config.LINEPAY_BATCH_RETRY_BACKOFF
+
+    @staticmethod
+    async def _resolve_credentials(key: str, machines) -> dict:
+        async def resolve(machine):
+            try:
+                channel_id, channel_secret = await LinePayAPI.credentials(key, machine)
+            except Exception as exc:
+                return machine, exc
+            if not channel_id or not channel_secret:
+                return machine, HTTPException(status_code=400, detail="金流未開放")
+            return machine, (channel_id, channel_secret)
+
+        return dict(await asyncio.gather(*(resolve(machine) for machine in machines)))
+
+    @classmethod
+    async def _call(cls, func, retryable):
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await func(), attempt
+            except Exception as exc:
+                if attempt > cls.RETRIES or not retryable(exc):
+                    exc.attempts = attempt
+                    raise
+                await asyncio.sleep(cls.RETRY_BACKOFF * (2 ** (attempt - 1)) * random.uniform(0.5, 1.0))
+
+    @classmethod
+    async def _run(cls, key: str, items, action, retryable):
+        """items 為 [(machine, orderId, 參數)]；action(channel_id, channel_secret, orderId, 參數)。"""
+        credentials = await cls._resolve_credentials(key, {machine for machine, _, _ in items})
+        semaphore = asyncio.Semaphore(cls.CONCURRENCY)
+
+        async def process(machine, order_id, argument):
+            result = {"orderId": order_id, "machine": machine}
+            resolved = credentials[machine]
+            if isinstance(resolved, Exception):
+                return dict(result, status="error", error=_error_message(resolved), attempts=0)
+            async with semaphore:
+                try:
+                    data, attempts = await cls._call(lambda: action(*resolved, order_id, argument), retryable)
+                except Exception as exc:
+                    return dict(result, status="error", error=_error_message(exc), attempts=getattr(exc, "attempts", 1))
+            return dict(result, status="success", data=data, attempts=attempts)
+
+        tasks = [asyncio.ensure_future(process(*item)) for item in items]
+        succeeded = failed = 0
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                if result["status"] == "success":
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # 用戶端中斷時不再繼續呼叫 LINE Pay
+            for task in tasks:
+                task.cancel()
+
+        yield json.dumps({"done": True, "total": len(items), "succeeded": succeeded, "failed": failed}) + "\n"
+
+    @classmethod
+    def inquire(cls, request: LinePayBatchInquireRequest):
+        items = [(order.machine or request.machine, order.orderId, None) for order in request.orders]
+
+        async def check(channel_id, channel_secret, order_id, _):
+            return await LinePayAPI.check_order(channel_id, channel_secret, order_id, request.test)
+
+        return cls._run(request.key, items, check, _inquire_retryable)
+
+    @classmethod
+    def refund(cls, request: LinePayBatchRefundRequest):
+        items = [(item.machine or request.machine, item.orderId, item.refundAmount) for item in request.items]
+
+        async def refund(channel_id, channel_secret, order_id, refund_amount):
+            return await LinePayAPI.refund_order(channel_id, channel_secret, order_id, refund_amount, request.test)
+
+        # 退款只在確定沒送出時重試，避免重複退款
+        return cls._run(request.key, items, refund, _refund_retryable)
@@ -0,0 +1,471 @@
+"""舊 log 的壓縮歸檔。
+
+每台機台每天一個歸檔檔（LOG_ARCHIVE_DIR/{machine}/{YYYY-MM-DD}.lga），內容為：
+
+    MAGIC | 區塊 ... | 索引（zlib 壓縮的 JSON） | 索引長度（8 bytes） | MAGIC
+
+每份 log 切成 LOG_ARCHIVE_BLOCK_SIZE 的區塊各自壓縮（gzip 或 zstd），索引記錄每個區塊的位置，
+第 i 個區塊對應原始內容的 [i * block_size, (i + 1) * block_size)。讀取時只解壓縮需要的區塊，
+ArchiveMember 提供可 seek 的 binary file 介面，logfile 的讀取函式不需要區分一般檔案或歸檔。
+"""
+import datetime
+import io
+import json
+import logging
+import os
+import struct
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from stat import S_ISREG
+from typing import NamedTuple, Optional
+import config
+import logfile
+
+try:
+    import zstandard
+except ImportError:  # 選用套件，未安裝時使用 gzip
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"LGARCH01"
+TRAILER = struct.Struct("<Q8s")
+SUFFIX = ".lga"
+
+
+class _Gzip:
+    name = "gzip"
+
+    def __init__(self, level: int):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        # wbits=31 產生 gzip member，同一份 log 的區塊接起來就是合法的多 member gzip
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zlib.decompress(data, 31)
+
+
+class _Zstd:
+    name = "zstd"
+
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _codec(name: str, level: int = 6):
+    if name == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd archive requires the zstandard package")
+        return _Zstd(level)
+    if name == "gzip":
+        return _Gzip(level)
+    raise ValueError(f"unknown archive codec: {name}")
+
+
+class ArchiveMember(io.RawIOBase):
+    """歸檔內單一 log 的唯讀檔案物件，只解壓縮讀到的區塊（保留最近一個）。"""
+
+    def __init__(self, path: Path, filename: str):
+        super().__init__()
+        self._f = open(path, "rb")
+        try:
+            index = LogArchive.read_index(path, self._f)
+            entry = index["files"][filename]
+            self._codec = _codec(entry["codec"])
+        except KeyError:
+            self._f.close()
+            raise FileNotFoundError(f"{filename} not in {path}")
+        except BaseException:
+            self._f.close()
+            raise
+        self._blocks = entry["blocks"]
+        self._block_size = index["block_size"]
+        self.size = entry["size"]
+        self._pos = 0
+        self._cached = (None, b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self._pos = offset
+        return offset
+
+    def _block(self, number: int) -> bytes:
+        if self._cached[0] != number:
+            offset, length = self._blocks[number]
+            self._f.seek(offset)
+            self._cached = (number, self._codec.decompress(self._f.read(length)))
+        return self._cached[1]
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.size - self._pos
+        if size is not None and 0 <= size < remaining:
+            remaining = size
+        parts = []
+        while remaining > 0:
+            number, within = divmod(self._pos, self._block_size)
+            data = self._block(number)[within:within + remaining]
+            if not data:
+                break
+            parts.append(data)
+            self._pos += len(data)
+            remaining -= len(data)
+        return b"".join(parts)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+class LogSource(NamedTuple):
+    """一份 log 的位置：一般檔案，或 archive 中名為 member 的項目。"""
+
+    machine: str
+    name: str
+    path: Path
+    size: int
+    mtime: float
+    mtime_ns: int
+    member: Optional[str] = None
+
+    @property
+    def archived(self) -> bool:
+        return self.member is not None
+
+    def open(self):
+        if self.member is not None:
+            return ArchiveMember(self.path, self.member)
+        try:
+            return self.path.open("rb")
+        except FileNotFoundError:
+            # 解析之後剛好被歸檔
+            found = LogArchive.find(self.machine, self.name, self.mtime)
+            if found is None:
+                raise
+            return ArchiveMember(found[0], self.name)
+
+
+class LogArchive:
+    """把超過 LOG_ARCHIVE_AFTER_DAYS 的 log 壓縮進每日歸檔，並提供查詢與讀取。
+
+    壓縮由 leader 的 log 保存期限排程執行（單一寫入者）；歸檔以暫存檔 + rename 更新，
+    讀取中的請求仍持有舊檔，不受影響。Windows 上使用中的檔案無法刪除或取代（PermissionError），
+    這類檔案跳過，下次排程再處理。
+    """
+
+    ENABLED = config.LOG_ARCHIVE_ENABLED
+    DIR = Path(config.LOG_ARCHIVE_DIR)
+    AFTER_DAYS = config.LOG_ARCHIVE_AFTER_DAYS
+    RETENTION_DAYS = config.LOG_ARCHIVE_RETENTION_DAYS
+    BLOCK_SIZE = config.LOG_ARCHIVE_BLOCK_SIZE
+    LEVEL = config.LOG_ARCHIVE_LEVEL
+    CACHE_SIZE = 1024
+
+    _indexes = OrderedDict()  # path → ((inode, mtime_ns, size), index)
+    _lock = threading.Lock()
+
+    @classmethod
+    def codec(cls):
+        if config.LOG_ARCHIVE_CODEC == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, archiving with gzip")
+            return _codec("gzip", cls.LEVEL)
+        return _codec(config.LOG_ARCHIVE_CODEC, cls.LEVEL)
+
+    # ---- 索引 ----
+    @classmethod
+    def read_index(cls, path: Path, f=None) -> dict:
+        """讀取歸檔索引，以 (inode, mtime, size) 快取；f 為已開啟的檔案時以該檔案為準。"""
+        own = f is None
+        if own:
+            f = open(path, "rb")
+        try:
+            stat = os.fstat(f.fileno())
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            with cls._lock:
+                cached = cls._indexes.get(str(path))
+                if cached is not None and cached[0] == key:
+                    cls._indexes.move_to_end(str(path))
+                    return cached[1]
+
+            if stat.st_size < len(MAGIC) + TRAILER.size:
+                raise ValueError(f"corrupt log archive: {path}")
+            f.seek(-TRAILER.size, os.SEEK_END)
+            length, magic = TRAILER.unpack(f.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError(f"corrupt log archive: {path}")
+            f.seek(-TRAILER.size - length, os.SEEK_END)
+            index = json.loads(zlib.decompress(f.read(length)))
+        finally:
+            if own:
+                f.close()
+
+        with cls._lock:
+            cls._indexes[str(path)] = (key, index)
+            while len(cls._indexes) > cls.CACHE_SIZE:
+                cls._indexes.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _day(mtime: float) -> str:
+        return datetime.date.fromtimestamp(mtime).isoformat()
+
+    @classmethod
+    def machines(cls):
+        if not cls.DIR.is_dir():
+            return []
+        return [entry.name for entry in os.scandir(cls.DIR) if entry.is_dir() and not entry.name.startswith(".")]
+
+    @classmethod
+    def archives(cls, machine: str):
+        """機台的歸檔檔，由舊到新。"""
+        machine_dir = cls.DIR / machine
+        if not machine_dir.is_dir():
+            return []
+        return sorted(
+            Path(entry.path) for entry in os.scandir(machine_dir)
+            if entry.is_file() and entry.name.endswith(SUFFIX) and not entry.name.startswith(".")
+        )
+
+    @classmethod
+    def list_files(cls, machine: str) -> dict:
+        """filename → (size, mtime, lines)；同名檔案以較新的歸檔為準。"""
+        files = {}
+        for path in cls.archives(machine):
+            try:
+                index = cls.read_index(path)
+            except (OSError, ValueError, zlib.error) as exc:
+                logger.error("skipping unreadable log archive %s: %s", path, exc)
+                continue
+            for name, entry in index["files"].items():
+                files[name] = (entry["size"], entry["mtime"], entry["lines"])
+        return files
+
+    @classmethod
+    def find(cls, machine: str, filename: str, mtime: float = None):
+        """回傳 (歸檔路徑, 索引項目)；有 mtime 時先查當天的歸檔，否則由新到舊尋找。"""
+        paths = cls.archives(machine)
+        if mtime is not None:
+            day = cls.DIR / machine / f"{cls._day(mtime)}{SUFFIX}"
+            if day in paths:
+                paths.remove(day)
+                paths.append(day)
+        for path in reversed(paths):
+            try:
+                entry = cls.read_index(path)["files"].get(filename)
+            except (OSError, ValueError, zlib.error):
+                continue
+            if entry is not None:
+                return path, entry
+        return None
+
+    @classmethod
+    def resolve(cls, base_dir: Path, machine: str, filename: str, mtime: float = None) -> LogSource:
+        """一般檔案優先，其次為歸檔；都不存在時 raise FileNotFoundError。"""
+        path = base_dir / machine / filename
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            stat = None
+        if stat is not None and S_ISREG(stat.st_mode):
+            return LogSource(machine, filename, path, stat.st_size, stat.st_mtime, stat.st_mtime_ns)
+
+        found = cls.find(machine, filename, mtime)
+        if found is None:
+            raise FileNotFoundError(filename)
+        archive_path, entry = found
+        return LogSource(
+            machine, filename, archive_path, entry["size"], entry["mtime"], entry["mtime_ns"], member=filename
+        )
+
+    # ---- 寫入 ----
+    @classmethod
+    def _write(cls, archive_path: Path, files):
+        """files 為 [(filename, 已開啟的一般檔案)]；與既有歸檔合併，同名的項目被取代。"""
+        codec = cls.codec()
+        previous = cls.read_index(archive_path) if archive_path.exists() else None
+        replaced = {name for name, _ in files}
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = archive_path.with_name(f".{archive_path.name}.{uuid.uuid4().hex}.tmp")
+        entries = {}
+        try:
+            with tmp_path.open("wb") as out:
+                out.write(MAGIC)
+                if previous is not None:
+                    # 既有項目的壓縮區塊直接複製，不重新壓縮
+                    with archive_path.open("rb") as src:
+                        for name, entry in previous["files"].items():
+                            if name in replaced:
+                                continue
+                            blocks = []
+                            for offset, length in entry["blocks"]:
+                                src.seek(offset)
+                                blocks.append([out.tell(), length])
+                                out.write(src.read(length))
+                            entries[name] = dict(entry, blocks=blocks)
+
+                for name, f in files:
+                    stat = os.fstat(f.fileno())
+                    counter = logfile.LineCounter()
+                    blocks = []
+                    f.seek(0)
+                    while block := f.read(cls.BLOCK_SIZE):
+                        counter.feed(block)
+                        data = codec.compress(block)
+                        blocks.append([out.tell(), len(data)])
+                        out.write(data)
+                    entries[name] = {
+                        "codec": codec.name,
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "lines": counter.lines,
+                        "blocks": blocks,
+                    }
+
+                index = zlib.compress(json.dumps({
+                    "version": 1, "block_size": cls.BLOCK_SIZE, "files": entries,
+                }, separators=(",", ":")).encode("utf-8"))
+                out.write(index)
+                out.write(TRAILER.pack(len(index), MAGIC))
+            os.replace(tmp_path, archive_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    @classmethod
+    def compact_machine(cls, machine_dir: Path, now: float):
+        """把機台超過 AFTER_DAYS 的 log 依修改日期併入每日歸檔，回傳已歸檔的路徑。
+
+        最新一份保留為一般檔案給 B010 狀態回報使用。
+        """
+        cutoff = now - cls.AFTER_DAYS * 86400
+        files = []
+        for entry in os.scandir(machine_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                files.append((entry.stat().st_mtime, Path(entry.path)))
+        files.sort()
+
+        by_day = {}
+        for mtime, path in files[:-1]:
+            if mtime < cutoff:
+                by_day.setdefault(cls._day(mtime), []).append(path)
+
+        archived = []
+        for day, paths in sorted(by_day.items()):
+            opened = []
+            try:
+                for path in paths:
+                    try:
+                        opened.append((path.name, path.open("rb")))
+                    except OSError:
+                        continue
+                if not opened:
+                    continue
+                try:
+                    cls._write(cls.DIR / machine_dir.name / f"{day}{SUFFIX}", opened)
+                except OSError as exc:
+                    # 例如 Windows 上歸檔正被讀取，無法取代
+                    logger.warning("could not archive %s/%s, retrying next sweep: %s", machine_dir.name, day, exc)
+                    continue
+                except (ValueError, zlib.error) as exc:
+                    # 既有歸檔損毀：只跳過這一天，不中斷其他日期與機台；原始 log 保留，依一般檔案的期限清除
+                    logger.error("existing log archive %s/%s is unreadable, leaving logs unarchived: %s",
+                                 machine_dir.name, day, exc)
+                    continue
+                for name, f in opened:
+                    stat = os.fstat(f.fileno())
+                    path = machine_dir / name
+                    # 歸檔期間重新上傳的檔案（rename 成新的 inode）保留，會在下次排程再歸檔
+                    try:
+                        current = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    if (current.st_ino, current.st_mtime_ns) == (stat.st_ino, stat.st_mtime_ns):
+                        try:
+                            path.unlink()
+                        except OSError as exc:
+                            # 已在歸檔中；一般檔案優先讀取，下次排程歸檔時取代同名項目
+                            logger.warning("could not remove archived log %s, retrying next sweep: %s", path, exc)
+                            continue
+                        archived.append(path)
+            finally:
+                for _, f in opened:
+                    f.close()
+        if archived:
+            logger.info("archived %d log files for %s", len(archived), machine_dir.name)
+        return archived
+
+    @classmethod
+    def usage(cls, machine: str):
+        """機台歸檔佔用的空間 [(最新一份 log 的 mtime, 歸檔大小, 路徑)]，由舊到新，供容量限制使用。"""
+        result = []
+        for path in cls.archives(machine):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            try:
+                mtime = max(entry["mtime"] for entry in cls.read_index(path)["files"].values())
+            except (OSError, ValueError, zlib.error):  # 無法讀取或是空的歸檔，以檔案本身的時間排序
+                mtime = stat.st_mtime
+            result.append((mtime, stat.st_size, path))
+        result.sort()
+        return result
+
+    @classmethod
+    def remove(cls, path: Path):
+        """刪除一個歸檔，回傳其中的 [(filename, mtime)]；無法刪除（Windows 上使用中）時回傳 None。"""
+        try:
+            entries = cls.read_index(path)["files"]
+        except (OSError, ValueError, zlib.error):
+            entries = {}
+        try:
+            path.unlink(missing_ok=True)
+        except OSError as exc:
+            logger.warning("could not delete log archive %s, retrying next sweep: %s", path, exc)
+            return None
+        logger.info("deleted log archive %s/%s", path.parent.name, path.name)
+        return [(name, entry["mtime"]) for name, entry in entries.items()]
+
+    @classmethod
+    def expire(cls, machine: str, now: float):
+        """刪除超過 RETENTION_DAYS 的歸檔，回傳被刪除的 [(filename, mtime)]。"""
+        cutoff = datetime.date.fromtimestamp(now - cls.RETENTION_DAYS * 86400).isoformat()
+        removed = []
+        for path in cls.archives(machine):
+            if path.name[:-len(SUFFIX)] >= cutoff:
+                break
+            removed.extend(cls.remove(path) or ())
+        return removed
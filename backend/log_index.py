@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+import config
+import logfile
+from log_archive import LogArchive
+from shared_state import SharedEvents
+
+logger = logging.getLogger(__name__)
+
+FileMeta = namedtuple("FileMeta", ["size", "mtime", "lines"])
+
+
+class LogIndex:
+    """機台 → log 檔（大小、修改時間、行數）的索引。
+
+    資料放在記憶體，同時寫入本機 SQLite；上傳與保存期限刪檔時更新，
+    啟動時先從 SQLite 載入，leader 再於背景與磁碟比對重建（大小與修改時間未變的檔案沿用既有行數），
+    已歸檔的 log 從歸檔索引讀取；重建期間的上傳與刪除記在 _changes，完成時套用在重建結果上。
+    其他 worker 只從 SQLite 載入，變更透過 SharedEvents 同步。
+    """
+
+    DB_PATH = Path(config.LOG_INDEX_DB_PATH)
+
+    _machines = {}
+    _loaded = False
+    _lock = threading.Lock()  # 保護 _machines，查詢會在事件迴圈中取得，只在記憶體操作時持有
+    _write_lock = threading.Lock()  # 依序寫入 SQLite 與記錄重建期間的變更，只在 thread 中取得
+    _changes = None  # 重建期間的 [(machine, filename, meta 或 None)]
+
+    # ---- SQLite ----
+    @classmethod
+    def _connect(cls) -> sqlite3.Connection:
+        cls.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(cls.DB_PATH, timeout=10)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS log_files (
+                machine TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                lines INTEGER NOT NULL,
+                PRIMARY KEY (machine, filename)
+            )
+        """)
+        return conn
+
+    # ---- 建立與維護 ----
+    @classmethod
+    def rebuild(cls, base_dir: Path):
+        with cls._write_lock:
+            cls._changes = []
+        conn = cls._connect()
+        try:
+            stored = {
+                (machine, filename): FileMeta(size, mtime, lines)
+                for machine, filename, size, mtime, lines in conn.execute(
+                    "SELECT machine, filename, size, mtime, lines FROM log_files"
+                )
+            }
+
+            # 已歸檔的檔案不在機台目錄中；同名時以一般檔案為準
+            machines = {
+                machine: {name: FileMeta(*meta) for name, meta in LogArchive.list_files(machine).items()}
+                for machine in LogArchive.machines()
+            }
+            for machine_entry in os.scandir(base_dir):
+                if not machine_entry.is_dir() or machine_entry.name.startswith("."):
+                    continue
+                files = machines.setdefault(machine_entry.name, {})
+                for entry in os.scandir(machine_entry.path):
+                    if not entry.is_file() or entry.name.startswith("."):
+                        continue
+                    stat = entry.stat()
+                    meta = stored.get((machine_entry.name, entry.name))
+                    if meta is None or meta.size != stat.st_size or meta.mtime != stat.st_mtime:
+                        with open(entry.path, "rb") as f:
+                            meta = FileMeta(stat.st_size, stat.st_mtime, logfile.count_lines(f))
+                    files[entry.name] = meta
+
+            with cls._write_lock:
+                # 掃描期間的上傳與刪除比掃描結果新
+                for machine, filename, meta in cls._changes:
+                    if meta is None:
+                        machines.get(machine, {}).pop(filename, None)
+                    else:
+                        machines.setdefault(machine, {})[filename] = meta
+                cls._changes = None
+                with conn:
+                    conn.execute("DELETE FROM log_files")
+                    conn.executemany(
+                        "INSERT INTO log_files (machine, filename, size, mtime, lines) VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (machine, filename, *meta)
+                            for machine, files in machines.items()
+                            for filename, meta in files.items()
+                        ],
+                    )
+                with cls._lock:
+                    cls._machines = machines
+                    cls._loaded = True
+        finally:
+            with cls._write_lock:
+                cls._changes = None
+            conn.close()
+        SharedEvents.publish("log_index", {"op": "reload"})
+
+    @classmethod
+    async def rebuild_in_background(cls, base_dir: Path):
+        """leader 工作：與磁碟比對重建，完成前以 SQLite 中的索引提供服務。"""
+        try:
+            await asyncio.to_thread(cls.rebuild, base_dir)
+        except Exception as exc:
+            logger.exception("log index rebuild failed, serving the persisted index: %s", exc)
+
+    @classmethod
+    def load(cls):
+        """從 SQLite 載入（不掃描磁碟）。"""
+        conn = cls._connect()
+        try:
+            machines = {}
+            for machine, filename, size, mtime, lines in conn.execute(
+                "SELECT machine, filename, size, mtime, lines FROM log_files"
+            ):
+                machines.setdefault(machine, {})[filename] = FileMeta(size, mtime, lines)
+        finally:
+            conn.close()
+        with cls._lock:
+            cls._machines = machines
+            cls._loaded = True
+
+    @classmethod
+    def _on_event(cls, event: dict):
+        # 其他 worker 已寫入 SQLite，這裡只更新記憶體
+        if event["op"] == "reload":
+            # 整份重新載入會讀取 SQLite，交給 thread，SharedEvents 會等它完成
+            return asyncio.to_thread(cls.load)
+        with cls._lock:
+            if event["op"] == "update":
+                cls._machines.setdefault(event["machine"], {})[event["filename"]] = FileMeta(*event["meta"])
+            elif event["op"] == "remove":
+                files = cls._machines.get(event["machine"])
+                if files is not None:
+                    files.pop(event["filename"], None)
+
+    @classmethod
+    async def ensure_loaded(cls, base_dir: Path):
+        if not cls._loaded:
+            await asyncio.to_thread(cls.rebuild, base_dir)
+
+    @classmethod
+    def update(cls, machine: str, filename: str, meta: FileMeta):
+        with cls._write_lock:
+            with cls._lock:
+                cls._machines.setdefault(machine, {})[filename] = meta
+            if cls._changes is not None:
+                cls._changes.append((machine, filename, meta))
+            conn = cls._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO log_files (machine, filename, size, mtime, lines) VALUES (?, ?, ?, ?, ?)",
+                        (machine, filename, *meta),
+                    )
+            finally:
+                conn.close()
+        SharedEvents.publish("log_index", {
+            "op": "update", "machine": machine, "filename": filename, "meta": list(meta),
+        })
+
+    @classmethod
+    def remove(cls, machine: str, filename: str):
+        with cls._write_lock:
+            with cls._lock:
+                files = cls._machines.get(machine)
+                if files is not None:
+                    files.pop(filename, None)
+            if cls._changes is not None:
+                cls._changes.append((machine, filename, None))
+            conn = cls._connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM log_files WHERE machine = ? AND filename = ?", (machine, filename))
+            finally:
+                conn.close()
+        SharedEvents.publish("log_index", {"op": "remove", "machine": machine, "filename": filename})
+
+    # ---- 查詢 ----
+    @classmethod
+    def has_machine(cls, machine: str) -> bool:
+        return machine in cls._machines
+
+    @classmethod
+    def get(cls, machine: str, filename: str):
+        with cls._lock:
+            return cls._machines.get(machine, {}).get(filename)
+
+    @classmethod
+    def latest(cls, machine: str):
+        with cls._lock:
+            files = cls._machines.get(machine)
+            if not files:
+                return None
+            return max(files.items(), key=lambda item: item[1].mtime)
+
+    @staticmethod
+    def _page(items, sort: str, order: str, offset: int, limit: int):
+        items.sort(key=lambda item: (item[sort], item["name"]), reverse=(order == "desc"))
+        total = len(items)
+        end = None if limit is None else offset + limit
+        return total, items[offset:end]
+
+    @classmethod
+    def list_files(cls, machine: str, sort="name", order="asc", offset=0, limit=None,
+                   mtime_from: float = None, mtime_to: float = None):
+        with cls._lock:
+            files = list(cls._machines.get(machine, {}).items())
+        items = [
+            {"name": name, "size": meta.size, "mtime": meta.mtime, "lines": meta.lines}
+            for name, meta in files
+            if (mtime_from is None or meta.mtime >= mtime_from) and (mtime_to is None or meta.mtime <= mtime_to)
+        ]
+        return cls._page(items, sort, order, offset, limit)
+
+    @classmethod
+    def list_machines(cls, sort="name", order="asc", offset=0, limit=None,
+                      mtime_from: float = None, mtime_to: float = None):
+        with cls._lock:
+            machines = [(machine, list(files.values())) for machine, files in cls._machines.items()]
+        items = []
+        for machine, files in machines:
+            matched = [
+                meta for meta in files
+                if (mtime_from is None or meta.mtime >= mtime_from) and (mtime_to is None or meta.mtime <= mtime_to)
+            ]
+            if (mtime_from is not None or mtime_to is not None) and not matched:
+                continue
+            items.append({
+                "name": machine,
+                "files": len(files),
+                "size": sum(meta.size for meta in files),
+                "mtime": max((meta.mtime for meta in files), default=0.0),
+            })
+        return cls._page(items, sort, order, offset, limit)
+
+
+SharedEvents.subscribe("log_index", LogIndex._on_event)
@@ -0,0 +1,400 @@
+import asyncio
+import json
+import mmap
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from log_index import LogIndex
+from log_archive import ArchiveMember, LogArchive
+import config
+import logfile
+
+NEWLINE = b"\n"
+ESCAPED_NEWLINE = logfile.ESCAPED_NEWLINE
+TOKEN_PATTERN = re.compile(rb"[A-Za-z0-9_]+")
+TAIL_TOKEN_PATTERN = re.compile(rb"[A-Za-z0-9_]+\Z")
+MIN_TOKEN = 2
+MAX_TOKEN = 64
+LINE_WINDOW = 4096
+SCAN_WINDOW = 1 << 20  # 每次 regex 搜尋的範圍（延伸到行尾），兩次搜尋之間檢查時間上限
+# (a+)+、(\w*)* 之類的巢狀量詞遇到不符合的長字串會指數回溯，執行緒中的 regex 無法中途取消
+NESTED_QUANTIFIER = re.compile(r"\((?:[^()\\]|\\.)*[+*}]\)[+*{]")
+
+
+# ---- 單一檔案掃描（在 thread / process pool 中執行，需為模組層級函式） ----
+# 分隔符號以 LINE_WINDOW 為單位往前 / 往後找：只用其中一種分隔的檔案，
+# 另一種的 find 不會每個符合都掃到檔頭 / 檔尾
+def _line_start(mm, pos: int) -> int:
+    high = pos
+    while high > 0:
+        low = max(0, high - LINE_WINDOW)
+        newline = mm.rfind(NEWLINE, low, high)
+        escaped = mm.rfind(ESCAPED_NEWLINE, max(0, low - 1), high)  # 可能跨在 low 兩側
+        if newline >= 0 or escaped >= 0:
+            return max(newline + 1, escaped + 2 if escaped >= 0 else 0)
+        high = low
+    return 0
+
+
+def _line_end(mm, pos: int, size: int) -> int:
+    low = pos
+    while low < size:
+        high = min(size, low + LINE_WINDOW)
+        ends = [index for index in (mm.find(NEWLINE, low, high), mm.find(ESCAPED_NEWLINE, low, high + 1))
+                if index >= 0]
+        if ends:
+            return min(ends)
+        low = high
+    return size
+
+
+def _next_line_start(mm, end: int) -> int:
+    return end + 1 if mm[end:end + 1] == NEWLINE else end + 2
+
+
+def _previous_line_end(mm, start: int) -> int:
+    return start - 1 if mm[start - 1:start] == NEWLINE else start - 2
+
+
+def _text(data: bytes) -> str:
+    return data.rstrip(b"\r").decode("utf-8", errors="replace")
+
+
+def _scan(mm, size: int, regex, context: int, limit: int, deadline: float = None):
+    """mm 為 mmap 或 bytes，回傳 [(行號, 該行, 前幾行, 後幾行)]；行以換行或字面 "\\n" 分隔。
+
+    超過 deadline（time.time()）時回傳已找到的部分。
+    """
+    results = []
+    line_no = 1
+    counted_to = 0
+    pos = 0
+    while pos < size:
+        if deadline is not None and time.time() >= deadline:
+            break
+        window_end = size if pos + SCAN_WINDOW >= size else _line_end(mm, pos + SCAN_WINDOW, size)
+        match = regex.search(mm, pos, window_end)
+        if match is None:
+            pos = window_end if window_end > pos else size
+            continue
+        start = _line_start(mm, match.start())
+        chunk = mm[counted_to:start]
+        line_no += chunk.count(NEWLINE) + chunk.count(ESCAPED_NEWLINE)
+        counted_to = start
+        end = _line_end(mm, match.start(), size)
+
+        before = []
+        cursor = start
+        while len(before) < context and cursor > 0:
+            previous_end = _previous_line_end(mm, cursor)
+            cursor = _line_start(mm, previous_end)
+            before.insert(0, _text(mm[cursor:previous_end]))
+
+        after = []
+        cursor = end
+        while len(after) < context and cursor < size:
+            following = _next_line_start(mm, cursor)
+            if following >= size:
+                break
+            cursor = _line_end(mm, following, size)
+            after.append(_text(mm[following:cursor]))
+
+        results.append((line_no, _text(mm[start:end]), before, after))
+        if len(results) >= limit:
+            break
+        # 同一行只回報一次，從下一行繼續找
+        pos = _next_line_start(mm, end) if end < size else size
+    return results
+
+
+def scan_file(path: str, pattern: bytes, flags: int, context: int, limit: int, deadline: float = None):
+    """以 mmap 掃描檔案；檔案不存在（可能已歸檔）時回傳 None。"""
+    regex = re.compile(pattern, flags)
+    try:
+        with open(path, "rb") as f:
+            size = f.seek(0, 2)
+            if size == 0:
+                return []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _scan(mm, size, regex, context, limit, deadline)
+    except FileNotFoundError:
+        return None
+
+
+def scan_archived(path: str, filename: str, pattern: bytes, flags: int, context: int, limit: int,
+                  deadline: float = None):
+    """掃描歸檔內的 log：整份解壓縮到記憶體後以相同方式掃描。"""
+    try:
+        with ArchiveMember(Path(path), filename) as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return _scan(data, len(data), re.compile(pattern, flags), context, limit, deadline)
+
+
+def tokenize_file(path: str) -> set:
+    """取出檔案中的英數字 token（小寫），字面 "\\n" 視為分隔。"""
+    tokens = set()
+    carry = b""
+    with open(path, "rb") as f:
+        for chunk in logfile.unescape_chunks(logfile.iter_range(f)):
+            data = carry + chunk
+            # 結尾可能切在 token 中間，留到下一段
+            tail = TAIL_TOKEN_PATTERN.search(data, max(0, len(data) - MAX_TOKEN - 1))
+            split = tail.start() if tail else len(data)
+            carry = data[split:]
+            for token in TOKEN_PATTERN.findall(data, 0, split):
+                if MIN_TOKEN <= len(token) <= MAX_TOKEN:
+                    tokens.add(token.lower().decode("ascii"))
+    for token in TOKEN_PATTERN.findall(carry):
+        if MIN_TOKEN <= len(token) <= MAX_TOKEN:
+            tokens.add(token.lower().decode("ascii"))
+    return tokens
+
+
+class SearchIndex:
+    """選用的 token 索引（SQLite）：上傳時更新，用來縮小需要掃描的檔案範圍。
+
+    只有查詢字串中左右都被非英數字元包住的詞（必須完整出現），
+    以及左邊被包住、位於結尾的詞（以此開頭的 token）會用來篩選。
+    查詢字串與建立索引時相同，字面 "\\n" 先換成換行：分隔之後的詞是一行的開頭（左邊有邊界），
+    不能連同 "n" 當成一個 token，否則該行第一個詞的檔案會被排除。
+    """
+
+    DB_PATH = Path(config.SEARCH_INDEX_DB_PATH)
+    ENABLED = config.SEARCH_INDEX_ENABLED
+    _lock = threading.Lock()
+
+    @classmethod
+    def _connect(cls) -> sqlite3.Connection:
+        cls.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(cls.DB_PATH, timeout=30)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS indexed_files (
+                machine TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                PRIMARY KEY (machine, filename)
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                token TEXT NOT NULL,
+                machine TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                PRIMARY KEY (token, machine, filename)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_file ON postings (machine, filename);
+        """)
+        return conn
+
+    @classmethod
+    def index_file(cls, machine: str, filename: str, path: Path, mtime: float):
+        tokens = tokenize_file(str(path))
+        with cls._lock:
+            conn = cls._connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM postings WHERE machine = ? AND filename = ?", (machine, filename))
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO postings (token, machine, filename) VALUES (?, ?, ?)",
+                        [(token, machine, filename) for token in tokens],
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO indexed_files (machine, filename, mtime) VALUES (?, ?, ?)",
+                        (machine, filename, mtime),
+                    )
+            finally:
+                conn.close()
+
+    @classmethod
+    def remove_file(cls, machine: str, filename: str):
+        if not cls.ENABLED:
+            return
+        with cls._lock:
+            conn = cls._connect()
+            try:
+                with conn:
+                    conn.execute("DELETE FROM postings WHERE machine = ? AND filename = ?", (machine, filename))
+                    conn.execute("DELETE FROM indexed_files WHERE machine = ? AND filename = ?", (machine, filename))
+            finally:
+                conn.close()
+
+    @staticmethod
+    def query_terms(q: str):
+        """回傳 (必須完整出現的 token, 必須以此開頭的 token)。"""
+        exact, prefix = set(), set()
+        raw = q.encode("utf-8").replace(ESCAPED_NEWLINE, NEWLINE)
+        for match in TOKEN_PATTERN.finditer(raw):
+            token = match.group().lower().decode("ascii")
+            if not MIN_TOKEN <= len(token) <= MAX_TOKEN or match.start() == 0:
+                continue
+            if match.end() < len(raw):
+                exact.add(token)
+            else:
+                prefix.add(token)
+        return exact, prefix
+
+    @classmethod
+    def filter_candidates(cls, q: str, candidates):
+        """依索引排除不可能符合的檔案；未建立索引的檔案一律保留。"""
+        exact, prefix = cls.query_terms(q)
+        if not exact and not prefix:
+            return candidates
+
+        conn = cls._connect()
+        try:
+            indexed = {
+                (machine, filename, mtime)
+                for machine, filename, mtime in conn.execute("SELECT machine, filename, mtime FROM indexed_files")
+            }
+            matched = None
+            for token in exact:
+                files = set(conn.execute(
+                    "SELECT machine, filename FROM postings WHERE token = ?", (token,)
+                ).fetchall())
+                matched = files if matched is None else matched & files
+            for token in prefix:
+                files = set(conn.execute(
+                    "SELECT machine, filename FROM postings WHERE token >= ? AND token < ?",
+                    (token, token + "\x7f"),
+                ).fetchall())
+                matched = files if matched is None else matched & files
+        finally:
+            conn.close()
+
+        return [
+            (machine, filename, mtime) for machine, filename, mtime in candidates
+            if (machine, filename, mtime) not in indexed or (machine, filename) in matched
+        ]
+
+
+class LogSearch:
+    WORKERS = config.SEARCH_WORKERS
+    TIMEOUT = config.SEARCH_TIMEOUT
+    _executor = None
+
+    @classmethod
+    def _get_executor(cls):
+        if cls._executor is None:
+            if config.SEARCH_EXECUTOR == "process":
+                cls._executor = ProcessPoolExecutor(max_workers=cls.WORKERS)
+            else:
+                cls._executor = ThreadPoolExecutor(max_workers=cls.WORKERS, thread_name_prefix="log-search")
+        return cls._executor
+
+    @classmethod
+    def shutdown(cls):
+        if cls._executor is not None:
+            cls._executor.shutdown(wait=False, cancel_futures=True)
+            cls._executor = None
+
+    @staticmethod
+    def check_pattern(q: str):
+        """檢查使用者提供的 regex，不接受的寫法丟出 ValueError（訊息可直接回給用戶端）。"""
+        try:
+            compiled = re.compile(q.encode("utf-8"))
+        except re.error as exc:
+            raise ValueError(f"Invalid regex: {exc}")
+        if compiled.search(b"") is not None:
+            raise ValueError("Regex must not match an empty string")
+        if NESTED_QUANTIFIER.search(q):
+            raise ValueError("Regex must not contain nested quantifiers such as (a+)+")
+
+    @staticmethod
+    def _candidates(machine: str = None, since: float = None, until: float = None):
+        names = [machine] if machine else [item["name"] for item in LogIndex.list_machines()[1]]
+        candidates = []
+        for name in names:
+            _, files = LogIndex.list_files(name, sort="mtime", order="desc", mtime_from=since, mtime_to=until)
+            candidates.extend((name, item["name"], item["mtime"]) for item in files)
+        return candidates
+
+    @classmethod
+    async def search(cls, base_dir: Path, q: str, machine: str = None, since: float = None,
+                     until: float = None, regex: bool = False, ignore_case: bool = True,
+                     context: int = 0, limit: int = 1000):
+        """依序產生 NDJSON：每個符合的行一筆，最後一筆為統計。
+
+        WORKERS 個 worker 依序取檔案掃描，結果經有上限的佇列交給輸出端；
+        超過 TIMEOUT 時停止並回傳已找到的結果（統計中 timed_out 為 true）。
+        """
+        await LogIndex.ensure_loaded(base_dir)
+        candidates = cls._candidates(machine, since, until)
+        if SearchIndex.ENABLED and not regex:
+            candidates = await asyncio.to_thread(SearchIndex.filter_candidates, q, candidates)
+
+        pattern = q.encode("utf-8") if regex else re.escape(q.encode("utf-8"))
+        flags = re.IGNORECASE if ignore_case else 0
+        loop = asyncio.get_running_loop()
+        executor = cls._get_executor()
+        # 掃描在其他 thread / process 中檢查 time.time()，事件迴圈這邊以 loop.time() 等待
+        deadline = time.time() + cls.TIMEOUT
+        loop_deadline = loop.time() + cls.TIMEOUT
+
+        async def scan(machine_id, filename, mtime):
+            path = str(base_dir / machine_id / filename)
+            results = await loop.run_in_executor(
+                executor, scan_file, path, pattern, flags, context, limit, deadline
+            )
+            if results is None:
+                found = await asyncio.to_thread(LogArchive.find, machine_id, filename, mtime)
+                results = [] if found is None else await loop.run_in_executor(
+                    executor, scan_archived, str(found[0]), filename, pattern, flags, context, limit, deadline
+                )
+            return machine_id, filename, results
+
+        pending = iter(candidates)  # 所有 worker 共用，每個檔案只會被取走一次
+        finished = asyncio.Queue(maxsize=cls.WORKERS * 2)
+
+        async def worker():
+            try:
+                for candidate in pending:
+                    if time.time() >= deadline:
+                        break
+                    await finished.put(await scan(*candidate))
+            except Exception as exc:
+                await finished.put(exc)
+            await finished.put(None)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(cls.WORKERS, len(candidates)))]
+        running = len(workers)
+        matches = 0
+        timed_out = False
+        try:
+            while running:
+                try:
+                    async with asyncio.timeout_at(loop_deadline):
+                        item = await finished.get()
+                except TimeoutError:
+                    timed_out = True
+                    break
+                if item is None:
+                    running -= 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                machine_id, filename, results = item
+                for line_no, text, before, after in results:
+                    record = {"machine": machine_id, "file": filename, "line": line_no, "text": text}
+                    if context:
+                        record["before"] = before
+                        record["after"] = after
+                    yield json.dumps(record, ensure_ascii=False) + "\n"
+                    matches += 1
+                    if matches >= limit:
+                        break
+                if matches >= limit:
+                    break
+        finally:
+            for task in workers:
+                task.cancel()
+
+        yield json.dumps({
+            "done": True,
+            "matches": matches,
+            "files": len(candidates),
+            "truncated": matches >= limit,
+            "timed_out": timed_out or (matches < limit and time.time() >= deadline),
+        }) + "\n"
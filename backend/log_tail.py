@@ -0,0 +1,298 @@
+"""機台 log 的即時追蹤（Server-Sent Events）。
+
+每台有人在看的機台只有一個 MachineWatcher：定期檢查機台目錄，讀取新增的內容後分送給所有訂閱者，
+看的人再多也只讀一次檔案。每個訂閱者有固定大小的佇列，用戶端讀太慢、佇列滿時丟掉積壓的事件，
+改送一個 lagged 事件（含丟棄數量），用戶端可依事件中的 offset 以下載 API 的 Range 補齊。
+
+事件（data 皆為 JSON，字面 "\\n" 已轉為換行）：
+    append   {"file", "offset", "end", "text"}    檔案新增的內容
+    file     {"file", "size", "rotated"}          新檔案或整份被取代（之後的 append 從新檔案開始）
+    removed  {"file"}                             檔案被刪除或歸檔
+    lagged   {"dropped"}                          積壓的事件被丟棄
+事件 id 為 "{file}@{end}"，斷線重連時瀏覽器送回的 Last-Event-ID 會從該位置繼續。
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import namedtuple
+from pathlib import Path
+from fastapi import HTTPException
+import config
+import logfile
+import metrics
+from log_archive import LogArchive
+
+logger = logging.getLogger(__name__)
+
+# position 為已送出的位置；recent 為 position 之前的一小段內容，用來判斷被取代的檔案是否只是變長
+FileState = namedtuple("FileState", ["ino", "size", "mtime", "position", "recent"])
+RECENT_BYTES = 64
+
+
+def _complete(data: bytes) -> int:
+    """data 中可以安全送出的長度：不切斷 UTF-8 字元，也不切斷字面 "\\n"。"""
+    end = len(data)
+    if data.endswith(b"\\"):
+        end -= 1
+    # 往前找最後一個字元的起始位元組，若該字元不完整就留到下一次
+    for back in range(1, min(4, end) + 1):
+        byte = data[end - back]
+        if byte & 0xC0 == 0x80:
+            continue
+        if byte >= 0xC0:
+            length = 2 if byte < 0xE0 else 3 if byte < 0xF0 else 4
+            if back < length:
+                end -= back
+        break
+    return end
+
+
+def _text(data: bytes) -> str:
+    return data.replace(logfile.ESCAPED_NEWLINE, b"\n").decode("utf-8", errors="replace")
+
+
+def _scan(machine_dir: Path) -> dict:
+    files = {}
+    try:
+        entries = list(os.scandir(machine_dir))
+    except FileNotFoundError:
+        return files
+    for entry in entries:
+        if entry.is_file() and not entry.name.startswith("."):
+            stat = entry.stat()
+            files[entry.name] = (stat.st_ino, stat.st_size, stat.st_mtime)
+    return files
+
+
+def _read(path: Path, start: int, end: int) -> bytes:
+    with path.open("rb") as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def _line_aligned_tail(path: Path, size: int, limit: int):
+    """回傳 (起點, 內容)：最後 limit bytes 內、從完整一行開始的內容。"""
+    start = max(0, size - limit)
+    data = _read(path, start, size)
+    if start > 0:
+        newline = max(data.find(b"\n"), data.find(logfile.ESCAPED_NEWLINE))
+        if newline >= 0:
+            skip = newline + (1 if data[newline:newline + 1] == b"\n" else 2)
+            start, data = start + skip, data[skip:]
+    return start, data
+
+
+class _Subscriber:
+    def __init__(self, filename: str, queue_size: int):
+        self.filename = filename  # None 表示追蹤機台所有檔案
+        self.queue = asyncio.Queue(queue_size)
+
+    def offer(self, event: dict):
+        if self.filename is not None and event.get("file") not in (None, self.filename):
+            return
+        if self.queue.full():
+            # 讀太慢：丟掉積壓的事件，只保留 lagged 與最新一筆
+            dropped = 0
+            while not self.queue.empty():
+                previous = self.queue.get_nowait()
+                dropped += previous.get("dropped", 1) if previous["event"] == "lagged" else 1
+            self.queue.put_nowait({"event": "lagged", "dropped": dropped})
+            LogTail.DROPPED.inc(dropped)
+        self.queue.put_nowait(event)
+
+
+class MachineWatcher:
+    def __init__(self, machine_dir: Path):
+        self.machine_dir = machine_dir
+        self.states = {}  # 只在 event loop 中整份替換，讀取不需要鎖
+        self.subscribers = set()
+        self.ready = asyncio.Event()
+        self._task = None
+
+    def _changes(self, states: dict):
+        """在 thread 中執行：比對目錄，回傳 (新狀態, 事件)；不修改傳入的狀態。"""
+        limit = config.LOG_TAIL_MAX_CHUNK
+        new_states, events = {}, []
+        for name, (ino, size, mtime) in _scan(self.machine_dir).items():
+            path = self.machine_dir / name
+            state = states.get(name)
+            try:
+                if state is not None and state.ino != ino and state.position <= size:
+                    # 重新上傳（rename 成新檔）：原本送出的結尾仍相同就視為附加
+                    start = state.position - len(state.recent)
+                    if _read(path, start, state.position) != state.recent:
+                        state = None
+                    else:
+                        state = state._replace(ino=ino)
+                if state is None or state.ino != ino or size < state.position:
+                    start, data = _line_aligned_tail(path, size, limit)
+                    events.append({"event": "file", "file": name, "size": size, "rotated": state is not None})
+                elif size > state.position:
+                    start = state.position
+                    if size - start > limit:
+                        start = size - limit
+                    data = _read(path, start, size)
+                else:
+                    new_states[name] = state._replace(size=size, mtime=mtime)
+                    continue
+            except FileNotFoundError:
+                continue  # 讀取前被刪除，下一輪會送出 removed
+
+            end = start + _complete(data)
+            if end > start:
+                events.append({
+                    "event": "append", "file": name, "offset": start, "end": end, "text": _text(data[:end - start]),
+                })
+            recent = (state.recent if state is not None else b"") + data[:end - start]
+            new_states[name] = FileState(ino, size, mtime, end, recent[-RECENT_BYTES:])
+
+        for name in states.keys() - new_states.keys():
+            events.append({"event": "removed", "file": name})
+        return new_states, events
+
+    def _prime(self):
+        return {
+            name: FileState(ino, size, mtime, size, _read(self.machine_dir / name, max(0, size - RECENT_BYTES), size))
+            for name, (ino, size, mtime) in _scan(self.machine_dir).items()
+        }
+
+    async def _run(self):
+        try:
+            self.states = await asyncio.to_thread(self._prime)
+        finally:
+            self.ready.set()
+        while True:
+            await asyncio.sleep(config.LOG_TAIL_POLL_INTERVAL)
+            try:
+                states, events = await asyncio.to_thread(self._changes, self.states)
+            except OSError as exc:
+                logger.warning("log tail poll failed for %s: %s", self.machine_dir.name, exc)
+                continue
+            # ✅ 狀態更新與分送之間沒有 await，新訂閱者取得的位置與之後收到的事件一定銜接
+            self.states = states
+            for event in events:
+                for subscriber in list(self.subscribers):
+                    subscriber.offer(event)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name=f"log-tail-{self.machine_dir.name}")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class LogTail:
+    MAX_SUBSCRIBERS = config.LOG_TAIL_MAX_SUBSCRIBERS
+    DROPPED = metrics.Counter("log_tail_dropped_events_total", "Live tail events dropped for slow clients")
+
+    _watchers = {}
+
+    @classmethod
+    def subscribers(cls) -> int:
+        return sum(len(watcher.subscribers) for watcher in cls._watchers.values())
+
+    @classmethod
+    async def _subscribe(cls, base_dir: Path, machine: str, filename: str):
+        watcher = cls._watchers.get(machine)
+        if watcher is None:
+            watcher = cls._watchers[machine] = MachineWatcher(base_dir / machine)
+            watcher.start()
+        subscriber = _Subscriber(filename, config.LOG_TAIL_QUEUE_SIZE)
+        watcher.subscribers.add(subscriber)
+        try:
+            await watcher.ready.wait()
+        except BaseException:
+            cls._unsubscribe(machine, watcher, subscriber)
+            raise
+        return watcher, subscriber
+
+    @classmethod
+    def _unsubscribe(cls, machine: str, watcher: MachineWatcher, subscriber: _Subscriber):
+        watcher.subscribers.discard(subscriber)
+        if not watcher.subscribers and cls._watchers.get(machine) is watcher:
+            watcher.stop()
+            del cls._watchers[machine]
+
+    @staticmethod
+    def parse_event_id(event_id: str):
+        name, _, end = (event_id or "").rpartition("@")
+        if not name or not end.isdigit():
+            return None, None
+        return name, int(end)
+
+    @staticmethod
+    def _format(event: dict) -> str:
+        kind = event.pop("event")
+        lines = [f"event: {kind}"]
+        if kind == "append":
+            lines.append(f"id: {event['file']}@{event['end']}")
+        lines.append("data: " + json.dumps(event, ensure_ascii=False))
+        return "\n".join(lines) + "\n\n"
+
+    @staticmethod
+    def _backfill(base_dir: Path, machine: str, filename: str, position: int, offset: int, lines: int):
+        """訂閱當下到 position 為止的歷史內容（一般檔案或歸檔皆可）。"""
+        source = LogArchive.resolve(base_dir, machine, filename)
+        end = source.size if position is None else min(position, source.size)
+        with source.open() as f:
+            if offset is not None:
+                start = max(min(offset, end), end - config.LOG_TAIL_MAX_CHUNK)
+                data = b"".join(logfile.iter_range(f, start, end))
+                end = start + _complete(data)
+                return {"event": "append", "file": filename, "offset": start, "end": end,
+                        "text": _text(data[:end - start])}
+            text = "\n".join(logfile.tail_lines(f, end, lines))
+            return {"event": "append", "file": filename, "offset": None, "end": end,
+                    "text": text + "\n" if text else ""}
+
+    @classmethod
+    async def stream(cls, base_dir: Path, machine: str, filename: str = None, offset: int = None,
+                     lines: int = None):
+        """產生 SSE 內容：先送出歷史內容（offset 起或最後 lines 行），再持續送出新內容。"""
+        if cls.subscribers() >= cls.MAX_SUBSCRIBERS:
+            raise HTTPException(status_code=503, detail="Too many live tail viewers", headers={"Retry-After": "30"})
+
+        async def events():
+            # 在開始送出時才訂閱，回應沒有被送出時不會留下訂閱者
+            watcher, subscriber = await cls._subscribe(base_dir, machine, filename)
+            try:
+                target = filename
+                if target is None and watcher.states:
+                    target = max(watcher.states, key=lambda name: watcher.states[name].mtime)
+                state = watcher.states.get(target) if target else None
+                yield "retry: 3000\n\n"
+                if target is not None:
+                    try:
+                        first = await asyncio.to_thread(
+                            cls._backfill, base_dir, machine, target, state.position if state else None,
+                            offset, lines if lines is not None else config.LOG_VIEW_DEFAULT_LINES,
+                        )
+                    except FileNotFoundError:
+                        first = None
+                    if first is not None and (first["text"] or offset is not None):
+                        yield cls._format(first)
+
+                while True:
+                    try:
+                        event = await asyncio.wait_for(subscriber.queue.get(), config.LOG_TAIL_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        yield ": ping\n\n"  # 保持連線，也讓中斷的連線盡早被發現
+                        continue
+                    yield cls._format(dict(event))
+            finally:
+                cls._unsubscribe(machine, watcher, subscriber)
+
+        return events()
+
+
+metrics.Gauge(
+    "log_tail_subscribers", "Live log tail viewers on this worker",
+    callback=lambda: {(): LogTail.subscribers()},
+)
+metrics.Gauge(
+    "log_tail_watchers", "Machines with an active live tail watcher on this worker",
+    callback=lambda: {(): len(LogTail._watchers)},
+)
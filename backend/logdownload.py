@@ -1,92 +1,308 @@
 from pathlib import Path
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
 import datetime
-import aiohttp
 import asyncio
-from fastapi import UploadFile, HTTPException
-from fastapi.responses import HTMLResponse
+import html
+import logging
+import os
+import re
+import time
+import uuid
+import zlib
+import httpx
+from fastapi import Request, UploadFile, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
+from resilience import Resilience, UpstreamUnavailable
+import config
+import logfile
+import metrics
+from log_index import LogIndex, FileMeta
+from log_archive import LogArchive, LogSource
+from b010_parser import B010StatusParser
+from log_search import SearchIndex
+from telemetry import Telemetry
+from lifecycle import Lifecycle
+
+logger = logging.getLogger(__name__)
 
 # 設定基礎目錄
-BASE_DIR = Path("./logs")
+BASE_DIR = Path(config.LOG_DIR)
 BASE_DIR.mkdir(exist_ok=True)
 
-B010_API_URL = "https://unibuy.com.tw/Unibuy/api/app/machine/status/B010"
+B010_API_URL = config.B010_URL
+B010_PARSER = B010StatusParser()
+
+UPLOAD_PATH = re.compile(r"/api/machine/[^/]+/log/update")
+UPLOAD_OVERHEAD = 64 * 1024  # multipart 的邊界與表頭，不屬於檔案內容
+
+
+def safe_name(name: str) -> str:
+    # 避免 ../ 之類的路徑跳脫，也排除上傳中的暫存檔（以 . 開頭）
+    if not name or name != Path(name).name or name.startswith("."):
+        raise HTTPException(status_code=400, detail="Invalid file name")
+    return name
+
+
+class UploadLimitMiddleware:
+    """在解析 multipart 之前限制上傳大小（ASGI middleware）。
+
+    UploadFile 參數在進入 upload_log 之前就已由 Starlette 把整個 body 寫進暫存檔，
+    upload_log 內的檢查擋不住過大的上傳；這裡先看 Content-Length，
+    沒有或不實時以實際收到的 bytes 計算，超過就回 413，不再繼續接收。
+    """
+
+    def __init__(self, app, limit: int = None):
+        self.app = app
+        self.limit = (config.LOG_UPLOAD_MAX_BYTES if limit is None else limit) + UPLOAD_OVERHEAD
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or not UPLOAD_PATH.fullmatch(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if length.isdigit() and int(length) > self.limit:
+            await JSONResponse({"detail": "File too large"}, status_code=413)(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            if received > self.limit:
+                # 表單解析中丟出，由 FastAPI 轉成 413 回應
+                raise HTTPException(status_code=413, detail="File too large")
+            return message
+
+        await self.app(scope, limited_receive, send)
 
 
 class LogAPI:
     @staticmethod
     async def upload_log(machine_id: str, file: UploadFile):
-        machine_dir = BASE_DIR / machine_id
-        machine_dir.mkdir(exist_ok=True)
-        
-          # 刪除超過 1 個月的 log 檔案
-        await LogAPI.delete_old_logs(machine_dir)
-        
+        machine_dir = BASE_DIR / safe_name(machine_id)
+
         # 使用上傳檔案原始檔名作為檔名
-        file_name = file.filename
-        if not file_name:
-            raise HTTPException(status_code=400, detail="Invalid file name")
-        
+        file_name = safe_name(Path(file.filename or "").name)
         file_path = machine_dir / file_name
 
-        with file_path.open("wb") as buffer:
-            buffer.write(await file.read())
+        # ✅ 分段寫入暫存檔再 rename，讀寫都不佔用 event loop
+        await asyncio.to_thread(machine_dir.mkdir, exist_ok=True)
+        tmp_path = machine_dir / f".{file_name}.{uuid.uuid4().hex}.tmp"
+        buffer = await asyncio.to_thread(tmp_path.open, "wb")
+        try:
+            size = 0
+            counter = logfile.LineCounter()
+            while chunk := await file.read(config.LOG_UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > config.LOG_UPLOAD_MAX_BYTES:
+                    raise HTTPException(status_code=413, detail="File too large")
+                counter.feed(chunk)
+                await asyncio.to_thread(buffer.write, chunk)
+            await asyncio.to_thread(buffer.close)
+            await asyncio.to_thread(os.replace, tmp_path, file_path)
+        except BaseException:
+            await asyncio.to_thread(buffer.close)
+            await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+            raise
+
+        stat = await asyncio.to_thread(file_path.stat)
+        await asyncio.to_thread(
+            LogIndex.update, machine_dir.name, file_name, FileMeta(stat.st_size, stat.st_mtime, counter.lines)
+        )
+        if SearchIndex.ENABLED:
+            # 搜尋索引於背景更新，不影響上傳回應時間
+            Lifecycle.spawn(asyncio.to_thread(
+                SearchIndex.index_file, machine_dir.name, file_name, file_path, stat.st_mtime
+            ))
+        if Telemetry.ENABLED:
+            Lifecycle.spawn(asyncio.to_thread(
+                LogAPI.ingest_telemetry, machine_dir.name, file_path, stat.st_mtime
+            ))
 
         return {"status": "success", "message": "File uploaded", "filename": file_name}
-    
+
+    @staticmethod
+    def ingest_telemetry(machine_id: str, file_path: Path, timestamp: float):
+        # ✅ 與 B010 共用解析器，只讀檔尾；同時預先建立 B010 下次回報需要的解析狀態
+        try:
+            Telemetry.append(machine_id, timestamp, B010_PARSER.parse(file_path))
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            logger.error("failed to record telemetry for %s: %s", machine_id, exc)
+
     @staticmethod
     async def delete_old_logs(machine_dir: Path):
-        one_month_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-        for file in machine_dir.iterdir():
-            if file.is_file() and datetime.datetime.fromtimestamp(file.stat().st_mtime) < one_month_ago:
-                file.unlink()
-                print(f"Deleted old log file: {file.name}")
-    
+        await asyncio.to_thread(LogRetention.sweep_machine, machine_dir, time.time())
 
     @staticmethod
-    async def download_log(machine_id: str, filename: str):
-        file_path = BASE_DIR / machine_id / filename
-        if not file_path.exists():
+    async def _source(machine_id: str, filename: str) -> LogSource:
+        """找出 log 的位置：一般檔案或壓縮歸檔，兩者的讀取方式相同。"""
+        machine_id, filename = safe_name(machine_id), safe_name(filename)
+        meta = LogIndex.get(machine_id, filename)
+        try:
+            return await asyncio.to_thread(
+                LogArchive.resolve, BASE_DIR, machine_id, filename, meta.mtime if meta else None
+            )
+        except FileNotFoundError:
             raise HTTPException(status_code=404, detail="File not found")
 
-        try:
-            content = file_path.read_text(encoding="utf-8")
-            return content.replace("\\n", "\n")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
+    @staticmethod
+    def _stream_file(source: LogSource, start: int, end: int, unescape: bool, as_json: bool = False):
+        # 同步 generator，StreamingResponse 會在 threadpool 中逐段讀取
+        with source.open() as f:
+            chunks = logfile.iter_range(f, start, end)
+            if unescape:
+                chunks = logfile.unescape_chunks(chunks)
+            if as_json:
+                chunks = logfile.json_string_chunks(chunks)
+            yield from chunks
+
+    @staticmethod
+    def _accepts_plain_text(request: Request) -> bool:
+        accept = request.headers.get("accept", "")
+        return "text/plain" in accept and "application/json" not in accept
+
+    @staticmethod
+    def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            return "*" in tags or etag in tags
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    @staticmethod
+    async def download_log(machine_id: str, filename: str, request: Request, raw: bool = False):
+        """串流下載 log，轉換 "\\n" 後的內容。
+
+        預設與原本相同，回傳內容為一個 JSON 字串；Accept 只要求 text/plain 時回傳純文字，
+        raw=True 時回傳未轉換的原始內容並支援 Range。
+        """
+        source = await LogAPI._source(machine_id, filename)
+        size = source.size
+        as_json = not raw and not LogAPI._accepts_plain_text(request)
+
+        # 三種表示法的內容不同，ETag 需區分；歸檔保留原本的修改時間，ETag 不變
+        variant = "" if raw else "-j" if as_json else "-u"
+        etag = f'"{source.mtime_ns:x}-{size:x}{variant}"'
+        last_modified = formatdate(source.mtime, usegmt=True)
+        headers = {"ETag": etag, "Last-Modified": last_modified, "Vary": "Accept"}
+        if raw:
+            headers["Accept-Ranges"] = "bytes"
+
+        if LogAPI._not_modified(request, etag, source.mtime):
+            return Response(status_code=304, headers=headers)
+
+        # ✅ 轉換後的長度無法預先得知，Range 只套用在原始內容
+        start, end, status_code = 0, size, 200
+        range_header = request.headers.get("range")
+        if raw and range_header and request.headers.get("if-range", etag) in (etag, last_modified):
+            try:
+                byte_range = logfile.parse_range(range_header, size)
+            except logfile.RangeNotSatisfiable:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+            if byte_range is not None:
+                start, end = byte_range
+                status_code = 206
+                headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        if raw:
+            headers["Content-Length"] = str(end - start)
+
+        return StreamingResponse(
+            LogAPI._stream_file(source, start, end, unescape=not raw, as_json=as_json),
+            status_code=status_code,
+            media_type="application/json" if as_json else "text/plain; charset=utf-8",
+            headers=headers,
+        )
 
     @staticmethod
-    async def list_logs(machine_id: str):
-        machine_dir = BASE_DIR / machine_id
-        if not machine_dir.exists():
+    async def list_logs(machine_id: str, sort: str = "name", order: str = "asc", offset: int = 0,
+                        limit: int = None, mtime_from: float = None, mtime_to: float = None):
+        await LogIndex.ensure_loaded(BASE_DIR)
+        if not LogIndex.has_machine(machine_id):
             raise HTTPException(status_code=404, detail="Machine ID not found")
-        
-        files = [f.name for f in machine_dir.iterdir() if f.is_file()]
-        return {"machine_id": machine_id, "files": files}
+
+        total, items = LogIndex.list_files(machine_id, sort, order, offset, limit, mtime_from, mtime_to)
+        return {
+            "machine_id": machine_id,
+            "files": [item["name"] for item in items],
+            "total": total,
+            "items": items,
+        }
 
     @staticmethod
-    async def list_machines():
-        machines = [d.name for d in BASE_DIR.iterdir() if d.is_dir()]
-        return {"machines": machines}
+    async def list_machines(sort: str = "name", order: str = "asc", offset: int = 0,
+                            limit: int = None, mtime_from: float = None, mtime_to: float = None):
+        await LogIndex.ensure_loaded(BASE_DIR)
+        total, items = LogIndex.list_machines(sort, order, offset, limit, mtime_from, mtime_to)
+        return {"machines": [item["name"] for item in items], "total": total, "items": items}
 
     @staticmethod
-    async def show_log(machine_id: str, filename: str):
-        file_path = BASE_DIR / machine_id / filename
-        if not file_path.exists():
-            raise HTTPException(status_code=404, detail="File not found")
+    def _read_tail(source: LogSource, count: int):
+        with source.open() as f:
+            return logfile.tail_lines(f, source.size, count)
+
+    @staticmethod
+    def _read_lines(source: LogSource, first: int, last: int):
+        with source.open() as f:
+            return logfile.read_lines(f, first, last)
+
+    @staticmethod
+    async def show_log(machine_id: str, filename: str, tail: int = None, start: int = None, end: int = None):
+        """分頁瀏覽 log：預設顯示最後 tail 行，指定 start（與 end）時顯示該範圍的行。"""
+        source = await LogAPI._source(machine_id, filename)
+        max_lines = config.LOG_VIEW_MAX_LINES
 
         try:
-            content = file_path.read_text(encoding="utf-8").replace("\\n", "\n")
-            return HTMLResponse(content=f"""
-            <html>
-                <head><meta charset="utf-8"><title>Log File</title></head>
-                <body>
-                    <pre style="white-space: pre-wrap; word-break: break-word;">{content}</pre>
-                </body>
-            </html>
-            """)
-        except Exception as e:
+            if start is not None:
+                if end is None or end < start:
+                    end = start + config.LOG_VIEW_DEFAULT_LINES - 1
+                end = min(end, start + max_lines - 1)
+                page = end - start + 1
+                lines, has_more = await asyncio.to_thread(LogAPI._read_lines, source, start, end)
+                title = f"Lines {start}-{start + len(lines) - 1}" if lines else f"Lines from {start}"
+                links = []
+                if start > 1:
+                    prev_start = max(1, start - page)
+                    links.append(f'<a href="?start={prev_start}&end={start - 1}">上一頁</a>')
+                if has_more:
+                    links.append(f'<a href="?start={end + 1}&end={end + page}">下一頁</a>')
+                links.append('<a href="?">最後幾行</a>')
+            else:
+                count = min(tail or config.LOG_VIEW_DEFAULT_LINES, max_lines)
+                lines = await asyncio.to_thread(LogAPI._read_tail, source, count)
+                title = f"Last {len(lines)} lines"
+                links = []
+                if len(lines) == count and count < max_lines:
+                    links.append(f'<a href="?tail={min(count * 2, max_lines)}">顯示更多</a>')
+                links.append(f'<a href="?start=1&end={config.LOG_VIEW_DEFAULT_LINES}">從頭瀏覽</a>')
+        except (OSError, ValueError, zlib.error) as e:
             raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
-        
+
+        download_url = f"/api/machine/{quote(machine_id)}/log/download/{quote(filename)}"
+        links.append(f'<a href="{download_url}">下載</a>')
+        content = html.escape("\n".join(lines))
+        return HTMLResponse(content=f"""
+        <html>
+            <head><meta charset="utf-8"><title>Log File</title></head>
+            <body>
+                <h3>{html.escape(filename)} - {title}</h3>
+                <p>{" | ".join(links)}</p>
+                <pre style="white-space: pre-wrap; word-break: break-word;">{content}</pre>
+            </body>
+        </html>
+        """)
+
     @staticmethod
     async def parse_log_for_b010(log_content: str):
         # 假設log的格式是 key:value，每行一組資料
@@ -95,7 +311,10 @@ class LogAPI:
             if ":" in line:
                 key, value = line.split(":", 1)
                 data[key.strip()] = value.strip()
-        
+        return LogAPI.b010_payload(data)
+
+    @staticmethod
+    def b010_payload(data: dict):
         # 準備B010所需的資料
         payload = {
             "key": "KahnEwjhfDBHUYS7",
@@ -110,33 +329,49 @@ class LogAPI:
         return payload
 
     @staticmethod
-    async def send_log_to_b010(machine_id: str):
-        machine_dir = BASE_DIR / machine_id
-        if not machine_dir.exists() or not any(machine_dir.iterdir()):
-            return
+    async def build_b010_payload(machine_id: str):
+        await LogIndex.ensure_loaded(BASE_DIR)
+        latest = LogIndex.latest(machine_id)
+        if latest is None:
+            return None
+
+        # ✅ 從檔尾往前只讀到需要的欄位，之後只解析新增的內容
+        latest_log = BASE_DIR / machine_id / latest[0]
+        data = await asyncio.to_thread(B010_PARSER.parse, latest_log)
+        return LogAPI.b010_payload(data)
 
-        latest_log = max(machine_dir.iterdir(), key=lambda f: f.stat().st_mtime)
-        log_content = latest_log.read_text(encoding="utf-8")
-        payload = await LogAPI.parse_log_for_b010(log_content)
+    @staticmethod
+    async def post_b010(payload: dict):
+        response = await Resilience.request("unibuy_b010", "POST", B010_API_URL, json=payload)
+        if response.status_code != 200:
+            raise httpx.HTTPStatusError(
+                f"B010 returned {response.status_code}: {response.text}",
+                request=response.request,
+                response=response,
+            )
+
+    @staticmethod
+    async def send_log_to_b010(machine_id: str) -> bool:
+        payload = await LogAPI.build_b010_payload(machine_id)
+        if payload is None:
+            return False
+
+        try:
+            await LogAPI.post_b010(payload)
+        except (httpx.HTTPError, UpstreamUnavailable) as exc:
+            logger.warning("failed to upload log for %s: %s", machine_id, exc)
+            return False
+        return True
 
-        async with aiohttp.ClientSession() as session:
-            async with session.post(B010_API_URL, json=payload) as response:
-                if response.status != 200:
-                    print(f"Failed to upload log for {machine_id}: {await response.text()}")
-    
     @staticmethod
     async def show_machine_logs(machine_id: str):
-        machine_dir = BASE_DIR / machine_id
-        if not machine_dir.exists():
+        await LogIndex.ensure_loaded(BASE_DIR)
+        if not LogIndex.has_machine(machine_id):
             raise HTTPException(status_code=404, detail="Machine ID not found")
-        
-        files = sorted(
-            machine_dir.iterdir(), 
-            key=lambda f: f.stat().st_mtime, 
-            reverse=True
-        )
-        
-        file_list_html = "".join(f'<li><a href="/api/machine/{machine_id}/log/show/{file.name}">{file.name}</a></li>' for file in files if file.is_file())
+
+        _, files = LogIndex.list_files(machine_id, sort="mtime", order="desc")
+
+        file_list_html = "".join(f'<li><a href="/api/machine/{machine_id}/log/show/{file["name"]}">{file["name"]}</a></li>' for file in files)
         return HTMLResponse(content=f"""
         <html>
             <head><meta charset="utf-8"><title>Log List</title></head>
@@ -147,9 +382,119 @@ class LogAPI:
         </html>
         """)
 
-async def schedule_log_upload():
+class LogRetention:
+    """定期歸檔、清除過期或超出容量的 log，取代每次上傳時的同步掃描。
+
+    容量限制（每台機台與全域）同時計入一般檔案與壓縮歸檔，由舊到新刪除；
+    無法刪除的檔案（Windows 上使用中）略過，下次排程再試。
+    """
+
+    @staticmethod
+    def _log_files(machine_dir: Path):
+        files = []
+        if not machine_dir.is_dir():  # 只剩歸檔的機台
+            return files
+        for entry in os.scandir(machine_dir):
+            if entry.is_file() and not entry.name.startswith("."):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, Path(entry.path)))
+        files.sort()
+        return files
+
+    @staticmethod
+    def _delete(path: Path) -> bool:
+        if path.parent.parent == LogArchive.DIR:
+            return LogRetention._delete_archive(path)
+        try:
+            path.unlink()
+            logger.info("deleted old log file %s/%s", path.parent.name, path.name)
+        except FileNotFoundError:
+            pass
+        except OSError as exc:
+            logger.warning("could not delete log file %s/%s, retrying next sweep: %s", path.parent.name, path.name, exc)
+            return False
+        LogIndex.remove(path.parent.name, path.name)
+        SearchIndex.remove_file(path.parent.name, path.name)
+        B010_PARSER.forget(path)
+        return True
+
+    @staticmethod
+    def _delete_archive(path: Path) -> bool:
+        removed = LogArchive.remove(path)
+        for filename, mtime in removed or ():
+            LogRetention._forget_archived(path.parent.name, filename, mtime)
+        return removed is not None
+
+    @staticmethod
+    def _forget_archived(machine: str, filename: str, mtime: float):
+        # 同名的較新版本（一般檔案或其他歸檔）仍在索引中時不移除
+        meta = LogIndex.get(machine, filename)
+        if meta is not None and meta.mtime != mtime:
+            return
+        LogIndex.remove(machine, filename)
+        SearchIndex.remove_file(machine, filename)
+
+    @staticmethod
+    def sweep_machine(machine_dir: Path, now: float):
+        """歸檔並刪除單一機台過期與超出容量的檔案，回傳 (可清除的檔案, 最新一份一般檔案)。
+
+        可清除的檔案含歸檔，皆為 (mtime, size, path)，由舊到新。
+        """
+        if LogArchive.ENABLED and machine_dir.is_dir():
+            # ✅ 內容與修改時間不變，索引不需更新
+            for path in LogArchive.compact_machine(machine_dir, now):
+                B010_PARSER.forget(path)
+        cutoff = now - config.LOG_RETENTION_DAYS * 86400
+        kept = []
+        for mtime, size, path in LogRetention._log_files(machine_dir):
+            if mtime < cutoff and LogRetention._delete(path):
+                continue
+            kept.append((mtime, size, path))
+        for filename, mtime in LogArchive.expire(machine_dir.name, now):
+            LogRetention._forget_archived(machine_dir.name, filename, mtime)
+
+        # 最新一份保留給 B010 狀態回報
+        latest = kept.pop() if kept else None
+        candidates = sorted(kept + LogArchive.usage(machine_dir.name))
+        limit = config.LOG_MACHINE_MAX_BYTES
+        if limit:
+            total = sum(size for _, size, _ in candidates) + (latest[1] if latest else 0)
+            remaining = []
+            for candidate in candidates:
+                if total > limit and LogRetention._delete(candidate[2]):
+                    total -= candidate[1]
+                else:
+                    remaining.append(candidate)
+            candidates = remaining
+        return candidates, latest
+
+    @staticmethod
+    def sweep():
+        now = time.time()
+        candidates = []
+        total = 0
+        machines = {entry.name for entry in os.scandir(BASE_DIR) if entry.is_dir() and not entry.name.startswith(".")}
+        for machine in sorted(machines.union(LogArchive.machines())):
+            removable, latest = LogRetention.sweep_machine(BASE_DIR / machine, now)
+            total += sum(size for _, size, _ in removable) + (latest[1] if latest else 0)
+            candidates.extend(removable)  # 各機台最新一份不列入全域清除
+
+        limit = config.LOG_GLOBAL_MAX_BYTES
+        if limit:
+            candidates.sort()
+            for _, size, path in candidates:
+                if total <= limit:
+                    break
+                if LogRetention._delete(path):
+                    total -= size
+
+
+async def schedule_log_retention():
     while True:
-        machines = await LogAPI.list_machines()
-        for machine_id in machines["machines"]:
-            await LogAPI.send_log_to_b010(machine_id)
-        await asyncio.sleep(600)  # 每10分鐘執行一次
\ No newline at end of file
+        try:
+            with metrics.BACKGROUND_TASK_DURATION.time(task="log_retention"):
+                await asyncio.to_thread(LogRetention.sweep)
+        except Exception as e:
+            metrics.BACKGROUND_TASK_FAILURES.inc(task="log_retention")
+            logger.exception("log retention sweep failed: %s", e)
+        await asyncio.sleep(config.LOG_RETENTION_INTERVAL)
@@ -0,0 +1,153 @@
+"""機台 log 檔的串流讀取工具。
+
+機台上傳的 log 以字面上的 "\\n" 表示換行，這裡的函式都以 binary file 物件為輸入，
+分段讀取並在串流過程中逐段轉換，不需要把整個檔案載入記憶體。
+"""
+import codecs
+import json
+
+ESCAPED_NEWLINE = b"\\n"
+CHUNK_SIZE = 64 * 1024
+
+
+def unescape_chunks(chunks):
+    """把 chunk 內的字面 "\\n" 轉為換行；chunk 結尾的反斜線留到下一段一起處理。"""
+    carry = b""
+    for chunk in chunks:
+        data = carry + chunk
+        if data.endswith(b"\\"):
+            carry, data = b"\\", data[:-1]
+        else:
+            carry = b""
+        if data:
+            yield data.replace(ESCAPED_NEWLINE, b"\n")
+    if carry:
+        yield carry
+
+
+def json_string_chunks(chunks):
+    """把 chunk 串流編碼成一個 JSON 字串（含前後引號）；跨 chunk 的多位元組字元由增量解碼處理。"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    yield b'"'
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield json.dumps(text, ensure_ascii=False)[1:-1].encode("utf-8")
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield json.dumps(text, ensure_ascii=False)[1:-1].encode("utf-8")
+    yield b'"'
+
+
+class LineCounter:
+    """分段計算行數（換行或字面 "\\n" 皆視為分隔），可處理跨 chunk 的 "\\n"。"""
+
+    def __init__(self):
+        self.separators = 0
+        self._tail = b""
+
+    def feed(self, chunk: bytes):
+        if not chunk:
+            return
+        self.separators += chunk.count(b"\n") + chunk.count(ESCAPED_NEWLINE)
+        if self._tail.endswith(b"\\") and chunk.startswith(b"n"):
+            self.separators += 1
+        self._tail = (self._tail + chunk)[-2:]
+
+    @property
+    def lines(self) -> int:
+        if not self._tail:
+            return 0
+        ends_with_separator = self._tail.endswith(b"\n") or self._tail == ESCAPED_NEWLINE
+        return self.separators + (0 if ends_with_separator else 1)
+
+
+def count_lines(f) -> int:
+    counter = LineCounter()
+    for chunk in iter_range(f):
+        counter.feed(chunk)
+    return counter.lines
+
+
+def iter_range(f, start: int = 0, end: int = None, chunk_size: int = CHUNK_SIZE):
+    """讀取 [start, end) 的原始位元組；end 為 None 時讀到檔尾。"""
+    f.seek(start)
+    remaining = None if end is None else end - start
+    while remaining is None or remaining > 0:
+        size = chunk_size if remaining is None else min(chunk_size, remaining)
+        chunk = f.read(size)
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield chunk
+
+
+def _count_separators(data: bytes) -> int:
+    return data.count(b"\n") + data.count(ESCAPED_NEWLINE)
+
+
+def tail_lines(f, size: int, n: int, block_size: int = CHUNK_SIZE):
+    """從檔尾往前分段讀取，回傳最後 n 行（已轉換換行），讀取量只與 n 行的長度有關。"""
+    if n <= 0 or size <= 0:
+        return []
+    buffer = b""
+    position = size
+    # 多讀一個分隔符號，確保最前面不完整的那一行可以被捨棄
+    while position > 0 and _count_separators(buffer) <= n:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        buffer = f.read(read_size) + buffer
+
+    lines = buffer.replace(ESCAPED_NEWLINE, b"\n").split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    if position > 0:
+        lines = lines[1:]
+    return [line.rstrip(b"\r").decode("utf-8", errors="replace") for line in lines[-n:]]
+
+
+def read_lines(f, first: int, last: int):
+    """回傳第 first 到 last 行（1 起算，含頭尾），以及之後是否還有內容。"""
+    lines = []
+    line_no = 1
+    pending = b""
+    for chunk in unescape_chunks(iter_range(f)):
+        pending += chunk
+        parts = pending.split(b"\n")
+        pending = parts.pop()
+        for part in parts:
+            if first <= line_no <= last:
+                lines.append(part.rstrip(b"\r").decode("utf-8", errors="replace"))
+            line_no += 1
+            if line_no > last:
+                return lines, True
+    if pending and first <= line_no <= last:
+        lines.append(pending.rstrip(b"\r").decode("utf-8", errors="replace"))
+    return lines, False
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int):
+    """解析單一 bytes range，回傳 (start, end) 半開區間；格式不支援時回傳 None（回完整內容）。"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start_text, _, end_text = header[len("bytes="):].strip().partition("-")
+    if not (start_text or end_text) or not (start_text + end_text).isdigit():
+        return None
+
+    if start_text == "":
+        suffix = int(end_text)
+        start, end = max(0, size - suffix), size
+        if suffix == 0:
+            raise RangeNotSatisfiable()
+    else:
+        start = int(start_text)
+        end = min(int(end_text) + 1, size) if end_text else size
+    if start >= size or start >= end:
+        raise RangeNotSatisfiable()
+    return start, end
@@ -0,0 +1,182 @@
+"""依序套用 migrations/ 下的 SQL 檔，已套用的版本記錄在 schema_migrations。
+
+可單獨執行：python migrate.py
+MySQL 的 DDL 會自動 commit，檔案中途失敗時前面的語句已生效；重跑時 ALTER TABLE ... ADD COLUMN
+與 CREATE INDEX 會先查 information_schema，已完成的步驟直接略過（每個 ALTER 只加一個欄位）。
+服務啟動時 leader 先套用（DB_MIGRATE_ON_STARTUP），所有 worker 確認 schema 為最新前 /readyz 回 503；
+依賴新欄位的程式以 Migrations.has() 判斷，未套用時退回舊欄位。
+"""
+import asyncio
+import logging
+import re
+from pathlib import Path
+from database import Database
+from leader import LeaderElection
+from lifecycle import Lifecycle
+import config
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent / "migrations"
+IDEMPOTENCY_COLUMNS = "001_linepay_transactions_idempotency"  # idempotency_key、response_json
+APPLYING = "applying migrations"
+
+
+_ADD_COLUMN = re.compile(r"ALTER\s+TABLE\s+`?(\w+)`?\s+ADD\s+COLUMN\s+`?(\w+)`?", re.IGNORECASE)
+_CREATE_INDEX = re.compile(r"CREATE\s+INDEX\s+`?(\w+)`?\s+ON\s+`?(\w+)`?\s*\(([^;]*)\)", re.IGNORECASE)
+
+
+def _statements(sql: str):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def _index_columns(columns: str) -> list:
+    # "created_at, id" / "`name`(10) DESC" → 欄位名稱
+    return [re.split(r"[\s(]", part.strip().strip("`"), maxsplit=1)[0].strip("`").lower()
+            for part in columns.split(",") if part.strip()]
+
+
+async def _columns(cursor, table: str) -> set:
+    await cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,),
+    )
+    return {row[0].lower() for row in await cursor.fetchall()}
+
+
+async def _has_index(cursor, table: str, index: str) -> bool:
+    await cursor.execute(
+        "SELECT 1 FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s LIMIT 1",
+        (table, index),
+    )
+    return await cursor.fetchone() is not None
+
+
+async def _execute(cursor, version: str, statement: str):
+    """執行一個 migration 語句；已生效的 ADD COLUMN / CREATE INDEX 略過，索引欄位不存在時明確報錯。"""
+    match = _ADD_COLUMN.match(statement)
+    if match and len(re.findall(r"\bADD\s+COLUMN\b", statement, re.IGNORECASE)) == 1:
+        table, column = match.groups()
+        if column.lower() in await _columns(cursor, table):
+            logger.info("migration %s: %s.%s already exists, skipped", version, table, column)
+            return
+    match = _CREATE_INDEX.match(statement)
+    if match:
+        index, table, columns = match.groups()
+        if await _has_index(cursor, table, index):
+            logger.info("migration %s: index %s already exists, skipped", version, index)
+            return
+        existing = await _columns(cursor, table)
+        missing = [column for column in _index_columns(columns) if column not in existing]
+        if missing:
+            raise RuntimeError(
+                f"migration {version}: {table} has no column {', '.join(missing)}, cannot create index {index}"
+            )
+    await cursor.execute(statement)
+
+
+class Migrations:
+    CHECK_INTERVAL = 10.0
+
+    applied = None  # 資料庫中已套用的版本；尚未確認前為 None
+    _lock = None
+
+    @staticmethod
+    def available():
+        return sorted(MIGRATIONS_DIR.glob("*.sql"))
+
+    @classmethod
+    def has(cls, version: str) -> bool:
+        return cls.applied is not None and version in cls.applied
+
+    @staticmethod
+    async def _applied_versions(cursor) -> set:
+        await cursor.execute(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version VARCHAR(255) PRIMARY KEY, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        )
+        await cursor.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in await cursor.fetchall()}
+
+    @classmethod
+    async def refresh(cls) -> list:
+        """重新讀取已套用的版本，回傳尚未套用的版本。"""
+        async with Database.acquire() as conn:
+            async with conn.cursor() as cursor:
+                cls.applied = await cls._applied_versions(cursor)
+        return [path.stem for path in cls.available() if path.stem not in cls.applied]
+
+    @classmethod
+    async def apply(cls) -> list:
+        """套用尚未執行的 migration，回傳這次套用的版本。"""
+        applied = []
+        async with Database.acquire() as conn:
+            async with conn.cursor() as cursor:
+                done = await cls._applied_versions(cursor)
+
+                for path in cls.available():
+                    version = path.stem
+                    if version in done:
+                        continue
+                    for statement in _statements(path.read_text(encoding="utf-8")):
+                        await _execute(cursor, version, statement)
+                    await cursor.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (version,))
+                    logger.info("applied migration %s", version)
+                    applied.append(version)
+                    done.add(version)
+                cls.applied = done
+        return applied
+
+    @classmethod
+    async def check(cls) -> dict:
+        """leader 套用 migration（DB_MIGRATE_ON_STARTUP），再確認 schema；有未套用的版本時阻擋 /readyz。"""
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+        # 套用 migration 可能超過暖機逾時，shield 讓它在背景做完（做完前 /readyz 維持 503）
+        task = asyncio.ensure_future(cls._check())
+        task.add_done_callback(lambda done: done.cancelled() or done.exception())  # 等待者已取消時也取走例外
+        return await asyncio.shield(task)
+
+    @classmethod
+    async def _check(cls) -> dict:
+        async with cls._lock:
+            try:
+                if config.DB_MIGRATE_ON_STARTUP and LeaderElection.is_leader:
+                    Lifecycle.block("schema", APPLYING)
+                    await cls.apply()
+                pending = await cls.refresh()
+            except Exception:
+                # 資料庫連不上時無法確認 schema，不阻擋服務（交易紀錄先進 spool），由 watch() 稍後重試
+                if Lifecycle.blockers.get("schema") == APPLYING:
+                    Lifecycle.unblock("schema")
+                raise
+            if pending:
+                Lifecycle.block("schema", f"pending migrations: {', '.join(pending)}")
+            else:
+                Lifecycle.unblock("schema")
+            return {"pending": pending}
+
+    @classmethod
+    async def watch(cls):
+        """schema 尚未確認為最新時定期重新檢查（資料庫暫時連不上、或等待 leader / 手動套用）。"""
+        while cls.applied is None or Lifecycle.blocked("schema"):
+            await asyncio.sleep(cls.CHECK_INTERVAL)
+            try:
+                await cls.check()
+            except Exception as exc:
+                logger.warning("schema check failed: %s", exc)
+
+
+async def main():
+    try:
+        applied = await Migrations.apply()
+        print(f"✅ 已套用 {len(applied)} 個 migration: {', '.join(applied) or '-'}")
+    finally:
+        await Database.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,6 @@
+-- 付款冪等：記錄冪等鍵與第一次的回應，重送時直接回傳
+-- 每個 ALTER 只加一個欄位，中途失敗重跑時 migrate.py 會略過已存在的欄位與索引
+ALTER TABLE linepay_transactions ADD COLUMN idempotency_key VARCHAR(64) NULL;
+ALTER TABLE linepay_transactions ADD COLUMN response_json TEXT NULL;
+
+CREATE INDEX idx_linepay_transactions_idempotency_key ON linepay_transactions (idempotency_key);
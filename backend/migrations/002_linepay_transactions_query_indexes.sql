@@ -0,0 +1,5 @@
+-- 交易查詢 / 匯出用的索引（keyset 分頁以 created_at, id 排序）
+-- 需要 linepay_transactions 的 id 與 created_at 欄位；缺少時 migrate.py 會指出缺少的欄位並停止
+CREATE INDEX idx_linepay_transactions_created ON linepay_transactions (created_at, id);
+CREATE INDEX idx_linepay_transactions_machine_created ON linepay_transactions (machine, created_at, id);
+CREATE INDEX idx_linepay_transactions_status_created ON linepay_transactions (status, created_at, id);
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from pathlib import Path
+from database import Database
+from idempotency import IdempotencyStore
+from migrate import Migrations, IDEMPOTENCY_COLUMNS
+from transaction_recorder import TransactionRecorder
+from structured_logging import bind_order
+import config
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+SUCCESS = "success"
+FAILED = "failed"
+EXPIRED = "expired"
+
+
+class ReconciliationEngine:
+    """付款逾時的訂單先寫入本機 SQLite，由背景工作以指數退避輪詢最終狀態。
+
+    各金流以 register() 註冊查詢函式：
+        async def checker(record: dict) -> tuple | None
+    回傳 None 表示尚未有最終結果，否則回傳 (status, return_code, return_message, data)。
+    record=False 的金流（玉山）不寫入 linepay_transactions，最終結果只保存在本機 SQLite。
+
+    取得最終結果後以 respond(order_id, status, return_code, return_message, data) 組出付款回應，
+    寫回 linepay_transactions.response_json 並更新冪等快取，同一筆付款重送時不再回 pending。
+    """
+
+    DB_PATH = Path(config.RECONCILE_DB_PATH)
+    MAX_CONCURRENT = config.RECONCILE_MAX_CONCURRENT
+    BASE_DELAY = config.RECONCILE_BASE_DELAY
+    MAX_DELAY = config.RECONCILE_MAX_DELAY
+    MAX_ATTEMPTS = config.RECONCILE_MAX_ATTEMPTS
+
+    _checkers = {}
+    _responders = {}
+    _unrecorded = set()
+    _task = None
+    _wakeup = None
+    _semaphore = None
+    _inflight = set()
+
+    @classmethod
+    def register(cls, provider: str, checker, record: bool = True, respond=None):
+        cls._checkers[provider] = checker
+        cls._responders[provider] = respond or cls._default_response
+        if record:
+            cls._unrecorded.discard(provider)
+        else:
+            cls._unrecorded.add(provider)
+
+    # ---- SQLite ----
+    @classmethod
+    def _connect(cls) -> sqlite3.Connection:
+        cls.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(cls.DB_PATH, timeout=10)
+        conn.row_factory = sqlite3.Row
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS pending_orders (
+                order_id TEXT PRIMARY KEY,
+                provider TEXT NOT NULL,
+                request_json TEXT NOT NULL,
+                status TEXT NOT NULL,
+                return_code TEXT,
+                return_message TEXT,
+                result_json TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        return conn
+
+    @classmethod
+    def _execute(cls, sql: str, params=()):
+        conn = cls._connect()
+        try:
+            with conn:
+                return [dict(row) for row in conn.execute(sql, params).fetchall()]
+        finally:
+            conn.close()
+
+    @classmethod
+    async def _query(cls, sql: str, params=()):
+        return await asyncio.to_thread(cls._execute, sql, params)
+
+    # ---- public API ----
+    @classmethod
+    async def submit(cls, provider: str, order_id: str, request: dict, idempotency_key: str = None) -> dict:
+        now = time.time()
+        if idempotency_key:
+            request = dict(request, _idempotency_key=idempotency_key)
+        await cls._query(
+            "INSERT OR IGNORE INTO pending_orders "
+            "(order_id, provider, request_json, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (order_id, provider, json.dumps(request, ensure_ascii=False), PENDING,
+             now + cls.BASE_DELAY, now, now),
+        )
+        if cls._wakeup is not None:
+            cls._wakeup.set()
+        return {"status": PENDING, "orderId": order_id}
+
+    @classmethod
+    async def get_status(cls, order_id: str, provider: str = None):
+        """查詢對帳狀態；指定 provider 時其他金流的同名訂單視為不存在。"""
+        sql = (
+            "SELECT order_id, provider, status, return_code, return_message, result_json, attempts, "
+            "created_at, updated_at FROM pending_orders WHERE order_id = ?"
+        )
+        params = (order_id,)
+        if provider is not None:
+            sql += " AND provider = ?"
+            params += (provider,)
+        rows = await cls._query(sql, params)
+        if not rows:
+            return None
+        row = rows[0]
+        result_json = row.pop("result_json")
+        row["data"] = json.loads(result_json) if result_json else None
+        return row
+
+    @classmethod
+    async def start(cls):
+        if cls._task is not None:
+            return
+        cls._wakeup = asyncio.Event()
+        cls._semaphore = asyncio.Semaphore(cls.MAX_CONCURRENT)
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is None:
+            return
+        cls._task.cancel()
+        try:
+            await cls._task
+        except asyncio.CancelledError:
+            pass
+        cls._task = None
+        # 未完成的查詢已保存在 SQLite，下次啟動會繼續
+        for task in list(cls._inflight):
+            task.cancel()
+        await asyncio.gather(*cls._inflight, return_exceptions=True)
+
+    # ---- worker ----
+    @classmethod
+    async def _run(cls):
+        while True:
+            try:
+                await cls._dispatch_due()
+            except Exception as exc:
+                logger.error("reconciliation dispatch failed: %s", exc)
+            cls._wakeup.clear()
+            try:
+                await asyncio.wait_for(cls._wakeup.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    async def _dispatch_due(cls):
+        busy = {task.get_name() for task in cls._inflight}
+        rows = await cls._query(
+            "SELECT * FROM pending_orders WHERE status = ? AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (PENDING, time.time(), cls.MAX_CONCURRENT * 4),
+        )
+        for row in rows:
+            if row["order_id"] in busy:
+                continue
+            task = asyncio.create_task(cls._poll(row), name=row["order_id"])
+            cls._inflight.add(task)
+            task.add_done_callback(cls._inflight.discard)
+
+    @classmethod
+    def _next_delay(cls, attempts: int) -> float:
+        # 指數退避加上 jitter，避免大量訂單同時打上游
+        delay = min(cls.MAX_DELAY, cls.BASE_DELAY * (2 ** attempts))
+        return delay * random.uniform(0.5, 1.0)
+
+    @classmethod
+    async def _poll(cls, row: dict):
+        checker = cls._checkers.get(row["provider"])
+        if checker is None:
+            logger.error("no reconciliation checker for provider %s", row["provider"])
+            return
+
+        bind_order(row["order_id"])
+        record = dict(row, request=json.loads(row["request_json"]))
+        async with cls._semaphore:
+            try:
+                result = await checker(record)
+            except Exception as exc:
+                logger.warning("reconciliation check for %s failed: %s", row["order_id"], exc)
+                result = None
+
+        attempts = row["attempts"] + 1
+        now = time.time()
+        if result is None:
+            if attempts >= cls.MAX_ATTEMPTS:
+                await cls._query(
+                    "UPDATE pending_orders SET status = ?, attempts = ?, updated_at = ? WHERE order_id = ?",
+                    (EXPIRED, attempts, now, row["order_id"]),
+                )
+            else:
+                await cls._query(
+                    "UPDATE pending_orders SET attempts = ?, next_attempt_at = ?, updated_at = ? WHERE order_id = ?",
+                    (attempts, now + cls._next_delay(attempts), now, row["order_id"]),
+                )
+            return
+
+        status, return_code, return_message, data = result
+        response = cls._responders[row["provider"]](row["order_id"], status, return_code, return_message, data)
+        try:
+            if row["provider"] not in cls._unrecorded:
+                await cls._save_final(row["order_id"], record["request"], status, return_code, return_message, response)
+        except Exception as exc:
+            logger.error("failed to save reconciled order %s: %s", row["order_id"], exc)
+            await cls._query(
+                "UPDATE pending_orders SET next_attempt_at = ?, updated_at = ? WHERE order_id = ?",
+                (now + cls._next_delay(attempts), now, row["order_id"]),
+            )
+            return
+        await cls._query(
+            "UPDATE pending_orders SET status = ?, return_code = ?, return_message = ?, result_json = ?, "
+            "attempts = ?, updated_at = ? WHERE order_id = ?",
+            (status, return_code, return_message, json.dumps(data, ensure_ascii=False),
+             attempts, now, row["order_id"]),
+        )
+        idempotency_key = record["request"].get("_idempotency_key")
+        if idempotency_key:
+            # 取代記憶體中的 pending 回應（並通知其他 worker），重送改回最終結果
+            IdempotencyStore.remember(idempotency_key, response)
+
+    @staticmethod
+    def _default_response(order_id: str, status: str, return_code: str, return_message: str, data) -> dict:
+        return {"status": status, "orderId": order_id, "data": data}
+
+    @staticmethod
+    async def _save_final(order_id: str, request: dict, status: str, return_code: str, return_message: str,
+                          response=None):
+        # 逾時當下已寫入一筆 pending 紀錄，先把佇列寫完再更新
+        await TransactionRecorder.flush()
+        if Migrations.applied is None:
+            await Migrations.refresh()
+        response_json = json.dumps(response, ensure_ascii=False) if response is not None else None
+        async with Database.acquire() as conn:
+            async with conn.cursor() as cursor:
+                if Migrations.has(IDEMPOTENCY_COLUMNS):
+                    # 冪等查詢讀的是 response_json，需一併改成最終結果
+                    updated = await cursor.execute(
+                        "UPDATE linepay_transactions SET status = %s, return_code = %s, return_message = %s, "
+                        "response_json = %s WHERE order_id = %s",
+                        (status, return_code, return_message, response_json, order_id),
+                    )
+                else:
+                    updated = await cursor.execute(
+                        "UPDATE linepay_transactions SET status = %s, return_code = %s, return_message = %s "
+                        "WHERE order_id = %s",
+                        (status, return_code, return_message, order_id),
+                    )
+        if not updated:
+            # pending 那筆可能因 MySQL 無法連線而留在 spool：重送時同一 order_id 已有紀錄就略過，不會多出一筆 pending
+            await TransactionRecorder.record_row({
+                "order_id": order_id,
+                "machine": request.get("machine"),
+                "barcode": request.get("barcode"),
+                "amount": request.get("amount"),
+                "payway": request.get("payway"),
+                "status": status,
+                "return_code": return_code,
+                "return_message": return_message,
+                "idempotency_key": request.get("_idempotency_key"),
+                "response_json": response_json,
+            })
@@ -0,0 +1,229 @@
+"""上游呼叫的熔斷、動態逾時與 hedged request。
+
+- 每個上游一個斷路器：連續失敗 FAILURE_THRESHOLD 次（連線錯誤、逾時、5xx）後斷路，
+  RESET_TIMEOUT 秒內直接回 503；之後放行一個試探請求，成功才恢復
+- 讀取（GET 或可 hedge 的請求）的逾時依近期成功讀取的延遲百分位調整（乘上倍數，介於 ADAPTIVE_TIMEOUT_MIN
+  與原設定之間）；付款、退款等不可重送的請求一律使用原設定，逾時後結果不明的代價比等待高
+- 可重送的讀取（查詢訂單、B014）可開啟 hedge：第一個請求超過 p95 還沒回來就再送一個，取先成功者
+"""
+import asyncio
+import time
+from collections import deque
+import httpx
+from fastapi import HTTPException
+from http_client import Upstreams
+import config
+import metrics
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+BREAKER_REJECTIONS = metrics.Counter(
+    "upstream_breaker_rejections_total", "Calls rejected because the circuit breaker was open", ("upstream",),
+)
+HEDGED_REQUESTS = metrics.Counter(
+    "upstream_hedged_requests_total", "Hedged requests sent and which attempt won", ("upstream", "winner"),
+)
+
+
+class UpstreamUnavailable(HTTPException):
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(
+            status_code=503,
+            detail=f"Upstream {upstream} is temporarily unavailable (circuit open)",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def before_call(self):
+        if self.state == CLOSED:
+            return
+        if self.state == OPEN:
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if remaining > 0:
+                BREAKER_REJECTIONS.inc(upstream=self.name)
+                raise UpstreamUnavailable(self.name, remaining)
+            self.state = HALF_OPEN
+            self._probing = False
+        # half-open：同時只放行一個試探請求
+        if self._probing:
+            BREAKER_REJECTIONS.inc(upstream=self.name)
+            raise UpstreamUnavailable(self.name, 1)
+        self._probing = True
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """保留最近 size 筆成功請求的延遲，用來計算百分位。"""
+
+    def __init__(self, size: int = 500):
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Resilience:
+    FAILURE_THRESHOLD = config.BREAKER_FAILURE_THRESHOLD
+    RESET_TIMEOUT = config.BREAKER_RESET_TIMEOUT
+    ADAPTIVE_TIMEOUT = config.ADAPTIVE_TIMEOUT_ENABLED
+    HEDGE_ENABLED = config.HEDGE_ENABLED
+
+    _breakers = {}
+    _latency = {}
+
+    @classmethod
+    def breaker(cls, name: str) -> CircuitBreaker:
+        breaker = cls._breakers.get(name)
+        if breaker is None:
+            breaker = cls._breakers[name] = CircuitBreaker(name, cls.FAILURE_THRESHOLD, cls.RESET_TIMEOUT)
+        return breaker
+
+    @classmethod
+    def _tracker(cls, name: str) -> LatencyTracker:
+        tracker = cls._latency.get(name)
+        if tracker is None:
+            tracker = cls._latency[name] = LatencyTracker()
+        return tracker
+
+    @classmethod
+    def timeout(cls, name: str) -> httpx.Timeout:
+        settings = config.UPSTREAMS[name]
+        read_timeout = settings["timeout"]
+        tracker = cls._tracker(name)
+        if cls.ADAPTIVE_TIMEOUT and len(tracker.samples) >= config.ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            observed = tracker.percentile(config.ADAPTIVE_TIMEOUT_PERCENTILE) * config.ADAPTIVE_TIMEOUT_MULTIPLIER
+            read_timeout = min(read_timeout, max(config.ADAPTIVE_TIMEOUT_MIN, observed))
+        return httpx.Timeout(read_timeout, connect=settings["connect_timeout"])
+
+    @classmethod
+    def hedge_delay(cls, name: str) -> float:
+        tracker = cls._tracker(name)
+        if len(tracker.samples) < config.ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return config.HEDGE_DELAY
+        return tracker.percentile(0.95)
+
+    @classmethod
+    def states(cls) -> dict:
+        return {
+            name: {
+                "state": breaker.state,
+                "failures": breaker.failures,
+                "timeout": cls.timeout(name).read,
+            }
+            for name, breaker in cls._breakers.items()
+        }
+
+    @classmethod
+    async def request(cls, name: str, method: str, url: str, hedge: bool = False, adaptive: bool = None,
+                      **kwargs) -> httpx.Response:
+        """透過 Upstreams 的共用 client 送出請求，套用斷路器與逾時；hedge 只能用在可重送的請求。
+
+        adaptive 未指定時，GET / HEAD 與 hedge 的請求套用動態逾時，其餘使用設定的逾時；
+        延遲統計也只記錄這些請求，付款的延遲不會混進查詢的百分位。
+        """
+        if adaptive is None:
+            adaptive = hedge or method in ("GET", "HEAD")
+        breaker = cls.breaker(name)
+        breaker.before_call()
+        client = Upstreams.get(name)
+        if adaptive:
+            kwargs.setdefault("timeout", cls.timeout(name))
+
+        async def send():
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            if adaptive and response.status_code < 500:
+                cls._tracker(name).record(time.perf_counter() - start)
+            return response
+
+        try:
+            if hedge and cls.HEDGE_ENABLED:
+                response = await cls._hedged(name, send)
+            else:
+                response = await send()
+        except httpx.TransportError:
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker._probing = False
+            raise
+
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    @classmethod
+    async def _hedged(cls, name: str, send) -> httpx.Response:
+        first = asyncio.create_task(send())
+        done, _ = await asyncio.wait({first}, timeout=cls.hedge_delay(name))
+        if done:
+            return first.result()
+
+        second = asyncio.create_task(send())
+        attempts = {first: "first", second: "hedge"}
+        pending = set(attempts)
+        last_response, last_error = None, None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    response = task.result()
+                    if response.status_code < 500:
+                        HEDGED_REQUESTS.inc(upstream=name, winner=attempts[task])
+                        return response
+                    last_response = response
+        finally:
+            for task in pending:
+                task.cancel()
+        HEDGED_REQUESTS.inc(upstream=name, winner="none")
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+
+def _breaker_values():
+    return {(name,): _STATE_VALUES[breaker.state] for name, breaker in Resilience._breakers.items()}
+
+
+def _timeout_values():
+    return {(name,): Resilience.timeout(name).read for name in Resilience._breakers}
+
+
+metrics.Gauge(
+    "upstream_breaker_state", "Circuit breaker state (0 closed, 1 half-open, 2 open)", ("upstream",),
+    callback=_breaker_values,
+)
+metrics.Gauge("upstream_read_timeout_seconds", "Current adaptive read timeout", ("upstream",), callback=_timeout_values)
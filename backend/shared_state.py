@@ -0,0 +1,186 @@
+import asyncio
+import inspect
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from pathlib import Path
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class SharedEvents:
+    """同一台主機上多個 worker 之間的快取同步。
+
+    變更快取的 worker 把事件寫入共用的 SQLite，其他 worker 定期以 PRAGMA data_version
+    檢查是否有別的連線寫入（不必每次查詢資料表），有變更才讀取新事件並套用到自己的記憶體。
+
+    publish() 只把事件放進記憶體的待送佇列並喚醒背景工作，不碰 SQLite；
+    寫入與讀取都由背景工作在 thread 中批次進行，付款流程不等待磁碟。
+    """
+
+    DB_PATH = Path(config.SHARED_STATE_DB_PATH)
+    POLL_INTERVAL = config.SHARED_STATE_POLL_INTERVAL
+    RETENTION = config.SHARED_STATE_RETENTION
+    MAX_PENDING = 10000  # 背景工作跟不上時丟棄最舊的事件（只影響其他 worker 的快取新鮮度）
+
+    ORIGIN = uuid.uuid4().hex  # 區分自己發出的事件
+
+    _conn = None
+    _lock = threading.Lock()  # SQLite 連線
+    _pending = deque()  # 尚未寫入的 (channel, payload json, created_at)；deque 的 append / popleft 可跨 thread
+    _data_version = None
+    _last_id = 0
+    _last_prune = 0.0
+    _subscribers = {}
+    _task = None
+    _loop = None
+    _wakeup = None
+
+    @classmethod
+    def _connection(cls) -> sqlite3.Connection:
+        if cls._conn is None:
+            cls.DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(cls.DB_PATH, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    channel TEXT NOT NULL,
+                    origin TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.commit()
+            cls._last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+            cls._data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            cls._conn = conn
+        return cls._conn
+
+    @classmethod
+    def subscribe(cls, channel: str, handler):
+        """handler(payload: dict) 在 event loop thread 上執行，只會收到其他 worker 的事件。
+
+        需要讀寫檔案的 handler 可以是 async，自行把阻塞的部分交給 thread。
+        """
+        cls._subscribers.setdefault(channel, []).append(handler)
+
+    @classmethod
+    def publish(cls, channel: str, payload: dict):
+        """放入待送佇列後立即返回（任何 thread 皆可呼叫），由背景工作寫入。"""
+        cls._pending.append((channel, json.dumps(payload, ensure_ascii=False), time.time()))
+        while len(cls._pending) > cls.MAX_PENDING:
+            try:
+                cls._pending.popleft()
+            except IndexError:
+                break
+        loop = cls._loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(cls._wakeup.set)
+            except RuntimeError:  # event loop 已關閉
+                pass
+
+    @classmethod
+    def _write_pending(cls, conn: sqlite3.Connection):
+        batch = []
+        while cls._pending:
+            try:
+                batch.append(cls._pending.popleft())
+            except IndexError:
+                break
+        if not batch:
+            return
+        now = time.time()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO events (channel, origin, payload, created_at) VALUES (?, ?, ?, ?)",
+                    [(channel, cls.ORIGIN, payload, created_at) for channel, payload, created_at in batch],
+                )
+                if now - cls._last_prune > 60:
+                    cls._last_prune = now
+                    conn.execute("DELETE FROM events WHERE created_at < ?", (now - cls.RETENTION,))
+        except sqlite3.Error as exc:
+            # 同步失敗只影響其他 worker 的快取新鮮度，不影響請求
+            logger.warning("failed to publish %d shared events: %s", len(batch), exc)
+
+    @classmethod
+    def sync(cls):
+        """寫入待送事件並讀取其他 worker 的新事件（阻塞，於 thread 中執行），回傳 [(channel, payload)]。"""
+        with cls._lock:
+            conn = cls._connection()
+            cls._write_pending(conn)
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == cls._data_version:
+                return []
+            cls._data_version = version
+            rows = conn.execute(
+                "SELECT id, channel, origin, payload FROM events WHERE id > ? ORDER BY id", (cls._last_id,)
+            ).fetchall()
+            if rows:
+                cls._last_id = rows[-1][0]
+        return [(channel, json.loads(payload)) for _, channel, origin, payload in rows if origin != cls.ORIGIN]
+
+    @classmethod
+    async def poll(cls) -> int:
+        events = await asyncio.to_thread(cls.sync)
+        handled = 0
+        for channel, payload in events:
+            for handler in cls._subscribers.get(channel, ()):
+                try:
+                    result = handler(payload)
+                    if inspect.isawaitable(result):
+                        await result
+                    handled += 1
+                except Exception as exc:
+                    logger.error("shared event handler for %s failed: %s", channel, exc)
+        return handled
+
+    @classmethod
+    async def _run(cls):
+        while True:
+            try:
+                await cls.poll()
+            except sqlite3.Error as exc:
+                logger.warning("shared event poll failed: %s", exc)
+            # 有新事件要送出時提早醒來，否則每 POLL_INTERVAL 檢查一次
+            try:
+                async with asyncio.timeout(cls.POLL_INTERVAL):
+                    await cls._wakeup.wait()
+            except TimeoutError:
+                pass
+            cls._wakeup.clear()
+
+    @classmethod
+    async def start(cls):
+        if cls._task is None:
+            await asyncio.to_thread(cls._connection)  # 從目前最後一筆事件開始接收
+            cls._wakeup = asyncio.Event()
+            cls._loop = asyncio.get_running_loop()
+            cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is not None:
+            cls._loop = None
+            cls._task.cancel()
+            try:
+                await cls._task
+            except asyncio.CancelledError:
+                pass
+            cls._task = None
+
+        def close():
+            with cls._lock:
+                if cls._conn is not None:
+                    cls._write_pending(cls._conn)  # 送出剩下的事件
+                    cls._conn.close()
+                    cls._conn = None
+
+        await asyncio.to_thread(close)
@@ -0,0 +1,215 @@
+"""結構化 log：JSON lines、關聯 ID、取樣與敏感欄位遮蔽。
+
+呼叫端只把 LogRecord 放進佇列（QueueHandler），格式化與寫入 stdout 都在
+QueueListener 的背景 thread 進行，stdout 卡住不會拖慢付款流程；佇列滿時直接丟棄並計數。
+"""
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import re
+import sys
+import uuid
+import config
+import metrics
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+order_id_var = contextvars.ContextVar("order_id", default=None)
+
+REDACTED = "***"
+# 整個值遮蔽
+SECRET_KEYS = {
+    "hash_key", "key", "t050v43", "hashsource", "hash_source",
+    "x-line-channelsecret", "channel_secret", "line_channelsecret", "channelsecret",
+}
+# 只保留末四碼
+BARCODE_KEYS = {"barcode", "buyerid", "onetimekey"}
+SECRET_KEYS |= {name.strip().lower() for name in config.APP_LOG_REDACT_KEYS.split(",") if name.strip()}
+
+LOGS_DROPPED = metrics.Counter("app_logs_dropped_total", "Log records dropped because the log queue was full")
+LOGS_SAMPLED_OUT = metrics.Counter("app_logs_sampled_out_total", "Log records skipped by sampling")
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def _mask_barcode(value) -> str:
+    text = str(value)
+    return REDACTED + text[-4:] if len(text) > 4 else REDACTED
+
+
+def _field_pattern(keys) -> re.Pattern:
+    # key=value、key: value、"key": "value"，以及 URL 編碼過的 %22key%22%3A%22value%22
+    names = "|".join(re.escape(name) for name in sorted(keys, key=len, reverse=True))
+    quote = r"(?:[\"']|%22)?"
+    return re.compile(
+        rf"(?<![\w-])({quote}(?:{names}){quote}\s*(?:[:=]|%3A|%3D)\s*{quote})((?:(?!%22|%26|%2C)[^\s\"'&,;}}\]])+)",
+        re.IGNORECASE,
+    )
+
+
+_SECRET_FIELD = _field_pattern(SECRET_KEYS)
+_BARCODE_FIELD = _field_pattern(BARCODE_KEYS)
+# 沒有欄位名稱的長數字串（付款條碼、一次性付款碼），不動夾在英數字中間的訂單編號
+_LONG_DIGITS = re.compile(r"(?<![0-9A-Za-z])\d{16,}(?![0-9A-Za-z])")
+
+
+def redact_text(text: str) -> str:
+    """遮蔽訊息 / 例外文字中的密鑰與條碼；上游回應內容常被例外訊息帶進來。"""
+    text = _SECRET_FIELD.sub(lambda match: match.group(1) + REDACTED, text)
+    text = _BARCODE_FIELD.sub(lambda match: match.group(1) + _mask_barcode(match.group(2)), text)
+    return _LONG_DIGITS.sub(lambda match: _mask_barcode(match.group(0)), text)
+
+
+def redact(value):
+    """遞迴遮蔽 dict / list 中的敏感欄位。"""
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            name = str(key).lower()
+            if name in SECRET_KEYS:
+                result[key] = REDACTED
+            elif name in BARCODE_KEYS:
+                result[key] = _mask_barcode(item)
+            else:
+                result[key] = redact(item)
+        return result
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def bind_order(order_id: str):
+    """之後在同一個請求 / task 內寫的 log 都帶上這個訂單編號。"""
+    order_id_var.set(order_id)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact_text(record.getMessage()),
+        }
+        request_id = getattr(record, "request_id", None)
+        order_id = getattr(record, "order_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        if order_id:
+            entry["order_id"] = order_id
+        # logger.info(..., extra={...}) 傳入的欄位
+        extra = {key: value for key, value in vars(record).items()
+                 if key not in _STANDARD_ATTRS and key not in ("request_id", "order_id")}
+        if extra:
+            entry.update(redact(extra))
+        exc = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exc:
+            entry["exc"] = redact_text(exc)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _MessageFormatter(logging.Formatter):
+    """QueueHandler.prepare 用：只合併 msg % args，traceback 另外放在 exc_text。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return record.getMessage()
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """在呼叫端的 thread 記下關聯 ID 與取樣，JSON 格式化留給背景 thread。"""
+
+    def __init__(self, log_queue, sample_rate: float = 1.0):
+        super().__init__(log_queue)
+        self.sample_rate = sample_rate
+        self.setFormatter(_MessageFormatter())
+
+    def prepare(self, record: logging.LogRecord):
+        # 參數可能在進佇列後被呼叫端修改，或 traceback 持有的物件之後才變動，
+        # 沿用標準做法在呼叫端先合併訊息、把例外轉成文字
+        exc_text = self.formatter.formatException(record.exc_info) if record.exc_info else record.exc_text
+        record = super().prepare(record)
+        record.exc_text = exc_text
+        # contextvars 只在呼叫端看得到，必須在進佇列前取值
+        record.request_id = request_id_var.get()
+        record.order_id = order_id_var.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DROPPED.inc()
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno < logging.WARNING and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            LOGS_SAMPLED_OUT.inc()
+            return
+        try:
+            self.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class StructuredLogging:
+    _listener = None
+    _handler = None
+
+    @classmethod
+    def setup(cls, level: str = None, stream=None):
+        if cls._listener is not None:
+            return
+        log_queue = queue.Queue(maxsize=config.APP_LOG_QUEUE_SIZE)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter())
+        cls._handler = ContextQueueHandler(log_queue, config.APP_LOG_SAMPLE_RATE)
+        cls._listener = logging.handlers.QueueListener(log_queue, output)
+        cls._listener.start()
+
+        root = logging.getLogger()
+        root.addHandler(cls._handler)
+        root.setLevel(level or config.APP_LOG_LEVEL)
+
+    @classmethod
+    def shutdown(cls):
+        if cls._listener is None:
+            return
+        logging.getLogger().removeHandler(cls._handler)
+        cls._listener.stop()  # 會先寫完佇列中剩下的紀錄
+        cls._listener = None
+        cls._handler = None
+
+
+class CorrelationMiddleware:
+    """每個請求使用 X-Request-ID（沒有就產生一個），並寫回回應標頭。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+        request_token = request_id_var.set(request_id)
+        order_token = order_id_var.set(None)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message.setdefault("headers", [])
+                message["headers"] = list(message["headers"]) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(request_token)
+            order_id_var.reset(order_token)
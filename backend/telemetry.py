@@ -0,0 +1,227 @@
+"""機台狀態的時間序列（溫度、門、櫃溫、狀態碼）。
+
+每次上傳 log 時取出最新一組欄位值，附加到該機台的欄式儲存：
+
+    TELEMETRY_DIR/{machine}/ts.i8          上傳時間（epoch 毫秒，int64，遞增）
+    TELEMETRY_DIR/{machine}/{field}.f4     欄位數值（float32，無法轉成數字時為 NaN）
+
+各欄位檔案只會附加、筆數相同，查詢時以 numpy.memmap 直接對應，不需要重新讀取原始 log；
+區間以 searchsorted 取得，分桶的 min / max / mean 以 reduceat 一次算完。
+"""
+import math
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+from fastapi import HTTPException
+import config
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+FIELDS = ("temperature", "door", "cabinetT", "M_Stus", "M_Stus2")
+FIELD_PATTERN = f"^({'|'.join(FIELDS)})$"
+TS_DTYPE = np.dtype("<i8")
+VALUE_DTYPE = np.dtype("<f4")
+PRECISION = 4  # float32 只有約 7 位有效數字，輸出時四捨五入避免 4.900000095 之類的尾數
+BUCKET_PATTERN = re.compile(r"^(\d+)([smhd]?)$")
+BUCKET_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_bucket(bucket: str) -> int:
+    """"30s"、"5m"、"1h"、"1d" 或秒數，回傳秒數。"""
+    match = BUCKET_PATTERN.match(bucket.strip())
+    if not match or int(match.group(1)) == 0:
+        raise HTTPException(status_code=400, detail="Invalid bucket")
+    return int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+
+
+def _number(value) -> float:
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return number if math.isfinite(number) else math.nan
+
+
+def _points(ts, values):
+    return [
+        {"ts": t / 1000, "value": round(v, PRECISION)}
+        for t, v in zip(ts.tolist(), values.tolist())
+    ]
+
+
+class Telemetry:
+    ENABLED = config.TELEMETRY_ENABLED
+    DIR = Path(config.TELEMETRY_DIR)
+    MAX_POINTS = config.TELEMETRY_MAX_POINTS
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    @contextmanager
+    def _file_lock(machine_dir: Path):
+        # 多個 worker 可能同時寫入同一台機台，所有欄位需在同一個鎖內附加才能保持對齊
+        fd = os.open(machine_dir / ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            yield
+        finally:
+            os.close(fd)  # 關閉時一併釋放鎖
+
+    @staticmethod
+    def _rows(machine_dir: Path) -> int:
+        """完整寫入的筆數：各欄位檔案長度的最小值（寫到一半當掉的尾端不算）。"""
+        sizes = []
+        for name, dtype in [("ts.i8", TS_DTYPE)] + [(f"{field}.f4", VALUE_DTYPE) for field in FIELDS]:
+            try:
+                sizes.append((machine_dir / name).stat().st_size // dtype.itemsize)
+            except FileNotFoundError:
+                return 0
+        return min(sizes)
+
+    @classmethod
+    def append(cls, machine: str, timestamp: float, values: dict):
+        """附加一筆；values 為 log 欄位的字串值，缺少的欄位記為 NaN。"""
+        machine_dir = cls.DIR / machine
+        machine_dir.mkdir(parents=True, exist_ok=True)
+        with cls._lock, cls._file_lock(machine_dir):
+            rows = cls._rows(machine_dir)
+            ts = int(timestamp * 1000)
+            if rows:
+                last = np.fromfile(machine_dir / "ts.i8", dtype=TS_DTYPE, count=1, offset=(rows - 1) * TS_DTYPE.itemsize)
+                ts = max(ts, int(last[0]))  # 時間需遞增才能以 searchsorted 查詢，時鐘倒退時沿用上一筆
+            columns = [("ts.i8", np.array([ts], dtype=TS_DTYPE), TS_DTYPE)] + [
+                (f"{field}.f4", np.array([_number(values.get(field))], dtype=VALUE_DTYPE), VALUE_DTYPE)
+                for field in FIELDS
+            ]
+            for name, array, dtype in columns:
+                with open(machine_dir / name, "ab") as f:
+                    # 先截掉未對齊的尾端（上次寫到一半）
+                    if f.tell() != rows * dtype.itemsize:
+                        f.truncate(rows * dtype.itemsize)
+                    array.tofile(f)
+
+    @classmethod
+    def _load(cls, machine: str, field: str):
+        """回傳 (ts, values) 的 memmap；沒有資料時回傳 None。"""
+        machine_dir = cls.DIR / machine
+        rows = cls._rows(machine_dir)
+        if rows == 0:
+            return None
+        ts = np.memmap(machine_dir / "ts.i8", dtype=TS_DTYPE, mode="r", shape=(rows,))
+        values = np.memmap(machine_dir / f"{field}.f4", dtype=VALUE_DTYPE, mode="r", shape=(rows,))
+        return ts, values
+
+    @classmethod
+    def machines(cls):
+        if not cls.DIR.is_dir():
+            return []
+        return sorted(entry.name for entry in os.scandir(cls.DIR) if entry.is_dir() and not entry.name.startswith("."))
+
+    @staticmethod
+    def _slice(ts, values, since: float = None, until: float = None):
+        lo = 0 if since is None else int(np.searchsorted(ts, int(since * 1000), side="left"))
+        hi = len(ts) if until is None else int(np.searchsorted(ts, int(until * 1000), side="left"))
+        t = np.asarray(ts[lo:hi])
+        v = np.asarray(values[lo:hi], dtype=np.float64)
+        valid = ~np.isnan(v)
+        return t[valid], v[valid]
+
+    @staticmethod
+    def _buckets(t, v, bucket_ms: int):
+        """t 需已排序；回傳 (桶起點, min, max, sum, count)。"""
+        keys = t // bucket_ms
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=np.intp)
+        if len(starts) == 0:
+            empty = np.array([], dtype=np.float64)
+            return np.array([], dtype=np.int64), empty, empty, empty, np.array([], dtype=np.int64)
+        counts = np.diff(np.r_[starts, len(t)])
+        return (
+            keys[starts] * bucket_ms,
+            np.minimum.reduceat(v, starts),
+            np.maximum.reduceat(v, starts),
+            np.add.reduceat(v, starts),
+            counts,
+        )
+
+    @staticmethod
+    def _bucket_points(keys, mins, maxs, sums, counts):
+        return [
+            {"ts": k / 1000, "min": round(lo, PRECISION), "max": round(hi, PRECISION),
+             "mean": round(s / n, PRECISION), "count": n}
+            for k, lo, hi, s, n in zip(keys.tolist(), mins.tolist(), maxs.tolist(), sums.tolist(), counts.tolist())
+        ]
+
+    @classmethod
+    def _check_size(cls, since, until, bucket: int):
+        if since is not None and until is not None and (until - since) / bucket > cls.MAX_POINTS:
+            raise HTTPException(status_code=400, detail=f"Too many buckets (max {cls.MAX_POINTS})")
+
+    @classmethod
+    def query(cls, machine: str, field: str, since: float = None, until: float = None, bucket: int = None) -> dict:
+        """單一機台；bucket 為 None 時回傳原始資料點（最多 MAX_POINTS 筆，取最新的）。"""
+        if bucket is not None:
+            cls._check_size(since, until, bucket)
+        loaded = cls._load(machine, field)
+        result = {"machine": machine, "field": field, "bucket": bucket, "points": []}
+        if loaded is None:
+            return result
+        t, v = cls._slice(*loaded, since, until)
+        if bucket is None:
+            result["truncated"] = len(t) > cls.MAX_POINTS
+            result["points"] = _points(t[-cls.MAX_POINTS:], v[-cls.MAX_POINTS:])
+            return result
+
+        buckets = cls._buckets(t, v, bucket * 1000)
+        if len(buckets[0]) > cls.MAX_POINTS:
+            raise HTTPException(status_code=400, detail=f"Too many buckets (max {cls.MAX_POINTS})")
+        result["points"] = cls._bucket_points(*buckets)
+        if len(v):
+            result["summary"] = {
+                "min": round(float(v.min()), PRECISION),
+                "max": round(float(v.max()), PRECISION),
+                "mean": round(float(v.mean()), PRECISION),
+                "count": len(v),
+            }
+        return result
+
+    @classmethod
+    def fleet(cls, field: str, since: float = None, until: float = None, bucket: int = 3600, machines=None) -> dict:
+        """多台機台合併分桶：先各自分桶，再以桶為單位合併 min / max / sum / count。"""
+        cls._check_size(since, until, bucket)
+        bucket_ms = bucket * 1000
+        parts = []
+        names = machines or cls.machines()
+        for machine in names:
+            loaded = cls._load(machine, field)
+            if loaded is not None:
+                parts.append(cls._buckets(*cls._slice(*loaded, since, until), bucket_ms))
+
+        result = {"field": field, "bucket": bucket, "machines": len(parts), "points": []}
+        if not parts:
+            return result
+        keys, mins, maxs, sums, counts = (np.concatenate(column) for column in zip(*parts))
+        if len(keys) == 0:
+            return result
+        order = np.argsort(keys, kind="stable")
+        keys, mins, maxs, sums, counts = keys[order], mins[order], maxs[order], sums[order], counts[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        if len(starts) > cls.MAX_POINTS:
+            raise HTTPException(status_code=400, detail=f"Too many buckets (max {cls.MAX_POINTS})")
+        result["points"] = cls._bucket_points(
+            keys[starts],
+            np.minimum.reduceat(mins, starts),
+            np.maximum.reduceat(maxs, starts),
+            np.add.reduceat(sums, starts),
+            np.add.reduceat(counts, starts),
+        )
+        return result
@@ -0,0 +1,21 @@
+"""pytest 共用設定（於 backend 目錄執行 python -m pytest）。
+
+config 在 import 時讀取環境變數，這裡先把資料與 log 目錄指到暫存目錄，
+並關閉需要 MySQL 的啟動步驟，測試不會碰到正式環境的檔案或資料庫。
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+BACKEND = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BACKEND))
+
+_workdir = tempfile.mkdtemp(prefix="linepay-tests-")
+os.environ.update({
+    "DATA_DIR": f"{_workdir}/data",
+    "LOG_DIR": f"{_workdir}/logs",
+    "DB_MIGRATE_ON_STARTUP": "0",
+    "DB_POOL_MINSIZE": "0",
+    "APP_LOG_LEVEL": "WARNING",
+})
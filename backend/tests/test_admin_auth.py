@@ -0,0 +1,50 @@
+import pytest
+from fastapi.testclient import TestClient
+import app as app_module
+import config
+from transaction_query import TransactionQuery
+
+
+@pytest.fixture
+def client(monkeypatch):
+    async def page(*args):
+        return {"items": [], "next_cursor": None}
+
+    monkeypatch.setattr(TransactionQuery, "page", staticmethod(page))
+    return TestClient(app_module.app)
+
+
+def test_admin_api_is_disabled_without_token(client, monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "")
+    assert client.get("/api/admin/transactions").status_code == 503
+
+
+@pytest.mark.parametrize("headers, status_code", [
+    ({}, 401),
+    ({"Authorization": "Bearer wrong"}, 401),
+    ({"Authorization": "Bearer s3cret"}, 200),
+    ({"X-Admin-Token": "s3cret"}, 200),
+])
+def test_admin_api_requires_token(client, monkeypatch, headers, status_code):
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "s3cret")
+    assert client.get("/api/admin/transactions", headers=headers).status_code == status_code
+
+
+@pytest.mark.parametrize("path", ["/api/linepay/inquire/batch", "/api/linepay/refund/batch"])
+def test_batch_apis_require_token(client, monkeypatch, path):
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "s3cret")
+    assert client.post(path, json={}).status_code == 401
+
+
+def test_credential_invalidation_requires_token(client, monkeypatch):
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "s3cret")
+    assert client.delete("/api/admin/credentials").status_code == 401
+    response = client.delete("/api/admin/credentials", headers={"X-Admin-Token": "s3cret"})
+    assert response.json()["status"] == "success"
+
+
+@pytest.mark.parametrize("path", ["/api/admin/leader", "/api/admin/upstreams", "/api/admin/b010/stats"])
+def test_admin_status_apis_require_token(client, monkeypatch, path):
+    monkeypatch.setattr(config, "ADMIN_TOKEN", "s3cret")
+    assert client.get(path).status_code == 401
+    assert client.get(path, headers={"X-Admin-Token": "s3cret"}).status_code == 200
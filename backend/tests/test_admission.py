@@ -0,0 +1,126 @@
+import asyncio
+from collections import OrderedDict, deque
+import pytest
+from admission import MAX_BODY_BYTES, AdmissionController, AdmissionMiddleware, Rejected
+
+
+@pytest.fixture(autouse=True)
+def controller(monkeypatch):
+    for name, value in {
+        "in_flight": 0, "_waiters": deque(), "_machines": OrderedDict(),
+        "MAX_IN_FLIGHT": 1, "QUEUE_SIZE": 2, "QUEUE_TIMEOUT": 0.05, "MACHINE_CONCURRENCY": 1,
+    }.items():
+        monkeypatch.setattr(AdmissionController, name, value)
+
+
+def test_queue_timeout_rejects_and_cleans_up():
+    async def scenario():
+        await AdmissionController.acquire()
+        with pytest.raises(Rejected) as rejected:
+            await AdmissionController.acquire()
+        assert (rejected.value.status_code, rejected.value.reason) == (503, "queue_timeout")
+        assert not AdmissionController._waiters
+        assert AdmissionController.in_flight == 1
+        AdmissionController.release()
+
+    asyncio.run(scenario())
+    assert AdmissionController.in_flight == 0
+
+
+def test_release_hands_slot_to_waiter(monkeypatch):
+    monkeypatch.setattr(AdmissionController, "QUEUE_TIMEOUT", 5.0)
+
+    async def scenario():
+        await AdmissionController.acquire()
+        waiting = asyncio.create_task(AdmissionController.acquire())
+        await asyncio.sleep(0)
+        assert len(AdmissionController._waiters) == 1
+        AdmissionController.release()
+        await waiting
+        assert AdmissionController.in_flight == 1  # 名額直接轉交，不經過 0
+        AdmissionController.release()
+
+    asyncio.run(scenario())
+    assert AdmissionController.in_flight == 0
+
+
+def test_queue_full_rejects(monkeypatch):
+    monkeypatch.setattr(AdmissionController, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(AdmissionController, "QUEUE_TIMEOUT", 5.0)
+
+    async def scenario():
+        await AdmissionController.acquire()
+        waiting = asyncio.create_task(AdmissionController.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Rejected) as rejected:
+            await AdmissionController.acquire()
+        assert rejected.value.reason == "queue_full"
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        AdmissionController.release()
+
+    asyncio.run(scenario())
+    assert AdmissionController.in_flight == 0 and not AdmissionController._waiters
+
+
+def handoff_then(exc):
+    """模擬 wait_for 在名額已轉交給 waiter 的同時丟出 exc（Python 3.12 的逾時、或取消）。"""
+    async def wait_for(waiter, timeout):
+        AdmissionController.release()
+        assert waiter.done()
+        raise exc
+    return wait_for
+
+
+def test_timeout_after_handoff_keeps_slot(monkeypatch):
+    async def scenario():
+        await AdmissionController.acquire()
+        monkeypatch.setattr(asyncio, "wait_for", handoff_then(asyncio.TimeoutError()))
+        await AdmissionController.acquire()  # 已拿到名額，不能回 503 後把名額漏掉
+        assert AdmissionController.in_flight == 1
+        AdmissionController.release()
+
+    asyncio.run(scenario())
+    assert AdmissionController.in_flight == 0
+
+
+def test_cancel_after_handoff_returns_slot(monkeypatch):
+    async def scenario():
+        await AdmissionController.acquire()
+        monkeypatch.setattr(asyncio, "wait_for", handoff_then(asyncio.CancelledError()))
+        with pytest.raises(asyncio.CancelledError):
+            await AdmissionController.acquire()
+
+    asyncio.run(scenario())
+    assert AdmissionController.in_flight == 0 and not AdmissionController._waiters
+
+
+def test_machine_concurrency_limit():
+    async def scenario():
+        state = await AdmissionController.acquire("M1")
+        with pytest.raises(Rejected) as rejected:
+            await AdmissionController.acquire("M1")
+        assert (rejected.value.status_code, rejected.value.reason) == (429, "machine_busy")
+        AdmissionController.release(state)
+
+    asyncio.run(scenario())
+    assert AdmissionController.in_flight == 0
+
+
+def test_oversized_body_is_rejected_before_admission():
+    called, sent = [], []
+
+    async def app(scope, receive, send):
+        called.append(scope)
+
+    async def receive():
+        return {"type": "http.request", "body": b'{"machine": "M1", "pad": "' + b"x" * MAX_BODY_BYTES, "more_body": True}
+
+    async def send(message):
+        sent.append(message)
+
+    middleware = AdmissionMiddleware(app, paths=["/api/pay"])
+    asyncio.run(middleware({"type": "http", "method": "POST", "path": "/api/pay"}, receive, send))
+    assert not called
+    assert sent[0]["status"] == 413
+    assert AdmissionController.in_flight == 0
@@ -0,0 +1,34 @@
+import asyncio
+import time
+import pytest
+from credential_cache import CredentialCache, _Entry
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    for name, value in {
+        "_entries": {}, "_inflight": {}, "_generation": 0,
+        "STALE_IF_ERROR": True, "STALE_MAX_AGE": 600.0, "STALE_WAIT": 1.0,
+    }.items():
+        monkeypatch.setattr(CredentialCache, name, value)
+
+
+@pytest.mark.parametrize("error", [ValueError("bad json"), KeyError("data"), RuntimeError("circuit open")])
+def test_any_refresh_failure_serves_stale_entry(monkeypatch, error):
+    async def fetch(cache_key):
+        raise error
+
+    monkeypatch.setattr(CredentialCache, "_fetch", staticmethod(fetch))
+    expired = _Entry({"channel_id": "old"}, time.monotonic() - 120, 60)
+    CredentialCache._entries[("k", "M1")] = expired
+
+    assert asyncio.run(CredentialCache.get("k", "M1")) == {"channel_id": "old"}
+
+
+def test_refresh_failure_without_stale_entry_raises(monkeypatch):
+    async def fetch(cache_key):
+        raise ValueError("bad json")
+
+    monkeypatch.setattr(CredentialCache, "_fetch", staticmethod(fetch))
+    with pytest.raises(ValueError):
+        asyncio.run(CredentialCache.get("k", "M1"))
@@ -0,0 +1,94 @@
+import hashlib
+import json
+import logging
+import urllib.parse
+import pytest
+from esun_codec import EsunCodec, EsunDecodeError, _unquote
+
+
+def original_encode(store_id, term_id, hash_key, order_no, barcode, amount, order_dt):
+    # 改用 EsunCodec 之前的編碼方式
+    transaction_data = {
+        "StoreID": store_id, "TermID": term_id, "Timeout": 20, "BuyerID": barcode, "OrderNo": order_no,
+        "OrderCurrency": "TWD", "OrderAmount": amount, "OrderDT": order_dt, "OrderTitle": order_no,
+        "BuyerPaymentType": 1,
+    }
+    transaction_data_encoded = urllib.parse.quote(json.dumps(transaction_data, separators=(",", ":")), safe="")
+    hash_digest = hashlib.sha256(
+        ("tradeapi" + "payment" + transaction_data_encoded + hash_key).encode("utf-8")
+    ).hexdigest().upper()
+    final_payload = {
+        "Type": "tradeapi", "Action": "payment", "TransactionData": transaction_data_encoded, "HashDigest": hash_digest,
+    }
+    return f"json={urllib.parse.quote(json.dumps(final_payload, separators=(',', ':')), safe='')}"
+
+
+def response_body(result: dict, action: str = "payment") -> bytes:
+    data = urllib.parse.quote(json.dumps(result, ensure_ascii=False, separators=(",", ":")), safe="")
+    outer = {"Type": "tradeapi", "Action": action, "TransactionData": data, "HashDigest": ""}
+    return urllib.parse.quote(json.dumps(outer, separators=(",", ":")), safe="").encode("ascii")
+
+
+@pytest.mark.parametrize("store_id, term_id, order_no, barcode, amount", [
+    ("STORE001", "T00001", "20260101120000123ab M1", "281234567890", 120),
+    (12345, 678, "order/with&symbols?", "28 00", 1),
+    ("店家", "T-1", "中文訂單", "280000000000", 999999),
+])
+def test_payment_encoding_matches_original(store_id, term_id, order_no, barcode, amount):
+    args = (store_id, term_id, "mock-hash-key", order_no, barcode, amount, "20260101120000")
+    request = EsunCodec.terminal(*args[:3]).payment(*args[3:])
+    assert request.content == original_encode(*args)
+
+
+def test_digest_verifies_like_the_gateway():
+    request = EsunCodec.terminal("STORE001", "T00001", "secret").payment("O1", "281234567890", 50, "20260101120000")
+    outer = json.loads(urllib.parse.unquote(request.content.removeprefix("json=")))
+    source = f"{outer['Type']}{outer['Action']}{outer['TransactionData']}secret"
+    assert hashlib.sha256(source.encode("utf-8")).hexdigest().upper() == outer["HashDigest"] == request.digest
+    # 同一台機台重複使用快取的簽章前綴，結果不受前一筆影響
+    again = EsunCodec.terminal("STORE001", "T00001", "secret").payment("O1", "281234567890", 50, "20260101120000")
+    assert again == request
+
+
+def test_decode_round_trip():
+    result = {"ReturnCode": "00", "ReturnMessage": "交易成功", "OrderNo": "O1", "TradeAmount": 120}
+    response = EsunCodec.decode(response_body(result), "payment")
+    assert response.approved
+    assert response.return_message == "交易成功"
+    assert response.data()["TransactionData"] == result
+    # str 與 bytes 的結果相同
+    assert EsunCodec.decode(response_body(result).decode("ascii"), "payment").data() == response.data()
+
+
+def test_decode_different_action_only_warns(caplog):
+    body = response_body({"ReturnCode": "00", "OrderNo": "O1"}, action="Payment")
+    with caplog.at_level(logging.WARNING, logger="esun_codec"):
+        response = EsunCodec.decode(body, "payment")
+    assert response.return_code == "00"
+    assert "differs" in caplog.text
+
+
+@pytest.mark.parametrize("data", [b"100%", b"a%ZZb%41", b"%E4%B8%AD%", b"%4", b"50%25 off"])
+def test_unquote_matches_standard_on_malformed_escapes(data):
+    assert _unquote(data) == urllib.parse.unquote_to_bytes(data)
+
+
+def test_decode_accepts_literal_percent_in_message():
+    # 閘道回應的 TransactionData 中未編碼的 % 不應讓整個回應被視為無法解析
+    data = urllib.parse.quote('{"ReturnCode":"00","ReturnMessage":"100PCT","OrderNo":"O1"}', safe="")
+    data = data.replace("PCT", "%")
+    outer = {"Type": "tradeapi", "Action": "payment", "TransactionData": data, "HashDigest": ""}
+    body = urllib.parse.quote(json.dumps(outer, separators=(",", ":")), safe="").encode("ascii")
+    assert EsunCodec.decode(body, "payment").return_message == "100%"
+
+
+@pytest.mark.parametrize("body", [
+    b"",
+    b"not json",
+    b"%7B%22Type%22%3A%22tradeapi%22%7D",  # 沒有 TransactionData
+    response_body({"ReturnMessage": "missing code"}),
+    b"%ZZ",
+])
+def test_decode_rejects_malformed_responses(body):
+    with pytest.raises(EsunDecodeError):
+        EsunCodec.decode(body, "payment")
@@ -0,0 +1,75 @@
+import asyncio
+from collections import OrderedDict
+import pytest
+from fastapi import HTTPException
+from idempotency import IdempotencyStore, OrderIdGenerator, error_response
+from shared_state import SharedEvents
+
+
+@pytest.fixture(autouse=True)
+def store(monkeypatch):
+    published = []
+    monkeypatch.setattr(IdempotencyStore, "_entries", OrderedDict())
+    monkeypatch.setattr(IdempotencyStore, "_inflight", {})
+    monkeypatch.setattr(SharedEvents, "publish", lambda channel, payload: published.append(payload))
+
+    async def load(key):
+        raise AssertionError("unexpected database lookup")
+
+    monkeypatch.setattr(IdempotencyStore, "_load", classmethod(lambda cls, key: load(key)))
+    return published
+
+
+def counting(result=None, error=None, delay=0.01):
+    calls = []
+
+    async def func():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+    return func, calls
+
+
+def test_concurrent_requests_call_upstream_once():
+    func, calls = counting({"status": "success"})
+
+    async def scenario():
+        return await asyncio.gather(*[IdempotencyStore.run("test", "k", func, lookup=False) for _ in range(5)])
+
+    assert asyncio.run(scenario()) == [{"status": "success"}] * 5
+    assert len(calls) == 1
+    # 完成後重送直接回傳記住的結果
+    assert asyncio.run(IdempotencyStore.run("test", "k", func, lookup=True)) == {"status": "success"}
+    assert len(calls) == 1
+
+
+def test_exceptions_are_not_remembered():
+    func, calls = counting(error=HTTPException(status_code=400, detail="no result"))
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            asyncio.run(IdempotencyStore.run("test", "k", func, lookup=False))
+    assert len(calls) == 2
+
+
+def test_rejections_are_remembered_and_replayed():
+    func, calls = counting(error_response(400, "declined"))
+    for _ in range(2):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(IdempotencyStore.run("test", "k", func, lookup=False))
+        assert (error.value.status_code, error.value.detail) == (400, "declined")
+    assert len(calls) == 1
+
+
+def test_shared_response_is_redacted(store):
+    IdempotencyStore.remember("k", {"status": "success", "data": {"barcode": "281234567890", "amount": 1}})
+    assert store == [{"key": "k", "response": {"status": "success", "data": {"barcode": "***7890", "amount": 1}}}]
+    assert IdempotencyStore._cached("k")["data"]["barcode"] == "281234567890"
+
+
+def test_keys_and_order_ids():
+    assert IdempotencyStore.make_key("linepay", "client-1", "M1") == IdempotencyStore.make_key("linepay", "client-1", "M2")
+    assert IdempotencyStore.make_key("linepay", None, "M1", "b", 1) != IdempotencyStore.make_key("linepay", None, "M1", "b", 2)
+    ids = [OrderIdGenerator.next("M1") for _ in range(1000)]
+    assert ids == sorted(ids) and len(set(ids)) == len(ids)
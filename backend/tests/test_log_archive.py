@@ -0,0 +1,25 @@
+import os
+import time
+from log_archive import LogArchive, SUFFIX
+
+
+def test_corrupt_archive_skips_only_that_day(tmp_path, monkeypatch):
+    monkeypatch.setattr(LogArchive, "DIR", tmp_path / "archive")
+    monkeypatch.setattr(LogArchive, "AFTER_DAYS", 1)
+    machine_dir = tmp_path / "logs" / "M1"
+    machine_dir.mkdir(parents=True)
+    now = time.time()
+    for name, age_days in (("a.log", 10), ("b.log", 5), ("latest.log", 0)):
+        path = machine_dir / name
+        path.write_text(f"{name}\n")
+        mtime = now - age_days * 86400
+        os.utime(path, (mtime, mtime))
+
+    corrupt_day = LogArchive._day(now - 10 * 86400)
+    (LogArchive.DIR / "M1").mkdir(parents=True)
+    (LogArchive.DIR / "M1" / f"{corrupt_day}{SUFFIX}").write_bytes(b"not an archive")
+
+    archived = LogArchive.compact_machine(machine_dir, now)
+    assert archived == [machine_dir / "b.log"]
+    assert (machine_dir / "a.log").exists()
+    assert LogArchive.list_files("M1")["b.log"]
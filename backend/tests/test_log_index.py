@@ -0,0 +1,34 @@
+import pytest
+import logfile
+from log_archive import LogArchive
+from log_index import FileMeta, LogIndex
+
+
+@pytest.fixture(autouse=True)
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(LogIndex, "DB_PATH", tmp_path / "log_index.sqlite")
+    monkeypatch.setattr(LogIndex, "_machines", {})
+    monkeypatch.setattr(LogIndex, "_loaded", False)
+    monkeypatch.setattr(LogArchive, "DIR", tmp_path / "archive")
+
+
+def test_changes_during_rebuild_are_kept(tmp_path, monkeypatch):
+    base_dir = tmp_path / "logs"
+    (base_dir / "M1").mkdir(parents=True)
+    (base_dir / "M1" / "old.log").write_bytes(b"a\\nb")
+    count_lines = logfile.count_lines
+
+    def upload_while_scanning(f):
+        # 重建掃描到 old.log 時，另一個請求刪除它並上傳 new.log
+        LogIndex.remove("M1", "old.log")
+        LogIndex.update("M1", "new.log", FileMeta(1, 1.0, 1))
+        return count_lines(f)
+
+    monkeypatch.setattr(logfile, "count_lines", upload_while_scanning)
+    LogIndex.rebuild(base_dir)
+    assert LogIndex.get("M1", "old.log") is None
+    assert LogIndex.get("M1", "new.log") == FileMeta(1, 1.0, 1)
+
+    # SQLite 與記憶體一致，重新載入的結果相同
+    LogIndex.load()
+    assert sorted(LogIndex._machines["M1"]) == ["new.log"]
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import pytest
+from log_index import LogIndex
+from log_search import LogSearch, SearchIndex, scan_file
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(SearchIndex, "DB_PATH", tmp_path / "search_index.sqlite")
+
+    def add(machine: str, filename: str, content: bytes):
+        path = tmp_path / machine / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+        SearchIndex.index_file(machine, filename, path, 1.0)
+        return machine, filename, 1.0
+
+    return add
+
+
+def test_query_terms_unescape_line_separator():
+    # 字面 "\n" 之後是一行的開頭，不能和 n 連成 "nwarn"
+    assert SearchIndex.query_terms(r"disk full\nWARN retry") == ({"full", "warn"}, {"retry"})
+    assert SearchIndex.query_terms(r"\nWARN") == (set(), {"warn"})
+    # 查詢的第一個詞可能是檔案中某個 token 的後半段，不用來篩選
+    assert SearchIndex.query_terms("rror disk") == (set(), {"disk"})
+
+
+def test_filter_keeps_match_on_first_word_of_line_and_file(index):
+    first = index("M1", "a.log", rb"ERROR disk full\nWARN retry later" + b"\nINFO done")
+    other = index("M2", "b.log", b"INFO nothing to see\n")
+
+    assert SearchIndex.filter_candidates(r"full\nWARN retry", [first, other]) == [first]
+    assert SearchIndex.filter_candidates("\nINFO done", [first, other]) == [first]
+    assert SearchIndex.filter_candidates("ERROR disk", [first, other]) == [first]
+    assert SearchIndex.filter_candidates("rror disk", [first, other]) == [first]
+
+
+def test_filter_keeps_files_without_index(index):
+    indexed = index("M1", "a.log", b"ERROR disk full\n")
+    unindexed = ("M3", "c.log", 1.0)
+    assert SearchIndex.filter_candidates("ERROR boot", [indexed, unindexed]) == [unindexed]
+
+
+@pytest.mark.parametrize("pattern", ["a*", "x?|y", "(a+)+$", "(\\w*)*b", "["])
+def test_check_pattern_rejects_unsafe_regex(pattern):
+    with pytest.raises(ValueError):
+        LogSearch.check_pattern(pattern)
+
+
+def test_search_stops_at_time_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(LogSearch, "TIMEOUT", 0)
+    monkeypatch.setattr(LogIndex, "ensure_loaded", staticmethod(lambda base_dir: asyncio.sleep(0)))
+    monkeypatch.setattr(LogSearch, "_candidates", staticmethod(lambda *args: [("M1", "a.log", 1.0)]))
+    (tmp_path / "M1").mkdir()
+    (tmp_path / "M1" / "a.log").write_bytes(b"error\\nerror\n")
+
+    async def collect():
+        return [json.loads(line) async for line in LogSearch.search(tmp_path, "error")]
+
+    lines = asyncio.run(collect())
+    assert lines[-1]["timed_out"] is True and lines[-1]["matches"] == 0
+
+
+def test_scan_reports_each_line_once(tmp_path):
+    path = tmp_path / "a.log"
+    path.write_bytes(b"warn warn\\nok\nwarn\n")
+    results = scan_file(str(path), b"warn", 0, 0, 10)
+    assert [(line_no, text) for line_no, text, _, _ in results] == [(1, "warn warn"), (3, "warn")]
@@ -0,0 +1,11 @@
+import json
+import logfile
+
+
+def test_json_string_chunks_matches_json_dumps():
+    text = 'line "1"\n中文\\tab\n'
+    data = text.encode("utf-8")
+    # 每個位元組一段，中文字的位元組會被切開
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    encoded = b"".join(logfile.json_string_chunks(chunks))
+    assert json.loads(encoded) == text
@@ -0,0 +1,56 @@
+import asyncio
+import pytest
+from migrate import _execute, _statements, MIGRATIONS_DIR
+
+
+class FakeCursor:
+    """模擬 information_schema：columns 為現有欄位，indexes 為現有索引，executed 為實際執行的 DDL。"""
+
+    def __init__(self, columns, indexes=()):
+        self.columns = set(columns)
+        self.indexes = set(indexes)
+        self.executed = []
+        self._result = []
+
+    async def execute(self, sql, args=None):
+        if "information_schema.COLUMNS" in sql:
+            self._result = [(column,) for column in self.columns]
+        elif "information_schema.STATISTICS" in sql:
+            self._result = [(1,)] if args[1] in self.indexes else []
+        else:
+            self.executed.append(sql)
+
+    async def fetchall(self):
+        return self._result
+
+    async def fetchone(self):
+        return self._result[0] if self._result else None
+
+
+def run(cursor, version):
+    async def scenario():
+        for statement in _statements((MIGRATIONS_DIR / f"{version}.sql").read_text(encoding="utf-8")):
+            await _execute(cursor, version, statement)
+
+    asyncio.run(scenario())
+
+
+def test_rerun_skips_steps_that_already_took_effect():
+    # 上次加了 idempotency_key 後失敗：重跑只補 response_json 與索引
+    cursor = FakeCursor({"id", "created_at", "machine", "status", "idempotency_key"})
+    run(cursor, "001_linepay_transactions_idempotency")
+    assert len(cursor.executed) == 2
+    assert "response_json" in cursor.executed[0]
+    assert cursor.executed[1].startswith("CREATE INDEX idx_linepay_transactions_idempotency_key")
+
+    done = FakeCursor({"id", "created_at", "idempotency_key", "response_json"},
+                      {"idx_linepay_transactions_idempotency_key"})
+    run(done, "001_linepay_transactions_idempotency")
+    assert done.executed == []
+
+
+def test_index_on_missing_column_fails_clearly():
+    cursor = FakeCursor({"id", "machine", "status"})
+    with pytest.raises(RuntimeError, match="no column created_at"):
+        run(cursor, "002_linepay_transactions_query_indexes")
+    assert cursor.executed == []
@@ -0,0 +1,90 @@
+import asyncio
+from collections import OrderedDict
+import pytest
+from idempotency import IdempotencyStore
+from reconciliation import ReconciliationEngine
+from shared_state import SharedEvents
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """每個測試使用新的 SQLite；db.saved 為寫入 linepay_transactions 的最終結果。"""
+    for name, value in {
+        "DB_PATH": tmp_path / "reconciliation.sqlite", "BASE_DELAY": 0.0, "MAX_ATTEMPTS": 2,
+        "_checkers": {}, "_responders": {}, "_unrecorded": set(), "_inflight": set(), "_wakeup": None,
+    }.items():
+        monkeypatch.setattr(ReconciliationEngine, name, value)
+    monkeypatch.setattr(IdempotencyStore, "_entries", OrderedDict())
+    monkeypatch.setattr(SharedEvents, "publish", lambda channel, payload: None)
+
+    saved = []
+
+    async def save_final(order_id, request, status, return_code, return_message, response=None):
+        saved.append((order_id, status, response))
+
+    monkeypatch.setattr(ReconciliationEngine, "_save_final", staticmethod(save_final))
+    return saved
+
+
+def run_due():
+    async def scenario():
+        ReconciliationEngine._semaphore = asyncio.Semaphore(4)
+        await ReconciliationEngine._dispatch_due()
+        await asyncio.gather(*ReconciliationEngine._inflight)
+    asyncio.run(scenario())
+
+
+def respond(order_id, status, return_code, return_message, data):
+    return {"status": status, "orderId": order_id, "code": return_code}
+
+
+def test_final_result_is_saved_and_replaces_pending_response(engine):
+    ReconciliationEngine.register("test", lambda record: asyncio.sleep(0, ("success", "00", "ok", {"n": 1})),
+                                  respond=respond)
+    pending = asyncio.run(ReconciliationEngine.submit("test", "O1", {"machine": "M1"}, idempotency_key="k1"))
+    IdempotencyStore.remember("k1", pending)
+
+    run_due()
+    status = asyncio.run(ReconciliationEngine.get_status("O1", "test"))
+    assert (status["status"], status["return_code"], status["data"]) == ("success", "00", {"n": 1})
+    assert engine == [("O1", "success", {"status": "success", "orderId": "O1", "code": "00"})]
+    assert IdempotencyStore._cached("k1") == {"status": "success", "orderId": "O1", "code": "00"}
+
+
+def test_status_is_filtered_by_provider(engine):
+    ReconciliationEngine.register("test", lambda record: asyncio.sleep(0, None))
+    asyncio.run(ReconciliationEngine.submit("test", "O1", {}))
+    assert asyncio.run(ReconciliationEngine.get_status("O1", "test"))["status"] == "pending"
+    assert asyncio.run(ReconciliationEngine.get_status("O1", "other")) is None
+
+
+def test_unresolved_orders_expire_after_max_attempts(engine):
+    ReconciliationEngine.register("test", lambda record: asyncio.sleep(0, None))
+    asyncio.run(ReconciliationEngine.submit("test", "O1", {}))
+    run_due()
+    assert asyncio.run(ReconciliationEngine.get_status("O1"))["attempts"] == 1
+    asyncio.run(ReconciliationEngine._query("UPDATE pending_orders SET next_attempt_at = 0"))
+    run_due()
+    status = asyncio.run(ReconciliationEngine.get_status("O1"))
+    assert (status["status"], status["attempts"]) == ("expired", 2)
+    assert engine == []
+
+
+def test_failed_save_keeps_order_pending(engine, monkeypatch):
+    async def save_final(*args, **kwargs):
+        raise ConnectionError("mysql down")
+
+    monkeypatch.setattr(ReconciliationEngine, "_save_final", staticmethod(save_final))
+    ReconciliationEngine.register("test", lambda record: asyncio.sleep(0, ("failed", "1104", "declined", {})))
+    asyncio.run(ReconciliationEngine.submit("test", "O1", {}, idempotency_key="k1"))
+    run_due()
+    assert asyncio.run(ReconciliationEngine.get_status("O1"))["status"] == "pending"
+    assert IdempotencyStore._cached("k1") is None
+
+
+def test_unrecorded_provider_skips_linepay_transactions(engine):
+    ReconciliationEngine.register("test", lambda record: asyncio.sleep(0, ("success", "00", "", {})), record=False)
+    asyncio.run(ReconciliationEngine.submit("test", "O1", {}, idempotency_key="k1"))
+    run_due()
+    assert engine == []
+    assert IdempotencyStore._cached("k1") == {"status": "success", "orderId": "O1", "data": {}}
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+import pytest
+from shared_state import SharedEvents
+
+
+@pytest.fixture
+def events(tmp_path, monkeypatch):
+    for name, value in {
+        "DB_PATH": tmp_path / "shared_state.sqlite", "POLL_INTERVAL": 0.02,
+        "_conn": None, "_lock": threading.Lock(), "_pending": deque(), "_data_version": None,
+        "_last_id": 0, "_last_prune": 0.0, "_subscribers": {}, "_task": None, "_loop": None, "_wakeup": None,
+    }.items():
+        monkeypatch.setattr(SharedEvents, name, value)
+    return SharedEvents
+
+
+def foreign_event(path, channel: str, payload: dict):
+    # 模擬另一個 worker 寫入
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "INSERT INTO events (channel, origin, payload, created_at) VALUES (?, 'other', ?, ?)",
+            (channel, json.dumps(payload), time.time()),
+        )
+    conn.close()
+
+
+def stored(path):
+    conn = sqlite3.connect(path)
+    try:
+        return [(channel, json.loads(payload)) for channel, payload in conn.execute(
+            "SELECT channel, payload FROM events WHERE origin != 'other' ORDER BY id"
+        )]
+    finally:
+        conn.close()
+
+
+def test_publish_does_not_touch_sqlite(events, monkeypatch):
+    def fail():
+        raise AssertionError("publish must not open SQLite")
+
+    monkeypatch.setattr(SharedEvents, "_connection", classmethod(lambda cls: fail()))
+    events.publish("idempotency", {"key": "k"})
+    assert len(events._pending) == 1
+
+
+def test_events_are_written_in_background_and_dispatched(events):
+    received = []
+
+    async def slow_handler(payload):
+        await asyncio.sleep(0)
+        received.append(("async", payload))
+
+    events.subscribe("demo", lambda payload: received.append(("sync", payload)))
+    events.subscribe("demo", slow_handler)
+
+    async def scenario():
+        await events.start()
+        events.publish("demo", {"n": 1})
+        threading.Thread(target=events.publish, args=("demo", {"n": 2})).start()
+        foreign_event(events.DB_PATH, "demo", {"n": 3})
+        for _ in range(100):
+            if len(received) == 2 and len(stored(events.DB_PATH)) == 2:
+                break
+            await asyncio.sleep(0.02)
+        events.publish("demo", {"n": 4})
+        await events.stop()
+
+    asyncio.run(scenario())
+    # 自己發出的事件不會回到自己身上
+    assert received == [("sync", {"n": 3}), ("async", {"n": 3})]
+    assert stored(events.DB_PATH) == [("demo", {"n": 1}), ("demo", {"n": 2}), ("demo", {"n": 4})]
@@ -0,0 +1,47 @@
+import json
+import logging
+import queue
+import sys
+from structured_logging import ContextQueueHandler, JsonFormatter, order_id_var
+
+
+def format_record(msg, *args, exc_info=None):
+    record = logging.LogRecord("esunpay", logging.ERROR, __file__, 1, msg, args, exc_info)
+    return json.loads(JsonFormatter().format(record))
+
+
+def test_message_and_exception_are_masked():
+    try:
+        raise ValueError('{"BuyerID": "281234567890"} hash_key=secret-value')
+    except ValueError as exc:
+        entry = format_record("decode failed: %s", exc, exc_info=(type(exc), exc, exc.__traceback__))
+
+    for text in (entry["msg"], entry["exc"]):
+        assert "281234567890" not in text and "***7890" in text
+        assert "secret-value" not in text
+
+
+def test_bare_barcode_is_masked_but_order_id_is_kept():
+    entry = format_record("barcode 281234567890123456 order 20261016120000123ab1M01")
+    assert entry["msg"] == "barcode ***3456 order 20261016120000123ab1M01"
+
+
+def test_queue_handler_merges_args_and_keeps_exception():
+    log_queue = queue.Queue()
+    handler = ContextQueueHandler(log_queue)
+    args = {"amount": 100}
+    try:
+        raise RuntimeError("upstream down")
+    except RuntimeError:
+        record = logging.LogRecord("linepay", logging.ERROR, __file__, 1, "charge %(amount)s", (args,), sys.exc_info())
+    token = order_id_var.set("20261016120000123ab1")
+    try:
+        handler.emit(record)
+    finally:
+        order_id_var.reset(token)
+    args["amount"] = 999  # 進佇列後才改的參數不影響已寫的紀錄
+
+    entry = json.loads(JsonFormatter().format(log_queue.get_nowait()))
+    assert entry["msg"] == "charge 100"
+    assert entry["order_id"] == "20261016120000123ab1"
+    assert "RuntimeError: upstream down" in entry["exc"]
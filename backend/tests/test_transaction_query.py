@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+import sqlite3
+from contextlib import asynccontextmanager
+import pytest
+from fastapi import HTTPException
+import transaction_query
+from transaction_query import TransactionQuery, decode_cursor, encode_cursor
+
+BASE = datetime.datetime(2026, 1, 1, 12, 0, 0)
+
+
+class SqliteCursor:
+    """以 SQLite 執行 TransactionQuery 產生的 SQL（%s 換成 ?），回傳與 DictCursor 相同的 dict。"""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params):
+        params = [value.isoformat(" ") if isinstance(value, datetime.datetime) else value for value in params]
+        cursor = self._conn.execute(sql.replace("%s", "?"), params)
+        names = [column[0] for column in cursor.description]
+        self._rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+        for row in self._rows:
+            row["created_at"] = datetime.datetime.fromisoformat(row["created_at"])
+
+    async def fetchall(self):
+        return self._rows
+
+
+class SqliteConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursor_class=None):
+        return SqliteCursor(self._conn)
+
+
+@pytest.fixture
+def transactions(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE linepay_transactions (id INTEGER PRIMARY KEY, order_id TEXT, machine TEXT, barcode TEXT, "
+        "amount INTEGER, payway TEXT, status TEXT, return_code TEXT, return_message TEXT, created_at TEXT)"
+    )
+    # 25 筆，每 3 筆共用同一個 created_at：分頁必須以 id 區分同一時間的資料
+    for row_id in range(1, 26):
+        created_at = BASE + datetime.timedelta(seconds=row_id // 3)
+        conn.execute(
+            "INSERT INTO linepay_transactions VALUES (?, ?, ?, '', 10, 'linepay', ?, '0000', '', ?)",
+            (row_id, f"O{row_id}", "M1" if row_id % 2 else "M2", "success" if row_id % 5 else "failed",
+             created_at.isoformat(" ")),
+        )
+
+    @asynccontextmanager
+    async def acquire():
+        yield SqliteConnection(conn)
+
+    monkeypatch.setattr(transaction_query.Database, "acquire", acquire)
+    yield conn
+    conn.close()
+
+
+def all_pages(filters: dict, limit: int):
+    async def scenario():
+        pages, cursor = [], None
+        while True:
+            page = await TransactionQuery.page(filters, limit=limit, cursor=cursor)
+            pages.append([item["id"] for item in page["items"]])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return pages
+    return asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("limit", [1, 4, 7, 25, 100])
+def test_pages_cover_every_row_once_newest_first(transactions, limit):
+    pages = all_pages({}, limit)
+    ids = [row_id for page in pages for row_id in page]
+    assert ids == list(range(25, 0, -1))
+    assert all(len(page) == limit for page in pages[:-1])
+
+
+def test_pagination_with_filters(transactions):
+    ids = [row_id for page in all_pages({"machine": "M1", "status": "success"}, 3) for row_id in page]
+    assert ids == [row_id for row_id in range(25, 0, -1) if row_id % 2 and row_id % 5]
+
+
+def test_last_page_has_no_cursor(transactions):
+    assert all_pages({}, 25) == [list(range(25, 0, -1))]
+    assert all_pages({"machine": "nobody"}, 10) == [[]]
+
+
+def test_cursor_round_trip_and_invalid_cursor():
+    created_at = datetime.datetime(2026, 1, 1, 12, 0, 0, 123456)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+    with pytest.raises(HTTPException) as error:
+        decode_cursor("not-a-cursor")
+    assert error.value.status_code == 400
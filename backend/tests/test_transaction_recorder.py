@@ -0,0 +1,176 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import pymysql
+import pytest
+from leader import LeaderElection
+from transaction_recorder import COLUMNS, TransactionRecorder
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """每個測試使用全新的佇列與 spool 檔；db.batches 為寫入的批次，db.failures 不為空時寫入失敗。"""
+    for name, value in {
+        "_queue": None, "_task": None, "_write_lock": None, "_written": None,
+        "_seq": 0, "_outstanding": set(), "_last_spool_retry": 0.0,
+        "BATCH_SIZE": 3, "FLUSH_INTERVAL": 0.05, "SPOOL_RETRY_INTERVAL": 60.0,
+        "SPOOL_PATH": tmp_path / "transactions.spool",
+    }.items():
+        monkeypatch.setattr(TransactionRecorder, name, value)
+    monkeypatch.setattr(LeaderElection, "is_leader", True)
+
+    db = SimpleNamespace(batches=[], rows=[], failures=[])
+
+    async def insert(rows):
+        await asyncio.sleep(0)
+        if db.failures:
+            raise db.failures[0]
+        db.batches.append([row[0] for row in rows])
+        db.rows.extend(rows)
+
+    async def recorded_orders(order_ids):
+        return {order_id for batch in db.batches for order_id in batch if order_id in order_ids}
+
+    monkeypatch.setattr(TransactionRecorder, "_insert", staticmethod(insert))
+    monkeypatch.setattr(TransactionRecorder, "_recorded_orders", staticmethod(recorded_orders))
+    return db
+
+
+def row(order_id: str) -> dict:
+    return {"order_id": order_id, "machine": "M1", "status": "success"}
+
+
+def written(db):
+    return [order_id for batch in db.batches for order_id in batch]
+
+
+def test_batches_are_limited_to_batch_size(db):
+    async def scenario():
+        for i in range(7):
+            await TransactionRecorder.record_row(row(f"O{i}"))
+        await asyncio.sleep(0.3)
+        await TransactionRecorder.stop()
+
+    asyncio.run(scenario())
+    assert sorted(written(db)) == [f"O{i}" for i in range(7)]
+    assert all(len(batch) <= 3 for batch in db.batches)
+
+
+def test_flush_while_loop_collects_writes_each_row_once(db, monkeypatch):
+    # _run 正在收集一批（尚未滿、未到時間）時 flush：同一筆不能被兩邊各寫一次
+    monkeypatch.setattr(TransactionRecorder, "FLUSH_INTERVAL", 1.0)
+
+    async def scenario():
+        for i in range(5):
+            await TransactionRecorder.record_row(row(f"O{i}"))
+        await asyncio.sleep(0.05)
+        await TransactionRecorder.flush()
+        flushed = written(db)
+        await TransactionRecorder.record_row(row("O5"))
+        await TransactionRecorder.stop()
+        return flushed
+
+    flushed = asyncio.run(scenario())
+    assert sorted(flushed) == [f"O{i}" for i in range(5)]
+    assert sorted(written(db)) == [f"O{i}" for i in range(6)]
+
+
+def test_failed_batch_is_spooled_and_replayed(db):
+    async def scenario():
+        db.failures.append(ConnectionError("mysql down"))
+        for i in range(4):
+            await TransactionRecorder.record_row(row(f"O{i}"))
+        await TransactionRecorder.flush()
+        assert db.batches == []
+        assert len(TransactionRecorder.SPOOL_PATH.read_text(encoding="utf-8").splitlines()) == 4
+
+        db.failures.clear()
+        await TransactionRecorder._replay_spool()
+        await TransactionRecorder.stop()
+
+    asyncio.run(scenario())
+    assert sorted(written(db)) == [f"O{i}" for i in range(4)]
+    assert not TransactionRecorder.SPOOL_PATH.exists()
+    assert not TransactionRecorder._replay_path().exists()
+
+
+def test_spool_append_and_take_do_not_lose_rows(db):
+    # 其他 worker 附加的同時 leader 取走 spool：每一筆只出現一次
+    writers, per_writer = 4, 50
+    padding = (None,) * (len(COLUMNS) - 1)
+
+    def append(writer: int):
+        for i in range(per_writer):
+            TransactionRecorder._append_spool([(f"W{writer}-{i}",) + padding])
+
+    threads = [threading.Thread(target=append, args=(writer,)) for writer in range(writers)]
+    for thread in threads:
+        thread.start()
+    taken = []
+    while any(thread.is_alive() for thread in threads):
+        taken.extend(TransactionRecorder._take_spool())
+        TransactionRecorder._finish_spool([])
+    for thread in threads:
+        thread.join()
+    taken.extend(TransactionRecorder._take_spool())
+
+    order_ids = [row[0] for row in taken]
+    assert len(order_ids) == writers * per_writer
+    assert set(order_ids) == {f"W{writer}-{i}" for writer in range(writers) for i in range(per_writer)}
+
+
+def test_replay_skips_orders_already_recorded(db):
+    # pending 紀錄寫入失敗留在 spool，之後對帳已直接寫入最終結果：重送不能再多一筆 pending
+    padding = (None,) * (len(COLUMNS) - 2)
+    TransactionRecorder._append_spool([
+        ("O1", "M1") + padding, ("O2", "pending") + padding, ("O2", "success") + padding, ("O3", "M1") + padding,
+    ])
+    db.batches.append(["O3"])
+
+    async def scenario():
+        TransactionRecorder._write_lock = asyncio.Lock()
+        await TransactionRecorder._replay_spool()
+
+    asyncio.run(scenario())
+    assert db.batches == [["O3"], ["O1", "O2"]]
+    assert [row[1] for row in db.rows] == ["M1", "success"]
+    assert not TransactionRecorder._replay_path().exists()
+
+
+def test_poison_row_is_quarantined_without_blocking_the_batch(db, monkeypatch):
+    async def insert(rows):
+        if any(row[0] == "BAD" for row in rows):
+            raise pymysql.err.IntegrityError(1048, "Column 'order_id' cannot be null")
+        db.batches.append([row[0] for row in rows])
+
+    monkeypatch.setattr(TransactionRecorder, "_insert", staticmethod(insert))
+
+    async def scenario():
+        for order_id in ("O1", "BAD", "O2"):
+            await TransactionRecorder.record_row(row(order_id))
+        await TransactionRecorder.stop()
+
+    asyncio.run(scenario())
+    assert sorted(written(db)) == ["O1", "O2"]
+    assert not TransactionRecorder.SPOOL_PATH.exists()
+    rejected = TransactionRecorder.SPOOL_PATH.with_suffix(".rejected").read_text(encoding="utf-8").splitlines()
+    assert len(rejected) == 1 and '"BAD"' in rejected[0] and "IntegrityError" in rejected[0]
+
+
+def test_spool_failure_does_not_fail_the_caller(db, monkeypatch):
+    monkeypatch.setattr(TransactionRecorder, "QUEUE_SIZE", 1)
+    monkeypatch.setattr(TransactionRecorder, "ENQUEUE_TIMEOUT", 0.01)
+
+    def broken_spool(rows):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(TransactionRecorder, "_append_spool", broken_spool)
+
+    async def scenario():
+        await TransactionRecorder.start()
+        TransactionRecorder._task.cancel()  # 沒有人取出，佇列一直是滿的
+        await TransactionRecorder.record_row(row("O1"))
+        await TransactionRecorder.record_row(row("O2"))  # 放不進佇列、spool 也失敗：只記錄，不丟例外
+        assert TransactionRecorder._outstanding == {1}
+
+    asyncio.run(scenario())
@@ -0,0 +1,126 @@
+"""linepay_transactions 的查詢與匯出。
+
+- 查詢以 (created_at, id) 由新到舊做 keyset 分頁，cursor 為上一頁最後一筆的位置，不使用 OFFSET
+- 匯出使用獨立連線與 server-side cursor（SSCursor）邊讀邊送，不佔用連線池、記憶體不隨筆數成長
+"""
+import asyncio
+import base64
+import csv
+import datetime
+import io
+import json
+import aiomysql
+from fastapi import HTTPException
+from database import Database
+import config
+
+COLUMNS = (
+    "id", "order_id", "machine", "barcode", "amount", "payway",
+    "status", "return_code", "return_message", "created_at",
+)
+FILTERS = ("machine", "status", "return_code", "payway")
+
+
+def _json_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def encode_cursor(created_at: datetime.datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class TransactionQuery:
+    MAX_LIMIT = config.TRANSACTION_QUERY_MAX_LIMIT
+    FETCH_SIZE = config.TRANSACTION_EXPORT_FETCH_SIZE
+    _export_slots = asyncio.Semaphore(config.TRANSACTION_EXPORT_MAX_CONCURRENT)
+
+    @staticmethod
+    def _where(filters: dict, since: datetime.datetime = None, until: datetime.datetime = None):
+        clauses, params = [], []
+        for name in FILTERS:
+            value = filters.get(name)
+            if value is not None:
+                clauses.append(f"{name} = %s")
+                params.append(value)
+        if since is not None:
+            clauses.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at < %s")
+            params.append(until)
+        return clauses, params
+
+    @classmethod
+    async def page(cls, filters: dict, since=None, until=None, limit: int = 100, cursor: str = None) -> dict:
+        limit = min(limit, cls.MAX_LIMIT)
+        clauses, params = cls._where(filters, since, until)
+        if cursor:
+            created_at, row_id = decode_cursor(cursor)
+            clauses.append("(created_at < %s OR (created_at = %s AND id < %s))")
+            params.extend([created_at, created_at, row_id])
+        sql = f"SELECT {', '.join(COLUMNS)} FROM linepay_transactions"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        # 多取一筆判斷是否還有下一頁
+        sql += " ORDER BY created_at DESC, id DESC LIMIT %s"
+        params.append(limit + 1)
+
+        async with Database.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(sql, params)
+                rows = await cur.fetchall()
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if has_more else None
+        return {
+            "items": [{key: _json_value(value) for key, value in row.items()} for row in rows],
+            "next_cursor": next_cursor,
+        }
+
+    @classmethod
+    async def export(cls, filters: dict, since=None, until=None, fmt: str = "csv"):
+        """依序產生匯出內容；同時進行的匯出數量受 TRANSACTION_EXPORT_MAX_CONCURRENT 限制。"""
+        clauses, params = cls._where(filters, since, until)
+        sql = f"SELECT {', '.join(COLUMNS)} FROM linepay_transactions"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY created_at, id"
+
+        async with cls._export_slots:
+            conn = await Database.connect_dedicated()
+            try:
+                # 不用 async with：SSCursor 關閉時會把剩餘結果讀完，中斷時改為直接關閉連線
+                cur = await conn.cursor(aiomysql.SSCursor)
+                await cur.execute(sql, params)
+                if fmt == "csv":
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerow(COLUMNS)
+                    yield "\ufeff" + buffer.getvalue()  # BOM 讓 Excel 正確顯示中文
+                while True:
+                    rows = await cur.fetchmany(cls.FETCH_SIZE)
+                    if not rows:
+                        break
+                    if fmt == "csv":
+                        buffer = io.StringIO()
+                        csv.writer(buffer).writerows([[_json_value(value) for value in row] for row in rows])
+                        yield buffer.getvalue()
+                    else:
+                        yield "".join(
+                            json.dumps(dict(zip(COLUMNS, map(_json_value, row))), ensure_ascii=False) + "\n"
+                            for row in rows
+                        )
+            finally:
+                conn.close()
@@ -0,0 +1,387 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+import pymysql
+from database import Database
+from leader import LeaderElection
+from migrate import Migrations, IDEMPOTENCY_COLUMNS
+import config
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = (
+    "order_id", "machine", "barcode", "amount", "payway", "status", "return_code", "return_message",
+    "idempotency_key", "response_json",
+)
+BASE_COLUMNS = COLUMNS[:8]  # migration 001 之前就有的欄位
+# 單筆資料本身的問題（違反約束、值不合法）：重試也不會成功，與連線錯誤分開處理
+ROW_ERRORS = (pymysql.err.IntegrityError, pymysql.err.DataError, TypeError, ValueError)
+
+TRANSACTIONS_QUARANTINED = metrics.Counter(
+    "transactions_quarantined_total", "Transaction rows that MySQL rejected and were moved to the quarantine file",
+)
+TRANSACTIONS_LOST = metrics.Counter(
+    "transactions_lost_total", "Transaction rows that could be neither queued nor spooled",
+)
+
+
+class TransactionRecorder:
+    """交易紀錄先放入記憶體佇列，由背景工作批次寫入 linepay_transactions。
+
+    - 筆數達 BATCH_SIZE 或等待超過 FLUSH_INTERVAL 秒就寫入一次（多列 INSERT）
+    - 佇列滿時 record() 最多等待 ENQUEUE_TIMEOUT 秒，之後改寫入本機 spool 檔
+    - MySQL 無法連線時整批寫入 spool 檔，之後定期重送；重送時同一 order_id 只保留 spool 中最後一筆，
+      資料庫已有該 order_id 的紀錄（例如對帳已寫入最終結果）則略過
+    - 整批因某一筆的資料錯誤失敗時改為逐筆寫入，仍失敗的那幾筆移到 quarantine 檔（.rejected），
+      不會讓同一批的其他紀錄一直卡在 spool
+    每筆紀錄帶一個序號，flush() 等到呼叫當下已 record() 的序號都寫入（或寫入 spool）才返回。
+    """
+
+    BATCH_SIZE = config.TRANSACTION_BATCH_SIZE
+    FLUSH_INTERVAL = config.TRANSACTION_FLUSH_INTERVAL
+    QUEUE_SIZE = config.TRANSACTION_QUEUE_SIZE
+    ENQUEUE_TIMEOUT = config.TRANSACTION_ENQUEUE_TIMEOUT
+    SPOOL_RETRY_INTERVAL = config.TRANSACTION_SPOOL_RETRY_INTERVAL
+    SPOOL_PATH = Path(config.TRANSACTION_SPOOL_PATH)
+
+    _queue = None
+    _task = None
+    _write_lock = None
+    _written = None  # asyncio.Condition，_outstanding 減少時通知
+    _seq = 0
+    _outstanding = set()  # 已放入佇列、尚未寫入 MySQL 或 spool 的序號
+    _last_spool_retry = 0.0
+
+    @classmethod
+    async def start(cls):
+        if cls._task is not None:
+            return
+        cls._queue = asyncio.Queue(maxsize=cls.QUEUE_SIZE)
+        cls._write_lock = asyncio.Lock()
+        cls._written = asyncio.Condition()
+        cls._task = asyncio.create_task(cls._run())
+
+    @classmethod
+    async def stop(cls):
+        if cls._task is None:
+            return
+        cls._task.cancel()
+        try:
+            await cls._task
+        except asyncio.CancelledError:
+            pass
+        cls._task = None
+        # ✅ 關閉前把佇列內剩餘的紀錄寫完，寫不進去的留在 spool 檔
+        await cls.flush()
+
+    @classmethod
+    async def record(cls, order_id, request, status, return_code, return_message,
+                     idempotency_key=None, response=None):
+        await cls.record_row({
+            "order_id": order_id,
+            "machine": request.machine,
+            "barcode": request.barcode,
+            "amount": request.amount,
+            "payway": request.payway,
+            "status": status,
+            "return_code": return_code,
+            "return_message": return_message,
+            "idempotency_key": idempotency_key,
+            "response_json": json.dumps(response, ensure_ascii=False) if response is not None else None,
+        })
+
+    @classmethod
+    async def record_row(cls, values: dict):
+        row = tuple(values.get(column) for column in COLUMNS)
+        if cls._task is None:
+            await cls.start()
+        cls._seq += 1
+        seq = cls._seq
+        cls._outstanding.add(seq)
+        try:
+            await asyncio.wait_for(cls._queue.put((seq, row)), timeout=cls.ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("transaction queue full, spooling order %s", values.get("order_id"))
+            try:
+                await asyncio.to_thread(cls._append_spool, [row])
+            except Exception as exc:
+                # 付款已完成，紀錄寫不進去不能變成付款失敗的回應
+                TRANSACTIONS_LOST.inc()
+                logger.error("failed to spool order %s, transaction not recorded: %s", values.get("order_id"), exc)
+            finally:
+                await cls._done([seq])
+
+    @classmethod
+    async def flush(cls):
+        """寫入呼叫當下已 record() 的所有紀錄後才返回。
+
+        佇列中的由這裡直接寫入；_run 已取出、正在收集或寫入的那一批不重複寫，等它寫完。
+        """
+        if cls._queue is None:
+            return
+        waiting = set(cls._outstanding)
+        while True:
+            entries = []
+            while not cls._queue.empty():
+                entries.append(cls._queue.get_nowait())
+            for start in range(0, len(entries), cls.BATCH_SIZE):
+                await cls._write(entries[start:start + cls.BATCH_SIZE])
+            if not waiting & cls._outstanding:
+                return
+            try:
+                async with cls._written:
+                    await asyncio.wait_for(
+                        cls._written.wait_for(lambda: not waiting & cls._outstanding), timeout=cls.FLUSH_INTERVAL
+                    )
+                return
+            except asyncio.TimeoutError:
+                continue  # 佇列滿時等待中的 put() 可能在取出後才放入，再取一次
+
+    @classmethod
+    async def _run(cls):
+        await cls._replay_spool()
+        while True:
+            # 這一批只存在 _run 內，flush() 不會拿到同一份清單
+            entries = []
+            # 不用 wait_for：Python 3.11 的 wait_for 在取到資料的同時被取消會吞掉取消，stop() 會一直等下去
+            try:
+                try:
+                    async with asyncio.timeout(cls.SPOOL_RETRY_INTERVAL):
+                        entries.append(await cls._queue.get())
+                except TimeoutError:
+                    pass
+                deadline = time.monotonic() + cls.FLUSH_INTERVAL
+                while entries and len(entries) < cls.BATCH_SIZE:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        async with asyncio.timeout(remaining):
+                            entries.append(await cls._queue.get())
+                    except TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # stop() 取消時，已取出的紀錄在這裡寫完，佇列剩下的由 stop() 的 flush() 寫入
+                await cls._write(entries)
+                raise
+            await asyncio.shield(cls._write(entries))
+
+            if time.monotonic() - cls._last_spool_retry >= cls.SPOOL_RETRY_INTERVAL:
+                await cls._replay_spool()
+
+    @classmethod
+    async def _done(cls, seqs):
+        cls._outstanding.difference_update(seqs)
+        async with cls._written:
+            cls._written.notify_all()
+
+    @classmethod
+    async def _write(cls, entries) -> bool:
+        """entries 為 (序號, 紀錄)；寫入 MySQL 或 spool 後才標記完成。"""
+        if not entries:
+            return True
+        rows = [row for _, row in entries]
+        try:
+            async with cls._write_lock:
+                start = time.perf_counter()
+                unwritten = await cls._insert_rows(rows)
+                if not unwritten:
+                    metrics.BACKGROUND_TASK_DURATION.observe(time.perf_counter() - start, task="transaction_flush")
+                    return True
+                metrics.BACKGROUND_TASK_FAILURES.inc(task="transaction_flush")
+                logger.error("failed to write %d transactions, spooling", len(unwritten))
+                await asyncio.to_thread(cls._append_spool, unwritten)
+                return False
+        finally:
+            await cls._done([seq for seq, _ in entries])
+
+    @classmethod
+    async def _insert_rows(cls, rows) -> list:
+        """寫入 rows，回傳因連線等問題沒有寫入、需要留待重送的紀錄。
+
+        整批因資料錯誤失敗時逐筆重試，仍失敗的紀錄移到 quarantine 檔，不再重送。
+        """
+        try:
+            await cls._insert(rows)
+            return []
+        except ROW_ERRORS as exc:
+            if len(rows) == 1:
+                await asyncio.to_thread(cls._quarantine, [(rows[0], exc)])
+                return []
+            logger.warning("batch of %d transactions rejected, retrying one by one: %s", len(rows), exc)
+        except Exception as exc:
+            logger.error("failed to write %d transactions: %s", len(rows), exc)
+            return rows
+
+        rejected = []
+        try:
+            for index, row in enumerate(rows):
+                try:
+                    await cls._insert([row])
+                except ROW_ERRORS as exc:
+                    rejected.append((row, exc))
+                except Exception as exc:
+                    logger.error("failed to write %d transactions: %s", len(rows) - index, exc)
+                    return rows[index:]
+            return []
+        finally:
+            if rejected:
+                await asyncio.to_thread(cls._quarantine, rejected)
+
+    @staticmethod
+    async def _insert(rows):
+        if Migrations.applied is None:
+            await Migrations.refresh()
+        # migration 001 尚未套用時只寫入原有欄位（冪等鍵與回應只留在記憶體），不讓每筆 INSERT 失敗進 spool
+        columns = COLUMNS if Migrations.has(IDEMPOTENCY_COLUMNS) else BASE_COLUMNS
+        placeholders = "(" + ", ".join(["%s"] * len(columns)) + ")"
+        sql = (
+            f"INSERT INTO linepay_transactions ({', '.join(columns)}) VALUES "
+            + ", ".join([placeholders] * len(rows))
+        )
+        params = [value for row in rows for value in row[:len(columns)]]
+        async with Database.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, params)
+
+    @classmethod
+    @contextmanager
+    def _spool_lock(cls):
+        # spool 檔由同一程序的 thread 與其他 worker 共用：附加與取走（改名）需互斥，
+        # 否則改名前開啟的附加會寫進已被讀取、刪除的檔案
+        cls.SPOOL_PATH.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(cls.SPOOL_PATH.with_suffix(".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+            yield
+        finally:
+            os.close(fd)  # 關閉時一併釋放鎖
+
+    @classmethod
+    def _append_spool(cls, rows):
+        with cls._spool_lock(), cls.SPOOL_PATH.open("a", encoding="utf-8") as spool:
+            for row in rows:
+                spool.write(json.dumps(row, ensure_ascii=False) + "\n")
+            spool.flush()
+            os.fsync(spool.fileno())
+
+    @classmethod
+    def _quarantine(cls, rejected):
+        """MySQL 拒絕的紀錄連同錯誤訊息另存，需人工處理。"""
+        path = cls.SPOOL_PATH.with_suffix(".rejected")
+        with cls._spool_lock(), path.open("a", encoding="utf-8") as out:
+            for row, exc in rejected:
+                out.write(json.dumps({"row": row, "error": f"{type(exc).__name__}: {exc}"}, ensure_ascii=False) + "\n")
+                logger.error("transaction for order %s rejected by MySQL, quarantined: %s", row[0], exc)
+            out.flush()
+            os.fsync(out.fileno())
+        TRANSACTIONS_QUARANTINED.inc(len(rejected))
+
+    @classmethod
+    def _replay_path(cls) -> Path:
+        return cls.SPOOL_PATH.with_suffix(".replay")
+
+    @classmethod
+    def _take_spool(cls):
+        # 先把 spool 檔改名為 .taken（之後的附加寫入新的 spool 檔），再併入 replay 檔，
+        # 寫入成功後才刪除，重送中途當機也不會遺失
+        replay_path = cls._replay_path()
+        taken_path = cls.SPOOL_PATH.with_suffix(".taken")
+
+        def merge_taken():
+            if not taken_path.exists():
+                return
+            with taken_path.open(encoding="utf-8") as spool, replay_path.open("a", encoding="utf-8") as replay:
+                replay.write(spool.read())
+                replay.flush()
+                os.fsync(replay.fileno())
+            taken_path.unlink()
+
+        merge_taken()  # 上次改名後、併入前當機留下的檔案，先併入才不會被覆蓋
+        if cls.SPOOL_PATH.exists():
+            with cls._spool_lock():
+                try:
+                    os.replace(cls.SPOOL_PATH, taken_path)
+                except FileNotFoundError:
+                    pass
+            merge_taken()
+        if not replay_path.exists():
+            return []
+        with replay_path.open(encoding="utf-8") as replay:
+            rows = [tuple(json.loads(line)) for line in replay if line.strip()]
+        # 舊版 spool 的欄位較少，缺的欄位補 None
+        return [row + (None,) * (len(COLUMNS) - len(row)) for row in rows]
+
+    @staticmethod
+    def _latest_per_order(rows):
+        """同一 order_id 只保留最後一筆（例如先 spool 的 pending 與之後的最終結果），其餘順序不變。"""
+        last = {row[0]: index for index, row in enumerate(rows)}
+        return [row for index, row in enumerate(rows) if last[row[0]] == index]
+
+    @staticmethod
+    async def _recorded_orders(order_ids) -> set:
+        """已寫入 linepay_transactions 的 order_id。"""
+        if not order_ids:
+            return set()
+        placeholders = ", ".join(["%s"] * len(order_ids))
+        async with Database.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"SELECT order_id FROM linepay_transactions WHERE order_id IN ({placeholders})", list(order_ids)
+                )
+                return {row[0] for row in await cursor.fetchall()}
+
+    @classmethod
+    def _finish_spool(cls, remaining):
+        replay_path = cls._replay_path()
+        if not remaining:
+            replay_path.unlink(missing_ok=True)
+            return
+        tmp_path = replay_path.with_suffix(".tmp")
+        with tmp_path.open("w", encoding="utf-8") as replay:
+            for row in remaining:
+                replay.write(json.dumps(row, ensure_ascii=False) + "\n")
+            replay.flush()
+            os.fsync(replay.fileno())
+        os.replace(tmp_path, replay_path)
+
+    @classmethod
+    async def _replay_spool(cls):
+        cls._last_spool_retry = time.monotonic()
+        # spool 檔由所有 worker 共用，只由 leader 重送
+        if not LeaderElection.is_leader:
+            return
+        async with cls._write_lock:
+            rows = cls._latest_per_order(await asyncio.to_thread(cls._take_spool))
+            if not rows:
+                return
+            sent, remaining = 0, []
+            try:
+                while sent < len(rows):
+                    batch = rows[sent:sent + cls.BATCH_SIZE]
+                    recorded = await cls._recorded_orders([row[0] for row in batch])
+                    unwritten = await cls._insert_rows([row for row in batch if row[0] not in recorded])
+                    sent += len(batch)
+                    if unwritten:
+                        remaining = unwritten
+                        break
+            except Exception as exc:
+                logger.error("spool replay failed: %s", exc)
+            remaining += rows[sent:]
+            if remaining:
+                logger.error("spool replay incomplete, keeping %d transactions", len(remaining))
+            await asyncio.to_thread(cls._finish_spool, remaining)